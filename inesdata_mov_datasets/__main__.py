@@ -11,9 +11,7 @@ from rich.progress import Progress, SpinnerColumn, TextColumn
 from inesdata_mov_datasets.sources.create.aemet import create_aemet
 from inesdata_mov_datasets.sources.create.emt import create_emt
 from inesdata_mov_datasets.sources.create.informo import create_informo
-from inesdata_mov_datasets.sources.extract.aemet import get_aemet
-from inesdata_mov_datasets.sources.extract.emt import get_emt
-from inesdata_mov_datasets.sources.extract.informo import get_informo
+from inesdata_mov_datasets.sources.extract.daemon import extract_sources, run_daemon
 from inesdata_mov_datasets.utils import read_settings
 
 app = typer.Typer(add_completion=False)
@@ -39,27 +37,35 @@ def extract(
     sources: Sources = typer.Option(
         default=Sources.all.value, help="Possible sources to extract."
     ),
+    daemon: bool = typer.Option(
+        default=False, help="Keep running and extract on every wall-clock minute."
+    ),
 ):
-    """Extract raw data from the sources configurated."""
+    """Extract raw data from the sources configurated.
+
+    With --daemon the command stays resident: EMT is extracted every minute, Informo every 5
+    minutes and AEMET every `daemon_interval` minutes, reusing the same connections.
+    """
+    settings = read_settings(config_path)
+    if sources.value == sources.all:
+        selected_sources = [source.value for source in Sources if source != Sources.all]
+    else:
+        selected_sources = [sources.value]
+
+    if daemon:
+        print("Running extraction daemon")
+        asyncio.run(run_daemon(settings, selected_sources))
+        return
+
     with Progress(
         SpinnerColumn(),
         TextColumn("[progress.description]{task.description}"),
         transient=True,
     ) as progress:
-        # read settings
-        settings = read_settings(config_path)
-        # EMT
-        if sources.value == sources.emt or sources.value == sources.all:
-            progress.add_task(description="Extracting EMT data...", total=None)
-            asyncio.run(get_emt(settings))
-        # Aemet
-        if sources.value == sources.aemet or sources.value == sources.all:
-            progress.add_task(description="Extracting AEMET data...", total=None)
-            asyncio.run(get_aemet(settings))
-        # Informo
-        if sources.value == sources.informo or sources.value == sources.all:
-            progress.add_task(description="Extracting Informo data...", total=None)
-            asyncio.run(get_informo(settings))
+        description = ", ".join(source.upper() for source in selected_sources)
+        progress.add_task(description=f"Extracting {description} data...", total=None)
+        # All the sources run concurrently in a single event loop
+        asyncio.run(extract_sources(settings, selected_sources))
 
         print("Extracted data")
 
@@ -0,0 +1,96 @@
+"""Adaptive limit of the http calls in flight to a source."""
+import asyncio
+import datetime
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from inesdata_mov_datasets.settings import SourceEmtConcurrencySettings
+from inesdata_mov_datasets.utils import read_json_state, write_json_state
+
+
+class AimdLimiter:
+    """Limit of in-flight calls with additive increase and multiplicative decrease (AIMD).
+
+    The limit grows by about one call per round of fast and successful calls, and it is
+    multiplied by `decrease_factor` when a call shows overload (throttling, server errors,
+    timeouts or EMT error codes). Calls started before the last decrease do not decrease it
+    again, so a burst of failures only cuts the limit once.
+    """
+
+    def __init__(self, settings: SourceEmtConcurrencySettings, limit: float = None):
+        """Create the limiter.
+
+        Args:
+            settings (SourceEmtConcurrencySettings): Bounds and parameters of the limiter.
+            limit (float): Starting limit. If not provided, `settings.initial_limit` is used.
+        """
+        self.settings = settings
+        if limit is None:
+            limit = settings.initial_limit
+        self.limit = min(max(limit, settings.min_limit), settings.max_limit)
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self._last_decrease = 0.0
+
+    async def acquire(self) -> float:
+        """Wait for a free slot and take it.
+
+        Returns:
+            float: Monotonic time at which the call starts, to be given back on release.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, start: float, overloaded: bool):
+        """Free the slot of a call and adapt the limit to its outcome.
+
+        Args:
+            start (float): Value returned by `acquire` for this call.
+            overloaded (bool): True if the call showed that the source is overloaded.
+        """
+        latency = time.monotonic() - start
+        async with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                if start >= self._last_decrease:
+                    self.limit = max(
+                        self.settings.min_limit, self.limit * self.settings.decrease_factor
+                    )
+                    self._last_decrease = time.monotonic()
+            elif latency <= self.settings.latency_target:
+                self.limit = min(self.settings.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    @classmethod
+    def load(cls, settings: SourceEmtConcurrencySettings, state_path: Path) -> "AimdLimiter":
+        """Create the limiter from the limit saved by a previous run.
+
+        Args:
+            settings (SourceEmtConcurrencySettings): Bounds and parameters of the limiter.
+            state_path (Path): Local file with the state of the limiter.
+
+        Returns:
+            AimdLimiter: Limiter starting at the saved limit, or at the initial one if there is
+                no valid state file.
+        """
+        limit = None
+        state = read_json_state(state_path)
+        if "limit" in state:
+            try:
+                limit = float(state["limit"])
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Ignoring concurrency state file {state_path}: {e}")
+        return cls(settings, limit)
+
+    def save(self, state_path: Path):
+        """Save the current limit so the next run starts from it.
+
+        Args:
+            state_path (Path): Local file with the state of the limiter.
+        """
+        state = {"limit": self.limit, "updated": datetime.datetime.now().isoformat()}
+        write_json_state(state_path, state)
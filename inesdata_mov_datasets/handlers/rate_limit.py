@@ -0,0 +1,83 @@
+"""Token bucket rate limit of the http calls to a source."""
+import asyncio
+import time
+
+from inesdata_mov_datasets.settings import RateLimitSettings
+
+# Buckets shared by all the runs of the process, by (key, rate, burst)
+_buckets = {}
+
+
+class TokenBucket:
+    """Token bucket: `rate` calls per second on average, with bursts of up to `burst` calls.
+
+    Each call takes a token. When there are none left the call reserves the next one and
+    sleeps until it is refilled, so waiting calls go out in order and never above the rate.
+    The time spent waiting is counted in `waits` and `wait_time`.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """Create the bucket full.
+
+        Args:
+            rate (float): Tokens refilled per second.
+            burst (int): Capacity of the bucket.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.calls = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def expected_wait(self) -> float:
+        """Get the seconds a call taking a token now would wait.
+
+        Returns:
+            float: Seconds to wait, 0 if there is a token available.
+        """
+        self._refill()
+        return max(1 - self.tokens, 0) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Take a token, waiting for it if the bucket is empty."""
+        self._refill()
+        self.tokens -= 1
+        self.calls += 1
+        if self.tokens >= 0:
+            return
+
+        wait = -self.tokens / self.rate
+        self.waits += 1
+        self.wait_time += wait
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # Give back the reserved token to the calls still waiting
+            self.tokens += 1
+            raise
+
+
+def get_token_bucket(settings: RateLimitSettings, key: str = None) -> TokenBucket | None:
+    """Get the bucket of a rate limit, shared by every run of the process.
+
+    Args:
+        settings (RateLimitSettings): Rate limit settings.
+        key (str): Owner of the limit, e.g. the credential of the calls. Each key gets
+            its own bucket.
+
+    Returns:
+        TokenBucket | None: Shared bucket, or None if there is no rate limit configured.
+    """
+    if settings is None or settings.rate is None:
+        return None
+    bucket_key = (key, settings.rate, settings.burst)
+    if bucket_key not in _buckets:
+        _buckets[bucket_key] = TokenBucket(settings.rate, settings.burst)
+    return _buckets[bucket_key]
@@ -0,0 +1,67 @@
+"""In-process cache of the responses of a source, with concurrent requests coalesced."""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+# Cached responses, by key: {"value": response, "expiration": monotonic seconds}
+_entries = {}
+# Fetches in progress, by key
+_inflight = {}
+
+
+def clear_cache():
+    """Forget every cached response."""
+    _entries.clear()
+
+
+def _prune(now: float):
+    for key in [key for key, entry in _entries.items() if entry["expiration"] <= now]:
+        del _entries[key]
+
+
+async def cached_fetch(
+    key: Hashable,
+    ttl: float,
+    fetch: Callable[[], Awaitable],
+    cacheable: Callable[[Any], bool] = None,
+) -> Any:
+    """Get a response from the cache, or fetch it once for every concurrent request of the key.
+
+    A request arriving while the same key is being fetched waits for that fetch instead of
+    making its own, and gets its response or its exception. Exceptions are never cached.
+
+    Args:
+        key (Hashable): Identity of the request, e.g. (source, stop, line).
+        ttl (float): Seconds the response is reused. With 0 it is not cached, but concurrent
+            requests are still coalesced.
+        fetch (Callable[[], Awaitable]): Function returning the coroutine that fetches the
+            response.
+        cacheable (Callable[[Any], bool]): Whether a response can be cached, e.g. not an error
+            code. If not provided, every response is cached.
+
+    Returns:
+        Any: Response of the request.
+    """
+    entry = _entries.get(key)
+    if entry is not None and time.monotonic() < entry["expiration"]:
+        return entry["value"]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+
+        def finish(task: asyncio.Future):
+            del _inflight[key]
+            if task.cancelled() or task.exception() is not None or ttl <= 0:
+                return
+            value = task.result()
+            if cacheable is None or cacheable(value):
+                now = time.monotonic()
+                _prune(now)
+                _entries[key] = {"value": value, "expiration": now + ttl}
+
+        task.add_done_callback(finish)
+
+    # Shielded so a cancelled request does not cancel the fetch of the others
+    return await asyncio.shield(task)
@@ -0,0 +1,183 @@
+"""Retry policy of the http calls to the sources."""
+import asyncio
+import datetime
+import email.utils
+import json
+import random
+import re
+
+import aiohttp
+from loguru import logger
+
+from inesdata_mov_datasets.handlers.concurrency import AimdLimiter
+from inesdata_mov_datasets.handlers.rate_limit import TokenBucket
+from inesdata_mov_datasets.settings import SourceEmtRetrySettings
+
+# Http statuses that show the source is overloaded
+OVERLOAD_STATUSES = {429, 500, 502, 503, 504}
+# First "code" field of a json body, the one of EMT responses goes before their data
+CODE_PATTERN = re.compile(rb'"code"\s*:\s*"?(-?\w+)')
+# EMT response codes of a successful call
+SUCCESS_CODES = ("00",)
+
+
+def parse_retry_after(value: str) -> float | None:
+    """Get the seconds to wait from a Retry-After header.
+
+    Args:
+        value (str): Value of the header, in seconds or as an http date.
+
+    Returns:
+        float | None: Seconds to wait, or None if the header is missing or not valid.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(retry_date.tzinfo)
+    return max((retry_date - now).total_seconds(), 0)
+
+
+def retry_delay(retry: SourceEmtRetrySettings, attempt: int, retry_after: float = None) -> float:
+    """Get the seconds to wait before the next attempt.
+
+    Exponential backoff with full jitter, never shorter than the Retry-After of the server.
+
+    Args:
+        retry (SourceEmtRetrySettings): Retry policy.
+        attempt (int): Number of the failed attempt, starting at 1.
+        retry_after (float): Seconds asked by the server with Retry-After, if any.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    backoff = random.uniform(0, min(retry.backoff_max, retry.backoff_base * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        return max(retry_after, backoff)
+    return backoff
+
+
+def response_code(body: bytes) -> str | None:
+    """Get the `code` of an EMT response without decoding the whole json.
+
+    Args:
+        body (bytes): Raw body of the response.
+
+    Returns:
+        str | None: Value of the code, None if the body has no code.
+    """
+    match = CODE_PATTERN.search(body)
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+
+def is_retryable_code(
+    retry: SourceEmtRetrySettings, data: json, success_codes: tuple = SUCCESS_CODES
+) -> bool:
+    """Check if the `code` of an EMT response has to be retried.
+
+    Args:
+        retry (SourceEmtRetrySettings): Retry policy.
+        data (json): Response in json format.
+        success_codes (tuple): Codes of a successful call to the endpoint, never retried.
+
+    Returns:
+        bool: True if the call has to be retried.
+    """
+    if not isinstance(data, dict):
+        return False
+    code = str(data.get("code"))
+    if code in success_codes:
+        return False
+    if retry.retry_codes is None:
+        return True
+    return code in retry.retry_codes
+
+
+async def request_json(
+    session: aiohttp.ClientSession,
+    method: str,
+    url: str,
+    retry: SourceEmtRetrySettings = None,
+    content_type: str = "application/json",
+    limiter: AimdLimiter = None,
+    rate_limiter: TokenBucket = None,
+    raw: bool = False,
+    success_codes: tuple = SUCCESS_CODES,
+    **kwargs,
+) -> json:
+    """Make an http call and return its json, retrying the retryable failures.
+
+    Timeouts, connection errors, the statuses in `retry.retry_statuses` and the response
+    codes accepted by `is_retryable_code` are retried. Any other http error is raised at once.
+
+    Args:
+        session (aiohttp.ClientSession): Call session to make faster the calls to the same API.
+        method (str): Http method.
+        url (str): Url of the call.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        content_type (str): Expected content type of the response, None to skip the check.
+        limiter (AimdLimiter): Adaptive limit of calls in flight. Each attempt takes a slot
+            and reports whether the source looked overloaded.
+        rate_limiter (TokenBucket): Rate limit of the source. Each attempt takes a token.
+        raw (bool): Return the body as received instead of decoding it. Only its `code` is
+            read, with `response_code`.
+        success_codes (tuple): EMT response codes of a successful call to the endpoint.
+            They are neither retried nor reported as overload to the limiter.
+        **kwargs: Arguments of the request (headers, json, ...).
+
+    Returns:
+        json | bytes: Response in json format, or its raw body if `raw`. On the last attempt
+            it is returned whatever its code.
+
+    Raises:
+        aiohttp.ClientError: If the call fails and it cannot be retried anymore.
+        asyncio.TimeoutError: If the last attempt times out.
+    """
+    max_attempts = retry.max_attempts if retry is not None else 1
+    for attempt in range(1, max_attempts + 1):
+        last_attempt = attempt == max_attempts
+        retry_after = None
+        # Any failure but a non-overload http error counts as overload for the limiter
+        overloaded = True
+        if rate_limiter is not None:
+            await rate_limiter.acquire()
+        start = await limiter.acquire() if limiter is not None else None
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                overloaded = response.status in OVERLOAD_STATUSES
+                if not last_attempt and response.status in retry.retry_statuses:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    logger.debug(f"Status {response.status} in {url}, attempt {attempt}")
+                else:
+                    response.raise_for_status()
+                    if raw:
+                        data = await response.read()
+                        checked = {"code": response_code(data)}
+                    else:
+                        data = await response.json(content_type=content_type)
+                        checked = data
+                    overloaded = (
+                        isinstance(checked, dict) and str(checked.get("code")) not in success_codes
+                    )
+                    if last_attempt or not is_retryable_code(retry, checked, success_codes):
+                        return data
+                    logger.debug(f"Error code {checked.get('code')} in {url}, attempt {attempt}")
+        except aiohttp.ClientResponseError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if last_attempt:
+                raise
+            logger.debug(f"Error {e!r} in {url}, attempt {attempt}")
+        finally:
+            if limiter is not None:
+                await limiter.release(start, overloaded)
+
+        await asyncio.sleep(retry_delay(retry, attempt, retry_after))
@@ -0,0 +1,126 @@
+"""Cache of the access tokens of a source, in memory and shared by concurrent processes."""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from inesdata_mov_datasets.utils import read_json_state, write_json_state
+
+try:
+    import fcntl
+except ImportError:  # Windows, the shared cache is used without lock
+    fcntl = None
+
+# Tokens of the process, by credential: {"token": str, "expiration": unix seconds}
+_tokens = {}
+# Background refreshes in progress, by credential
+_refreshing = {}
+# Seconds between two attempts to take the lock of the shared cache
+LOCK_POLL_INTERVAL = 0.05
+
+
+def login_expiration(login_json: dict) -> float | None:
+    """Get the expiration of the token of an EMT login response.
+
+    Args:
+        login_json (dict): Login response in json format.
+
+    Returns:
+        float | None: Unix time at which the token expires, None if it is not provided.
+    """
+    try:
+        # tokenDteExpiration comes in milliseconds
+        return login_json["data"][0]["tokenDteExpiration"]["$date"] / 1000
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def remember_token(key: str, token: str, expiration: float):
+    """Keep a token in memory.
+
+    Args:
+        key (str): Credential of the token.
+        token (str): Access token.
+        expiration (float): Unix time at which the token expires.
+    """
+    _tokens[key] = {"token": token, "expiration": expiration}
+
+
+def get_cached_token(key: str) -> dict | None:
+    """Get the token of a credential kept in memory.
+
+    Args:
+        key (str): Credential of the token.
+
+    Returns:
+        dict | None: Token and expiration, None if there is none.
+    """
+    return _tokens.get(key)
+
+
+def refresh_in_background(key: str, refresh: Callable[[], Awaitable]):
+    """Start the refresh of a token unless it is already being refreshed.
+
+    Args:
+        key (str): Credential of the token.
+        refresh (Callable[[], Awaitable]): Function returning the coroutine that refreshes it.
+    """
+    task = _refreshing.get(key)
+    if task is not None and not task.done():
+        return
+    logger.debug("Refreshing EMT token before it expires")
+    _refreshing[key] = asyncio.ensure_future(refresh())
+
+
+@asynccontextmanager
+async def shared_cache_lock(cache_path: Path):
+    """Hold the lock of the shared cache, so only one process refreshes a token at a time.
+
+    Args:
+        cache_path (Path): Local file of the shared cache. The lock is taken on a `.lock`
+            file next to it.
+    """
+    os.makedirs(Path(cache_path).parent, exist_ok=True)
+    with open(f"{cache_path}.lock", "a") as lock_file:
+        if fcntl is not None:
+            # Poll without blocking: a thread blocked on flock per waiting credential could
+            # take every worker of the executor that the lock holder needs for its login
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def read_shared_tokens(cache_path: Path) -> dict:
+    """Read the tokens of the shared cache.
+
+    Args:
+        cache_path (Path): Local file of the shared cache.
+
+    Returns:
+        dict: Token and expiration by credential, empty if there is no valid cache file.
+    """
+    return read_json_state(cache_path)
+
+
+def save_shared_token(cache_path: Path, key: str, entry: dict):
+    """Save the token of a credential in the shared cache.
+
+    Args:
+        cache_path (Path): Local file of the shared cache.
+        key (str): Credential of the token.
+        entry (dict): Token and expiration.
+    """
+    tokens = read_shared_tokens(cache_path)
+    tokens[key] = entry
+    write_json_state(cache_path, tokens)
@@ -1,16 +1,32 @@
-from typing import List, Optional
-
-from pydantic import BaseModel, model_validator
+import importlib.util
+from typing import List, Literal, Optional
+
+from pydantic import (
+    BaseModel,
+    NonNegativeFloat,
+    NonNegativeInt,
+    PositiveFloat,
+    PositiveInt,
+    model_validator,
+)
 from pydantic_settings import BaseSettings
 
 # Sources settings
 
 
+class RateLimitSettings(BaseModel):
+    # Calls per second to the source, None disables the limit
+    rate: Optional[PositiveFloat] = None
+    burst: PositiveInt = 10
+
+
 class SourceEmtCredentialsSettings(BaseModel):
     email: Optional[str] = None
     password: Optional[str] = None
     x_client_id: Optional[str] = None
     passkey: Optional[str] = None
+    # Rate limit of the calls made with this credential, None uses sources.emt.rate_limit
+    rate_limit: Optional[RateLimitSettings] = None
 
     @model_validator(mode="after")
     def check_passwords_match(self) -> "EmtCredentialsSettings":
@@ -35,23 +51,162 @@ class SourceEmtCredentialsSettings(BaseModel):
         return self
 
 
+class SourceEmtHttpSettings(BaseModel):
+    limit: int = 100
+    limit_per_host: int = 50
+    keepalive_timeout: float = 30
+    ttl_dns_cache: int = 300
+    total_timeout: float = 20
+    connect_timeout: float = 5
+    read_timeout: float = 10
+
+
+class SourceEmtRetrySettings(BaseModel):
+    max_attempts: PositiveInt = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8
+    retry_statuses: List[int] = [429, 500, 502, 503, 504]
+    # EMT response codes to retry, None retries every code that is not a success code of the
+    # endpoint ("00", or "00" and "01" in the login)
+    retry_codes: Optional[List[str]] = None
+
+
+class SourceEmtConcurrencySettings(BaseModel):
+    initial_limit: PositiveInt = 50
+    min_limit: PositiveInt = 5
+    max_limit: PositiveInt = 500
+    decrease_factor: float = 0.5
+    latency_target: float = 1.0
+    # Local file with the limit reached by the last run, by default in the logs folder
+    state_path: Optional[str] = None
+
+
+class SourceEmtTokenSettings(BaseModel):
+    # Seconds before expiry at which the token starts to be refreshed in background
+    refresh_margin: float = 300
+    # Local file with the tokens shared by concurrent processes, by default in the logs folder
+    cache_path: Optional[str] = None
+
+
+class SourceEmtServiceWindowSettings(BaseModel):
+    # Skip the stops whose lines are all out of service
+    enabled: bool = False
+    # Minutes before StartTime and after StopTime in which a line still counts as in service
+    margin: NonNegativeInt = 15
+    # Minutes between polls of a skipped stop, to find lines not seen there yet
+    probe_interval: PositiveInt = 30
+    # Local file with the lines seen at each stop and the service windows of the day,
+    # by default in the logs folder
+    state_path: Optional[str] = None
+
+
+class SourceEmtCoverageSettings(BaseModel):
+    # Skip the stops whose buses are all observed by other polled stops
+    enabled: bool = False
+    # Max minutes since the last observation of a stop, older ones are polled again
+    staleness: PositiveInt = 5
+    # Local file with the buses observed by stop, by default in the logs folder
+    state_path: Optional[str] = None
+
+
+class SourceEmtStopTierSettings(BaseModel):
+    # Minutes between polls of the stops of the tier
+    every: PositiveInt
+    stops: List[int]
+
+
 class SourceEmtSettings(BaseModel):
-    credentials: SourceEmtCredentialsSettings
+    # A single credential or a list of them, the ETA calls are spread across their tokens
+    credentials: SourceEmtCredentialsSettings | List[SourceEmtCredentialsSettings]
+    credentials_strategy: Literal["round_robin", "least_loaded"] = "round_robin"
+    token: SourceEmtTokenSettings = SourceEmtTokenSettings()
     stops: List[int]
+    # Stops polled less often than every run, spread evenly across the minutes of each tier
+    stop_tiers: List[SourceEmtStopTierSettings] = []
     lines: List[int]
+    http: SourceEmtHttpSettings = SourceEmtHttpSettings()
+    run_deadline: float = 50
+    retry: SourceEmtRetrySettings = SourceEmtRetrySettings()
+    concurrency: SourceEmtConcurrencySettings = SourceEmtConcurrencySettings()
+    rate_limit: RateLimitSettings = RateLimitSettings()
+    eta_layout: Literal["files", "packed"] = "files"
+    eta_compression: Literal["gzip", "zstd"] = "gzip"
+    # Writers storing the ETA responses of the files layout as they arrive, 0 stores them all
+    # once the calls end
+    eta_stream_workers: NonNegativeInt = 20
+    # Store an ETA response whose arrivals did not change as a reference to the last stored one
+    eta_dedup: bool = False
+    # Local file with the last stored snapshot by stop, by default in the logs folder
+    eta_dedup_state_path: Optional[str] = None
+    # Poll only the stops with some line in service
+    service_window: SourceEmtServiceWindowSettings = SourceEmtServiceWindowSettings()
+    # Poll only the fewest stops that still observe every bus
+    coverage: SourceEmtCoverageSettings = SourceEmtCoverageSettings()
+
+    @model_validator(mode="after")
+    def check_tier_stops(self) -> "SourceEmtSettings":
+        # Tiers only thin out `stops`, a tier stop missing from them would never be polled
+        missing = [
+            stop_id
+            for tier in self.stop_tiers
+            for stop_id in tier.stops
+            if stop_id not in self.stops
+        ]
+        if missing:
+            raise ValueError(f"Stops {missing} of stop_tiers are not in stops")
+        return self
+
+    @model_validator(mode="after")
+    def check_eta_compression(self) -> "SourceEmtSettings":
+        # Fail when the config is read, not after the ETA calls of every run
+        if self.eta_compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+            raise ValueError("eta_compression zstd requires the zstandard package")
+        return self
 
 
 class SourceAemetCredentialsSettings(BaseModel):
     api_key: str = None
 
 
+class SourceAemetRefreshSettings(BaseModel):
+    # "daily" stores one forecast a day, "hours" one every `hours` hours and "vintage" every
+    # forecast published by AEMET, told apart by their `elaborado` date
+    policy: Literal["daily", "hours", "vintage"] = "daily"
+    hours: PositiveInt = 6
+
+
 class SourceAemetSettings(BaseModel):
     credentials: SourceAemetCredentialsSettings
+    daemon_interval: PositiveInt = 60
+    # Which forecasts are stored, the download is skipped when it would not be stored
+    refresh: SourceAemetRefreshSettings = SourceAemetRefreshSettings()
+    # INE codes of the municipalities whose forecast is extracted
+    municipalities: List[str] = ["28079"]
+    # Token bucket shared by every AEMET call, each municipality makes two. AEMET allows
+    # around 50 calls a minute by api key
+    rate_limit: RateLimitSettings = RateLimitSettings(rate=0.8, burst=4)
+
+
+class SourceInformoSettings(BaseModel):
+    # Local file with the validators of the last stored XML, by default in the logs folder
+    state_path: Optional[str] = None
+
+
+class SourceFilterCacheSettings(BaseModel):
+    # Seconds each response of the filtered extraction is reused, 0 disables the cache. The
+    # calendar is also cached by day
+    eta: NonNegativeFloat = 20
+    calendar: NonNegativeFloat = 24 * 3600
+    informo: NonNegativeFloat = 5 * 60
+    aemet: NonNegativeFloat = 3600
 
 
 class SourcesSettings(BaseSettings):
     emt: Optional[SourceEmtSettings] = None
     aemet: Optional[SourceAemetSettings] = None
+    informo: SourceInformoSettings = SourceInformoSettings()
+    # In-process cache of the filtered extraction (extract_filtered)
+    filter_cache: SourceFilterCacheSettings = SourceFilterCacheSettings()
 
 
 # Storage
@@ -63,6 +218,7 @@ class StorageMinioSettings(BaseModel):
     endpoint: str
     secure: bool
     bucket: str
+    max_pool_connections: int = 50
 
 
 class StorageLocalSettings(BaseModel):
@@ -78,6 +78,11 @@ def generate_df_from_file(content: dict, date: str) -> pd.DataFrame:
                             )
                         else:
                             day_df_final = day_df_aux
+                # Several municipalities are stored in the same day, AEMET sends its INE code
+                day_df_final["municipality"] = content[0].get("id")
+                # Forecasts stored several times a day are told apart by their vintage
+                if "elaborado" in content[0]:
+                    day_df_final["elaborado"] = content[0]["elaborado"]
     except Exception as e:
         logger.error(e)
         logger.error(traceback.format_exc())
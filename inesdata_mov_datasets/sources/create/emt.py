@@ -10,7 +10,7 @@ from loguru import logger
 
 from inesdata_mov_datasets.handlers.logger import instantiate_logger
 from inesdata_mov_datasets.settings import Settings
-from inesdata_mov_datasets.utils import async_download
+from inesdata_mov_datasets.utils import async_download, is_packed_file, read_ndjson
 
 
 def generate_calendar_df_from_file(content: dict) -> pd.DataFrame:
@@ -248,6 +248,41 @@ def generate_eta_df_from_file(content: dict) -> pd.DataFrame:
     return day_df
 
 
+def expand_eta_references(raw_storage_dir: Path, references: list) -> list:
+    """Generate the dataframes of the ETA snapshots stored as references to a previous one.
+
+    Args:
+        raw_storage_dir (Path): local directory with the day's ETA files
+        references (list): references with the datetime of the snapshot, its stop and the
+            file of the stored snapshot
+
+    Returns:
+        list: a pandas dataframe per reference, the stored snapshot at the reference datetime
+    """
+    dfs = []
+    snapshots = {}
+    for reference in references:
+        key = (reference["ref"], str(reference["stop_id"]))
+        if key not in snapshots:
+            filename = raw_storage_dir / reference["ref"]
+            snapshots[key] = None
+            if not filename.exists():
+                logger.warning(f"Missing ETA snapshot {reference['ref']}")
+            elif is_packed_file(reference["ref"]):
+                for record in read_ndjson(filename):
+                    snapshots[(reference["ref"], str(record["stop_id"]))] = record["response"]
+            else:
+                with open(filename, "r") as f:
+                    snapshots[key] = json.load(f)
+        content = snapshots.get(key)
+        if content is None:
+            continue
+        dfs.append(generate_eta_df_from_file({**content, "datetime": reference["datetime"]}))
+    if references:
+        logger.info(f"Expanded #{len(dfs)} ETA snapshots stored as references")
+    return dfs
+
+
 def generate_eta_day_df(storage_path: str, date: str) -> pd.DataFrame:
     """Generate a day's pandas dataframe from a whole day's files downloaded from MinIO.
 
@@ -259,16 +294,31 @@ def generate_eta_day_df(storage_path: str, date: str) -> pd.DataFrame:
         pd.DataFrame: day's pandas dataframe
     """
     dfs = []
+    # unchanged snapshots stored as references to a previous one, expanded at the end
+    references = []
     raw_storage_dir = Path(storage_path) / Path("raw") / "emt" / date / "eta"
     raw_storage_dir.mkdir(parents=True, exist_ok=True)
     files = os.listdir(raw_storage_dir)
     logger.info(f"#{len(files)} files from EMT ETA endpoint")
     for file in files:
         filename = raw_storage_dir / file
+        # packed layout: one NDJSON line per stop response of an extraction run
+        if is_packed_file(file):
+            for record in read_ndjson(filename):
+                if "ref" in record["response"]:
+                    references.append(record["response"])
+                    continue
+                df = generate_eta_df_from_file(record["response"])
+                dfs.append(df)
+            continue
         with open(filename, "r") as f:
             content = json.load(f)
+        if "ref" in content:
+            references.append(content)
+            continue
         df = generate_eta_df_from_file(content)
         dfs.append(df)
+    dfs.extend(expand_eta_references(raw_storage_dir, references))
 
     if len(dfs) > 0:
         final_df = pd.concat(dfs)
@@ -44,7 +44,8 @@ def generate_df_from_file(content: dict) -> pd.DataFrame:
     """Generate a day's pandas dataframe from a single file downloaded from MinIO.
 
     Args:
-        content (dict): traffic info from a file
+        content (dict): traffic info from a file. Its `pm` can also be an iterator of records,
+            e.g. the one of `extract.informo.parse_informo`, read as the df is built.
 
     Returns:
         pd.DataFrame: day's pandas dataframe from a single file downloaded from MinIO
@@ -1,24 +1,140 @@
 """Gather raw data from aemet."""
 
+import asyncio
 import datetime
 import json
 import traceback
 from pathlib import Path
 import pytz
 
-import requests
+import aiohttp
+from aiobotocore.session import ClientCreatorContext
 from loguru import logger
 
 from inesdata_mov_datasets.handlers.logger import instantiate_logger
+from inesdata_mov_datasets.handlers.rate_limit import TokenBucket, get_token_bucket
 from inesdata_mov_datasets.settings import Settings
-from inesdata_mov_datasets.utils import check_local_file_exists, check_s3_file_exists, upload_objs
+from inesdata_mov_datasets.utils import http_session, list_stored_objs, storage_client, upload_objs
 
+AEMET_MUNICIPALITY_URL = (
+    "https://opendata.aemet.es/opendata/api/prediccion/especifica/municipio/horaria/{}"
+)
+# Municipality extracted before the list was configurable, it keeps its object names
+MADRID_MUNICIPALITY = "28079"
 
-async def get_aemet(config: Settings):
-    """Request aemet API to get data from Madrid weather.
+
+async def fetch_aemet(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: json,
+    rate_limiter: TokenBucket = None,
+) -> json:
+    """Make the two calls of an AEMET request: the endpoint and then its `datos` url.
+
+    Args:
+        session (aiohttp.ClientSession): Call session to make faster the calls to the same API.
+        url (str): Url of the AEMET endpoint.
+        headers (json): Headers of the http call.
+        rate_limiter (TokenBucket): Rate limit of AEMET. Each of the two calls takes a token.
+
+    Returns:
+        json: Data of the response in json format.
+    """
+    if rate_limiter is not None:
+        await rate_limiter.acquire()
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        # AEMET does not always answer with an application/json content type
+        datos_url = (await response.json(content_type=None))["datos"]
+
+    if rate_limiter is not None:
+        await rate_limiter.acquire()
+    async with session.get(datos_url) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+def aemet_object_name(
+    config: Settings,
+    current_datetime: datetime.datetime,
+    data: json = None,
+    municipality: str = MADRID_MUNICIPALITY,
+) -> str | None:
+    """Get the object name of the forecast of a run, following the refresh policy.
 
     Args:
         config (Settings): Object with the config file.
+        current_datetime (datetime.datetime): Datetime of the run in Madrid.
+        data (json): Forecast of the run. Only needed by the "vintage" policy.
+        municipality (str): INE code of the municipality. Madrid keeps the names without it.
+
+    Returns:
+        str | None: Object name relative to the storage root, None if the policy needs the
+            forecast and it is not provided.
+    """
+    refresh = config.sources.aemet.refresh
+    formatted_date_slash = current_datetime.strftime("%Y/%m/%d")
+    if refresh.policy == "hours":
+        slot_hour = current_datetime.hour // refresh.hours * refresh.hours
+        file_date = current_datetime.replace(hour=slot_hour, minute=0).strftime("%Y%m%dT%H%M")
+    elif refresh.policy == "vintage":
+        if data is None:
+            return None
+        elaborado = datetime.datetime.fromisoformat(data[0]["elaborado"])
+        file_date = elaborado.strftime("%Y%m%dT%H%M")
+    else:
+        file_date = current_datetime.strftime("%Y%m%d")
+    if municipality != MADRID_MUNICIPALITY:
+        file_date = f"{municipality}_{file_date}"
+    return f"raw/aemet/{formatted_date_slash}/aemet_{file_date}.json"
+
+
+async def get_aemet_municipality(
+    config: Settings,
+    session: aiohttp.ClientSession,
+    municipality: str,
+    headers: json,
+    stored_objs: set,
+    s3_client: ClientCreatorContext = None,
+    rate_limiter: TokenBucket = None,
+):
+    """Request and store the forecast of a municipality.
+
+    Args:
+        config (Settings): Object with the config file.
+        session (aiohttp.ClientSession): Call session to make faster the calls to the same API.
+        municipality (str): INE code of the municipality.
+        headers (json): Headers of the http call.
+        stored_objs (set): Index of the AEMET objects already stored today.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        rate_limiter (TokenBucket): Rate limit of AEMET, if any.
+    """
+    try:
+        url = AEMET_MUNICIPALITY_URL.format(municipality)
+        r_json = await fetch_aemet(session, url, headers, rate_limiter=rate_limiter)
+        await save_aemet(
+            config, r_json, s3_client=s3_client, stored_objs=stored_objs, municipality=municipality
+        )
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+
+
+async def get_aemet(
+    config: Settings,
+    s3_client: ClientCreatorContext = None,
+    session: aiohttp.ClientSession = None,
+):
+    """Request aemet API to get the weather of the configured municipalities.
+
+    The municipalities are requested concurrently, under the AEMET rate limit. Each one is
+    stored as soon as its `datos` arrive.
+
+    Args:
+        config (Settings): Object with the config file.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the run.
     """
     try:
         # Logger
@@ -26,20 +142,48 @@ async def get_aemet(config: Settings):
         logger.info("Extracting AEMET")
         now = datetime.datetime.now()
 
-        url_madrid = (
-            "https://opendata.aemet.es/opendata/api/prediccion/especifica/municipio/horaria/28079"
-        )
-
         headers = {
             "api_key": config.sources.aemet.credentials.api_key,
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
 
-        r = requests.get(url_madrid, headers=headers)
-        r_json = requests.get(r.json()["datos"]).json()
+        async with storage_client(config, s3_client) as s3_client:
+            europe_timezone = pytz.timezone("Europe/Madrid")
+            current_datetime = datetime.datetime.now(europe_timezone).replace(second=0)
+            stored_objs = await list_stored_objs(
+                config,
+                [f"raw/aemet/{current_datetime.strftime('%Y/%m/%d')}/"],
+                s3_client=s3_client,
+            )
+
+            # The forecasts are only downloaded when they are going to be stored
+            municipalities = []
+            for municipality in config.sources.aemet.municipalities:
+                object_name = aemet_object_name(
+                    config, current_datetime, municipality=municipality
+                )
+                if object_name is not None and object_name in stored_objs:
+                    logger.debug(f"Already stored AEMET forecast {object_name}")
+                else:
+                    municipalities.append(municipality)
 
-        await save_aemet(config, r_json)
+            rate_limiter = get_token_bucket(config.sources.aemet.rate_limit, key="aemet")
+            async with http_session(session) as session:
+                await asyncio.gather(
+                    *[
+                        get_aemet_municipality(
+                            config,
+                            session,
+                            municipality,
+                            headers,
+                            stored_objs,
+                            s3_client=s3_client,
+                            rate_limiter=rate_limiter,
+                        )
+                        for municipality in municipalities
+                    ]
+                )
 
         end = datetime.datetime.now()
         logger.debug(f"Time duration of AEMET extraction {end - now}")
@@ -49,69 +193,64 @@ async def get_aemet(config: Settings):
         logger.error(traceback.format_exc())
 
 
-async def save_aemet(config: Settings, data: json):
+async def save_aemet(
+    config: Settings,
+    data: json,
+    s3_client: ClientCreatorContext = None,
+    stored_objs: set = None,
+    municipality: str = MADRID_MUNICIPALITY,
+):
     """Save weather json.
 
     Args:
         config (Settings): Object with the config file.
         data (json): Data with weather in json format.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        stored_objs (set): Index of the AEMET objects already stored today. If not provided,
+            it is listed from the storage.
+        municipality (str): INE code of the municipality of the forecast.
     """
-    
     # Get the timezone from Madrid and formated the dates for the object_name of the files
     europe_timezone = pytz.timezone("Europe/Madrid")
     current_datetime = datetime.datetime.now(europe_timezone).replace(second=0)
-    formatted_date_day = current_datetime.strftime(
-        "%Y%m%d"
-    )  # formatted date year|month|day all together
     formatted_date_slash = current_datetime.strftime(
         "%Y/%m/%d"
     )  # formatted date year/month/day for storage in Minio
 
-    if config.storage.default == "minio":
-        # Define object name
-        object_name = (
-            Path("raw") / "aemet" / formatted_date_slash / f"aemet_{formatted_date_day}.json"
+    # Index of the objects already stored today
+    if stored_objs is None:
+        stored_objs = await list_stored_objs(
+            config, [f"raw/aemet/{formatted_date_slash}/"], s3_client=s3_client
         )
 
-        if not await check_s3_file_exists(
-            endpoint_url=config.storage.config.minio.endpoint,
-            aws_secret_access_key=config.storage.config.minio.secret_key,
-            aws_access_key_id=config.storage.config.minio.access_key,
-            bucket_name=config.storage.config.minio.bucket,
-            object_name=str(object_name),
-        ):
-            # Convert data to JSON string
-            response_json_str = json.dumps(data)
-
-            # Create dict and upload into s3
-            aemet_dict_upload = {}
-            aemet_dict_upload[str(object_name)] = response_json_str
-            await upload_objs(
-                config.storage.config.minio.bucket,
-                config.storage.config.minio.endpoint,
-                config.storage.config.minio.access_key,
-                config.storage.config.minio.secret_key,
-                aemet_dict_upload,
-            )
-        else:
-            logger.debug("Already called AEMET today")
+    # Name of the forecast following the refresh policy
+    object_name = aemet_object_name(config, current_datetime, data, municipality)
+    if object_name in stored_objs:
+        logger.debug("Already called AEMET today")
+        return
 
-    if config.storage.default == "local":
-        # Define object name and path for local storage
-        object_name = f"aemet_{formatted_date_day}.json"
-        local_path = (
-            Path(config.storage.config.local.path) / "raw" / "aemet" / formatted_date_slash
+    # Convert data to JSON string
+    response_json_str = json.dumps(data)
+
+    if config.storage.default == "minio":
+        # Create dict and upload into s3
+        aemet_dict_upload = {}
+        aemet_dict_upload[object_name] = response_json_str
+        await upload_objs(
+            config.storage.config.minio.bucket,
+            config.storage.config.minio.endpoint,
+            config.storage.config.minio.access_key,
+            config.storage.config.minio.secret_key,
+            aemet_dict_upload,
+            client=s3_client,
         )
 
-        if not check_local_file_exists(local_path, object_name):
-            # Convert data to JSON string
-            response_json_str = json.dumps(data)
+    if config.storage.default == "local":
+        local_path = Path(config.storage.config.local.path) / object_name
 
-            # Create directories if they don't exist
-            local_path.mkdir(parents=True, exist_ok=True)
+        # Create directories if they don't exist
+        local_path.parent.mkdir(parents=True, exist_ok=True)
 
-            # Write JSON data to file
-            with open(local_path / object_name, "w") as file:
-                file.write(response_json_str)
-        else:
-            logger.debug("Already called AEMET today")
+        # Write JSON data to file
+        with open(local_path, "w") as file:
+            file.write(response_json_str)
@@ -0,0 +1,205 @@
+"""Schedule the extraction of raw data from several sources in one event loop."""
+import asyncio
+import datetime
+import traceback
+
+import aiohttp
+import pytz
+from aiobotocore.session import ClientCreatorContext
+from loguru import logger
+
+from inesdata_mov_datasets.settings import Settings, SourceEmtHttpSettings
+from inesdata_mov_datasets.sources.extract.aemet import get_aemet
+from inesdata_mov_datasets.sources.extract.emt import get_emt
+from inesdata_mov_datasets.sources.extract.informo import get_informo
+from inesdata_mov_datasets.utils import http_session, storage_client
+
+# Minutes between two extractions of each source
+EMT_INTERVAL = 1
+INFORMO_INTERVAL = 5
+AEMET_INTERVAL = 60
+
+
+def emt_http_settings(config: Settings) -> SourceEmtHttpSettings:
+    """Get the http settings of EMT, used for the session shared by all the sources.
+
+    EMT makes almost all the calls of a run, so its pool and timeouts are the ones applied.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        SourceEmtHttpSettings: Http settings of EMT, or None if EMT is not configured.
+    """
+    if config.sources.emt is None:
+        return None
+    return config.sources.emt.http
+
+
+def due_sources(
+    tick: datetime.datetime, sources: list, aemet_interval: int = AEMET_INTERVAL
+) -> list:
+    """Get the sources that have to be extracted in a given minute.
+
+    The intervals are counted from midnight, so an interval of 5 minutes fires at :00, :05, ...
+
+    Args:
+        tick (datetime.datetime): Minute of the extraction.
+        sources (list): Names of the sources to extract (emt, aemet, informo).
+        aemet_interval (int): Minutes between two AEMET extractions.
+
+    Returns:
+        list: Names of the sources to extract in this minute.
+    """
+    intervals = {"emt": EMT_INTERVAL, "informo": INFORMO_INTERVAL, "aemet": aemet_interval}
+    minute_of_day = tick.hour * 60 + tick.minute
+    return [source for source in sources if minute_of_day % intervals[source] == 0]
+
+
+def next_minute(now: datetime.datetime) -> datetime.datetime:
+    """Get the next wall-clock minute boundary.
+
+    Args:
+        now (datetime.datetime): Current datetime.
+
+    Returns:
+        datetime.datetime: Datetime of the next minute with seconds set to 0.
+    """
+    return now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+
+
+async def sleep_until(tick: datetime.datetime):
+    """Sleep until the given datetime, never waking up before it.
+
+    Args:
+        tick (datetime.datetime): Timezone aware datetime to wake up at.
+    """
+    while True:
+        remaining = (tick - datetime.datetime.now(tick.tzinfo)).total_seconds()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(remaining)
+
+
+async def extract_source(
+    config: Settings,
+    source: str,
+    s3_client: ClientCreatorContext = None,
+    session: aiohttp.ClientSession = None,
+):
+    """Extract one source reusing the clients opened by the caller.
+
+    Args:
+        config (Settings): Object with the config file.
+        source (str): Name of the source (emt, aemet, informo).
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        session (aiohttp.ClientSession): Shared http session.
+    """
+    # Tag the logs of this task with its source, other sources may be running concurrently
+    with logger.contextualize(source=source.upper()):
+        try:
+            if source == "emt":
+                await get_emt(config, s3_client=s3_client, session=session)
+            elif source == "aemet":
+                await get_aemet(config, s3_client=s3_client, session=session)
+            elif source == "informo":
+                await get_informo(config, s3_client=s3_client, session=session)
+        except Exception as e:
+            logger.error(e)
+            logger.error(traceback.format_exc())
+
+
+async def extract_sources(
+    config: Settings,
+    sources: list,
+    s3_client: ClientCreatorContext = None,
+    session: aiohttp.ClientSession = None,
+) -> dict:
+    """Extract several sources concurrently, so the run lasts as long as the slowest one.
+
+    A failure in one source is logged and does not stop the others.
+
+    Args:
+        config (Settings): Object with the config file.
+        sources (list): Names of the sources to extract (emt, aemet, informo).
+        s3_client (ClientCreatorContext): Shared client with s3 connection. If not provided,
+            a single client is opened for all the sources.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a single
+            session is opened for all the sources.
+
+    Returns:
+        dict: Time duration of the extraction of each source.
+    """
+
+    async def timed_extraction(
+        source: str, s3_client: ClientCreatorContext, session: aiohttp.ClientSession
+    ) -> datetime.timedelta:
+        start = datetime.datetime.now()
+        await extract_source(config, source, s3_client=s3_client, session=session)
+        return datetime.datetime.now() - start
+
+    now = datetime.datetime.now()
+    async with (
+        storage_client(config, s3_client) as s3_client,
+        http_session(session, emt_http_settings(config)) as session,
+    ):
+        results = await asyncio.gather(
+            *[timed_extraction(source, s3_client, session) for source in sources],
+            return_exceptions=True,
+        )
+    end = datetime.datetime.now()
+
+    durations = {}
+    for source, result in zip(sources, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Extraction of {source} failed: {result}")
+        else:
+            durations[source] = result
+
+    summary = ", ".join(f"{source} {duration}" for source, duration in durations.items())
+    logger.info(f"Time duration of the extraction {end - now} ({summary})")
+    return durations
+
+
+async def run_daemon(config: Settings, sources: list, max_ticks: int = None):
+    """Extract the sources on wall-clock minute boundaries until stopped.
+
+    EMT is extracted every minute, Informo every 5 minutes and AEMET every
+    `sources.aemet.daemon_interval` minutes. The s3 client and the http session are opened
+    once and shared by every extraction. A source whose previous extraction is still running
+    is skipped in that minute instead of piling up.
+
+    Args:
+        config (Settings): Object with the config file.
+        sources (list): Names of the sources to extract (emt, aemet, informo).
+        max_ticks (int): Number of minutes to run before returning. If not provided, it runs
+            forever.
+    """
+    europe_timezone = pytz.timezone("Europe/Madrid")
+    aemet_interval = AEMET_INTERVAL
+    if config.sources.aemet is not None:
+        aemet_interval = config.sources.aemet.daemon_interval
+
+    running = {}
+    ticks = 0
+    async with (
+        storage_client(config) as s3_client,
+        http_session(http_settings=emt_http_settings(config)) as session,
+    ):
+        while max_ticks is None or ticks < max_ticks:
+            tick = next_minute(datetime.datetime.now(europe_timezone))
+            await sleep_until(tick)
+            ticks += 1
+
+            for source in due_sources(tick, sources, aemet_interval):
+                if source in running and not running[source].done():
+                    logger.warning(
+                        f"Skipping {source} at {tick.strftime('%H:%M')}, previous extraction still running"
+                    )
+                    continue
+                running[source] = asyncio.ensure_future(
+                    extract_source(config, source, s3_client=s3_client, session=session)
+                )
+
+        # Let the last extractions finish before closing the shared clients
+        await asyncio.gather(*running.values())
@@ -1,32 +1,80 @@
 """Extract raw data from emt."""
 import asyncio
 import datetime
+import hashlib
 import json
 import os
+import time
 import traceback
 from pathlib import Path
+from typing import Callable
 
 import aiohttp
 import pytz
-import requests
+from aiobotocore.session import ClientCreatorContext
 from loguru import logger
 
+from inesdata_mov_datasets.handlers.concurrency import AimdLimiter
 from inesdata_mov_datasets.handlers.logger import instantiate_logger
-from inesdata_mov_datasets.settings import Settings
+from inesdata_mov_datasets.handlers.rate_limit import TokenBucket, get_token_bucket
+from inesdata_mov_datasets.handlers.retry import request_json, response_code
+from inesdata_mov_datasets.handlers.token_cache import (
+    get_cached_token,
+    login_expiration,
+    read_shared_tokens,
+    refresh_in_background,
+    remember_token,
+    save_shared_token,
+    shared_cache_lock,
+)
+from inesdata_mov_datasets.settings import (
+    Settings,
+    SourceEmtCredentialsSettings,
+    SourceEmtRetrySettings,
+)
+from inesdata_mov_datasets.sources.extract.emt_schedule import (
+    coverage_state_path,
+    learn_stop_lines,
+    load_coverage_state,
+    load_schedule_state,
+    observe_buses,
+    plan_stop_cover,
+    save_coverage_state,
+    save_schedule_state,
+    schedule_state_path,
+    select_in_service_stops,
+    select_tier_stops,
+    update_service_windows,
+)
 from inesdata_mov_datasets.utils import (
     check_local_file_exists,
     check_s3_file_exists,
+    http_session,
+    PACKED_SUFFIXES,
+    list_stored_objs,
+    manifest_shard_name,
+    pack_ndjson,
+    read_json_state,
     read_obj,
+    storage_client,
+    upload_manifest,
+    upload_obj,
     upload_objs,
-    upload_metadata
+    write_json_state,
 )
 
+# Codes of a successful EMT login: "00" when a valid token is reused or extended, "01" when
+# a new token is generated
+LOGIN_SUCCESS_CODES = ("00", "01")
+
 
 async def get_calendar(
     session: aiohttp,
     startDate: str,
     endDate: str,
     headers: json,
+    retry: SourceEmtRetrySettings = None,
+    rate_limiter: TokenBucket = None,
 ) -> json:
     """Call Calendar endpoint EMT.
 
@@ -35,6 +83,8 @@ async def get_calendar(
         startDate (str): Start date of the date you want to check.
         endDate (str): End date of the date you want to check.
         headers (json): Headers of the http petition.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        rate_limiter (TokenBucket): Rate limit of the EMT calls, if any.
 
     Returns:
         json: Response of the petition in json format.
@@ -42,14 +92,19 @@ async def get_calendar(
     calendar_url = (
         f"https://openapi.emtmadrid.es/v1/transport/busemtmad/calendar/{startDate}/{endDate}/"
     )
-    async with session.get(calendar_url, headers=headers) as response:
-        try:
-            response.raise_for_status()
-            return await response.json()
-        except Exception as e:
-            logger.error("Error in calendar call to the server")
-            logger.error(e)
-            return {"code": -1}
+    try:
+        return await request_json(
+            session,
+            "GET",
+            calendar_url,
+            retry=retry,
+            rate_limiter=rate_limiter,
+            headers=headers,
+        )
+    except Exception as e:
+        logger.error("Error in calendar call to the server")
+        logger.error(e)
+        return {"code": -1}
 
 
 async def get_line_detail(
@@ -57,6 +112,8 @@ async def get_line_detail(
     date: str,
     line_id: str,
     headers: json,
+    retry: SourceEmtRetrySettings = None,
+    rate_limiter: TokenBucket = None,
 ) -> json:
     """Call line_detail endpoint EMT.
 
@@ -65,6 +122,8 @@ async def get_line_detail(
         date (str): Date reference of the petition (we use the date of the done petition).
         line_id (str): Id of the line.
         headers (json): Headers of the petition.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        rate_limiter (TokenBucket): Rate limit of the EMT calls, if any.
 
     Returns:
         json: Response of the petition in json format.
@@ -72,26 +131,41 @@ async def get_line_detail(
     line_detail_url = (
         f"https://openapi.emtmadrid.es/v1/transport/busemtmad/lines/{line_id}/info/{date}/"
     )
-    async with session.get(line_detail_url, headers=headers) as response:
-        try:
-            response.raise_for_status()
-            return await response.json()
-        except Exception as e:
-            logger.error(f"Error in line_detail call line {line_id} to the server")
-            logger.error(e)
-            return {"code": -1}
+    try:
+        return await request_json(
+            session,
+            "GET",
+            line_detail_url,
+            retry=retry,
+            rate_limiter=rate_limiter,
+            headers=headers,
+        )
+    except Exception as e:
+        logger.error(f"Error in line_detail call line {line_id} to the server")
+        logger.error(e)
+        return {"code": -1}
 
 
-async def get_eta(session: aiohttp, stop_id: str, headers: json) -> json:
+async def get_eta(
+    session: aiohttp,
+    stop_id: str,
+    headers: json,
+    retry: SourceEmtRetrySettings = None,
+    limiter: AimdLimiter = None,
+    rate_limiter: TokenBucket = None,
+) -> bytes:
     """Make the API call to ETA endpoint.
 
     Args:
         session (aiohttp): Call session to make faster the calls to the same API.
         stop_id (str): Id of the bus stop.
         headers (json): Headers of the http call.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        limiter (AimdLimiter): Adaptive limit of ETA calls in flight, if any.
+        rate_limiter (TokenBucket): Rate limit of the EMT calls, if any.
 
     Returns:
-        json: Response of the petition in json format.
+        bytes: Raw json body of the response, stored as received.
     """
     body = {
         "cultureInfo": "ES",
@@ -100,49 +174,142 @@ async def get_eta(session: aiohttp, stop_id: str, headers: json) -> json:
         "Text_IncidencesRequired_YN": "N",
     }
     eta_url = f"https://openapi.emtmadrid.es/v2/transport/busemtmad/stops/{stop_id}/arrives/"
-    async with session.post(eta_url, headers=headers, json=body) as response:
-        try:
-            response.raise_for_status()
-            return await response.json()
-        except Exception as e:
-            logger.error(f"Error in ETA call stop {stop_id} to the server")
-            logger.error(e)
-            return {"code": -1}
+    try:
+        return await request_json(
+            session,
+            "POST",
+            eta_url,
+            retry=retry,
+            limiter=limiter,
+            rate_limiter=rate_limiter,
+            raw=True,
+            headers=headers,
+            json=body,
+        )
+    except Exception as e:
+        logger.error(f"Error in ETA call stop {stop_id} to the server")
+        logger.error(e)
+        return b'{"code": -1}'
+
+
+def emt_credentials(config: Settings) -> list:
+    """Get the EMT credentials of the config as a list.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        list: Credentials, in the order of the config file.
+    """
+    credentials = config.sources.emt.credentials
+    if isinstance(credentials, list):
+        return credentials
+    return [credentials]
+
+
+def credential_key(credentials: SourceEmtCredentialsSettings) -> str:
+    """Get the identifier of a credential.
+
+    Args:
+        credentials (SourceEmtCredentialsSettings): EMT credential.
+
+    Returns:
+        str: Client id, or email for basic auth.
+    """
+    return credentials.x_client_id or credentials.email
+
+
+def credential_rate_limiter(
+    config: Settings, credentials: SourceEmtCredentialsSettings
+) -> TokenBucket | None:
+    """Get the rate limit of the calls made with a credential.
+
+    Args:
+        config (Settings): Object with the config file.
+        credentials (SourceEmtCredentialsSettings): Credential of the calls.
+
+    Returns:
+        TokenBucket | None: Bucket of the credential, with its own `rate_limit` or else
+            `sources.emt.rate_limit`. None if there is no rate limit.
+    """
+    settings = credentials.rate_limit
+    if settings is None:
+        settings = config.sources.emt.rate_limit
+    return get_token_bucket(settings, key=credential_key(credentials))
 
 
-async def login_emt(config: Settings, object_login_name: str, local_path: Path = None) -> str:
+def login_object_name(date_day: str, credential_index: int = 0) -> str:
+    """Get the file name of the login response of a credential.
+
+    Args:
+        date_day (str): Date in format yearmonthday.
+        credential_index (int): Position of the credential in the config file.
+
+    Returns:
+        str: File name. The first credential keeps the name used with a single credential.
+    """
+    if credential_index == 0:
+        return f"login_{date_day}.json"
+    return f"login_{date_day}_{credential_index}.json"
+
+
+async def login_emt(
+    config: Settings,
+    object_login_name: str,
+    local_path: Path = None,
+    s3_client: ClientCreatorContext = None,
+    session: aiohttp.ClientSession = None,
+    credentials: SourceEmtCredentialsSettings = None,
+) -> str:
     """Make the call to Login endpoint EMT.
 
     Args:
         config (Settings): Object with the config file.
         object_login_name (str): Name of the object which is onna be saved.
         local_path (Path): Local path to save login response.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the call.
+        credentials (SourceEmtCredentialsSettings): Credential to log in with. If not
+            provided, the first one of the config file is used.
 
     Returns:
         str: token from the login
     """
-    if config.sources.emt.credentials.x_client_id is not None:
+    if credentials is None:
+        credentials = emt_credentials(config)[0]
+    if credentials.x_client_id is not None:
         headers = {
-            "X-ClientId": config.sources.emt.credentials.x_client_id,
-            "passKey": config.sources.emt.credentials.passkey,
+            "X-ClientId": credentials.x_client_id,
+            "passKey": credentials.passkey,
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
     else:
         headers = {
-            "email": config.sources.emt.credentials.email,
-            "password": config.sources.emt.credentials.password,
+            "email": credentials.email,
+            "password": credentials.password,
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-    r = requests.get(
-        "https://openapi.emtmadrid.es/v2/mobilitylabs/user/login/", headers=headers, verify=True
-    )
     try:
-        login_json = r.json()
+        async with http_session(session) as session:
+            login_json = await request_json(
+                session,
+                "GET",
+                "https://openapi.emtmadrid.es/v2/mobilitylabs/user/login/",
+                retry=config.sources.emt.retry,
+                content_type=None,
+                rate_limiter=credential_rate_limiter(config, credentials),
+                success_codes=LOGIN_SUCCESS_CODES,
+                headers=headers,
+            )
         login_json_str = json.dumps(login_json)
 
         token = login_json["data"][0]["accessToken"]
+        expiration = login_expiration(login_json)
+        if expiration is not None:
+            remember_token(credential_key(credentials), token, expiration)
 
         if config.storage.default == "minio":
             # Dict to upload s3 asynchronously
@@ -154,6 +321,7 @@ async def login_emt(config: Settings, object_login_name: str, local_path: Path =
                 config.storage.config.minio.access_key,
                 config.storage.config.minio.secret_key,
                 login_dict_upload,
+                client=s3_client,
             )
 
         if config.storage.default == "local" and local_path:
@@ -168,29 +336,55 @@ async def login_emt(config: Settings, object_login_name: str, local_path: Path =
         return ""
 
 
-async def token_control(config: Settings, date_slash: str, date_day: str) -> str:
-    """Get existing token from EMT API or regenerate it if its deprecated.
+async def load_token(
+    config: Settings,
+    date_slash: str,
+    date_day: str,
+    s3_client: ClientCreatorContext = None,
+    stored_objs: set = None,
+    session: aiohttp.ClientSession = None,
+    credential_index: int = 0,
+) -> str:
+    """Get the token from the stored login of the day or regenerate it if its deprecated.
 
     Args:
         config (Settings): Object with the config file.
         date_slash (str): date format for object name
         date_day (str): date format for object name
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        stored_objs (set): Index of the objects already stored today. If not provided,
+            the storage is checked directly.
+        session (aiohttp.ClientSession): Shared http session for the login call, if any.
+        credential_index (int): Position in the config file of the credential of the token.
 
     Returns:
        str: Token from EMT Login.
     """
+    credentials = emt_credentials(config)[credential_index]
+    login_name = login_object_name(date_day, credential_index)
     if config.storage.default == "minio":
-        object_login_name = Path("raw") / "emt" / date_slash / "login" / f"login_{date_day}.json"
+        object_login_name = Path("raw") / "emt" / date_slash / "login" / login_name
 
         # Check if file already exists so we have made the call already
-        if not await check_s3_file_exists(
-            endpoint_url=config.storage.config.minio.endpoint,
-            aws_secret_access_key=config.storage.config.minio.secret_key,
-            aws_access_key_id=config.storage.config.minio.access_key,
-            bucket_name=config.storage.config.minio.bucket,
-            object_name=str(object_login_name),
-        ):
-            token = await login_emt(config, object_login_name)
+        if stored_objs is not None:
+            login_exists = object_login_name.as_posix() in stored_objs
+        else:
+            login_exists = await check_s3_file_exists(
+                endpoint_url=config.storage.config.minio.endpoint,
+                aws_secret_access_key=config.storage.config.minio.secret_key,
+                aws_access_key_id=config.storage.config.minio.access_key,
+                bucket_name=config.storage.config.minio.bucket,
+                object_name=str(object_login_name),
+                client=s3_client,
+            )
+        if not login_exists:
+            token = await login_emt(
+                config,
+                object_login_name,
+                s3_client=s3_client,
+                session=session,
+                credentials=credentials,
+            )
             return token
 
         # If it exists, get the token from the json
@@ -201,6 +395,7 @@ async def token_control(config: Settings, date_slash: str, date_day: str) -> str
                 config.storage.config.minio.access_key,
                 config.storage.config.minio.secret_key,
                 str(object_login_name),
+                client=s3_client,
             )
 
             data = json.loads(response)
@@ -211,7 +406,13 @@ async def token_control(config: Settings, date_slash: str, date_day: str) -> str
                 expiration_date_unix = data["data"][0]["tokenDteExpiration"]["$date"]
             except:
                 logger.error(f"Error saving time expiration from login. Solving the problem retrying the call.")
-                token = await login_emt(config, object_login_name)
+                token = await login_emt(
+                    config,
+                    object_login_name,
+                    s3_client=s3_client,
+                    session=session,
+                    credentials=credentials,
+                )
                 return token
             
             expiration_date = datetime.datetime.utcfromtimestamp(
@@ -221,19 +422,38 @@ async def token_control(config: Settings, date_slash: str, date_day: str) -> str
 
             # Compare the time expiration of the token withthe actual date
             if now >= expiration_date:  # reset token
-                token = await login_emt(config, object_login_name)
+                token = await login_emt(
+                    config,
+                    object_login_name,
+                    s3_client=s3_client,
+                    session=session,
+                    credentials=credentials,
+                )
                 return token
             # Get the token that already exists
             elif now < expiration_date:
+                remember_token(credential_key(credentials), token, expiration_date_unix / 1000)
                 return token
 
     elif config.storage.default == "local":
         dir_path = Path(config.storage.config.local.path) / "raw" / "emt" / date_slash / "login"
-        object_login_name = f"login_{date_day}.json"
+        object_login_name = login_name
 
         # Check if file already exists so we have made the call already
-        if not check_local_file_exists(dir_path, object_login_name):
-            token = await login_emt(config, object_login_name, local_path=dir_path)
+        if stored_objs is not None:
+            login_exists = (
+                Path("raw") / "emt" / date_slash / "login" / object_login_name
+            ).as_posix() in stored_objs
+        else:
+            login_exists = check_local_file_exists(dir_path, object_login_name)
+        if not login_exists:
+            token = await login_emt(
+                config,
+                object_login_name,
+                local_path=dir_path,
+                session=session,
+                credentials=credentials,
+            )
             return token
 
         # If it exists, get the token from the json
@@ -248,7 +468,13 @@ async def token_control(config: Settings, date_slash: str, date_day: str) -> str
                     expiration_date_unix = data["data"][0]["tokenDteExpiration"]["$date"]
                 except:
                     logger.error(f"Error saving time expiration from login. Solving the problem retrying the call.")
-                    token = await login_emt(config, object_login_name, local_path=dir_path)
+                    token = await login_emt(
+                        config,
+                        object_login_name,
+                        local_path=dir_path,
+                        session=session,
+                        credentials=credentials,
+                    )
                     return token
                 
                 expiration_date = datetime.datetime.utcfromtimestamp(
@@ -257,18 +483,670 @@ async def token_control(config: Settings, date_slash: str, date_day: str) -> str
                 now = datetime.datetime.now()
                 # Compare the time expiration of the token withthe actual date
                 if now >= expiration_date:  # reset token
-                    token = await login_emt(config, object_login_name, local_path=dir_path)
+                    token = await login_emt(
+                        config,
+                        object_login_name,
+                        local_path=dir_path,
+                        session=session,
+                        credentials=credentials,
+                    )
                     return token
                 # Get the token that already exists
                 elif now < expiration_date:
+                    remember_token(credential_key(credentials), token, expiration_date_unix / 1000)
                     return token
 
 
-async def get_emt(config: Settings):
+def token_cache_path(config: Settings) -> Path:
+    """Get the local file where the EMT tokens are shared by concurrent processes.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        Path: Path of the cache file.
+    """
+    if config.sources.emt.token.cache_path is not None:
+        return Path(config.sources.emt.token.cache_path)
+    return Path(config.storage.logs.path) / "emt_tokens.json"
+
+
+async def refresh_token(
+    config: Settings, date_slash: str, date_day: str, credential_index: int = 0
+):
+    """Log in again with a credential whose token is about to expire.
+
+    Args:
+        config (Settings): Object with the config file.
+        date_slash (str): date format for object name
+        date_day (str): date format for object name
+        credential_index (int): Position in the config file of the credential of the token.
+    """
+    credentials = emt_credentials(config)[credential_index]
+    key = credential_key(credentials)
+    refresh_margin = config.sources.emt.token.refresh_margin
+    cache_path = token_cache_path(config)
+    async with shared_cache_lock(cache_path):
+        # Another process may have refreshed it while waiting for the lock
+        entry = read_shared_tokens(cache_path).get(key)
+        if entry is not None and time.time() < entry["expiration"] - refresh_margin:
+            remember_token(key, entry["token"], entry["expiration"])
+            return
+
+        login_name = login_object_name(date_day, credential_index)
+        if config.storage.default == "minio":
+            object_login_name = Path("raw") / "emt" / date_slash / "login" / login_name
+            token = await login_emt(config, object_login_name, credentials=credentials)
+        else:
+            dir_path = (
+                Path(config.storage.config.local.path) / "raw" / "emt" / date_slash / "login"
+            )
+            token = await login_emt(
+                config, login_name, local_path=dir_path, credentials=credentials
+            )
+        if token and get_cached_token(key) is not None:
+            save_shared_token(cache_path, key, get_cached_token(key))
+
+
+async def token_control(
+    config: Settings,
+    date_slash: str,
+    date_day: str,
+    s3_client: ClientCreatorContext = None,
+    stored_objs: set = None,
+    session: aiohttp.ClientSession = None,
+    credential_index: int = 0,
+) -> str:
+    """Get the token of a credential, from memory while it is valid.
+
+    When the token is `token.refresh_margin` seconds from expiring, it is still returned while
+    a new one is obtained in background. Without a valid token in memory, the cache file shared
+    by concurrent processes is checked under a lock and, if it has none either, the stored login
+    is read or a new login is made holding the lock, so the other processes wait for it instead
+    of logging in too.
+
+    Args:
+        config (Settings): Object with the config file.
+        date_slash (str): date format for object name
+        date_day (str): date format for object name
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        stored_objs (set): Index of the objects already stored today. If not provided,
+            the storage is checked directly.
+        session (aiohttp.ClientSession): Shared http session for the login call, if any.
+        credential_index (int): Position in the config file of the credential of the token.
+
+    Returns:
+       str: Token from EMT Login.
+    """
+    key = credential_key(emt_credentials(config)[credential_index])
+    refresh_margin = config.sources.emt.token.refresh_margin
+
+    cached = get_cached_token(key)
+    if cached is not None and time.time() < cached["expiration"]:
+        if time.time() >= cached["expiration"] - refresh_margin:
+            refresh_in_background(
+                key, lambda: refresh_token(config, date_slash, date_day, credential_index)
+            )
+        return cached["token"]
+
+    cache_path = token_cache_path(config)
+    async with shared_cache_lock(cache_path):
+        entry = read_shared_tokens(cache_path).get(key)
+        if entry is not None and time.time() < entry["expiration"]:
+            remember_token(key, entry["token"], entry["expiration"])
+            return entry["token"]
+
+        token = await load_token(
+            config,
+            date_slash,
+            date_day,
+            s3_client=s3_client,
+            stored_objs=stored_objs,
+            session=session,
+            credential_index=credential_index,
+        )
+        if token and get_cached_token(key) is not None:
+            save_shared_token(cache_path, key, get_cached_token(key))
+        return token
+
+
+def pick_credential(pool: list, position: int, strategy: str) -> dict:
+    """Choose the credential of an ETA call.
+
+    Args:
+        pool (list): One dict per credential with its `headers`, its `rate_limiter` and
+            its ETA calls `in_flight`.
+        position (int): Position of the stop in the run.
+        strategy (str): "round_robin" to take the credentials in turns, or "least_loaded"
+            to take the one whose rate limit frees a token first, with the fewest calls in
+            flight on a tie.
+
+    Returns:
+        dict: Chosen entry of the pool.
+    """
+    if strategy == "least_loaded":
+
+        def load(entry: dict) -> tuple:
+            bucket = entry["rate_limiter"]
+            return (bucket.expected_wait() if bucket is not None else 0, entry["in_flight"])
+
+        return min(pool, key=load)
+    return pool[position % len(pool)]
+
+
+async def get_eta_pooled(
+    session: aiohttp,
+    stop_id: str,
+    position: int,
+    pool: list,
+    strategy: str,
+    retry: SourceEmtRetrySettings = None,
+    limiter: AimdLimiter = None,
+    observe: Callable[[str, bytes], None] = None,
+) -> bytes:
+    """Call ETA endpoint EMT with one of the credentials of the pool.
+
+    Args:
+        session (aiohttp): Call session to make faster the calls to the same API.
+        stop_id (str): Id of the bus stop.
+        position (int): Position of the stop in the run.
+        pool (list): Credentials of the run, see `pick_credential`.
+        strategy (str): Strategy to choose the credential, see `pick_credential`.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        limiter (AimdLimiter): Adaptive limit of the ETA calls in flight, if any.
+        observe (Callable[[str, bytes], None]): Function called with the stop and its response,
+            to learn from it which stops to poll next.
+
+    Returns:
+        bytes: Raw json body of the response.
+    """
+    entry = pick_credential(pool, position, strategy)
+    entry["in_flight"] += 1
+    try:
+        response = await get_eta(
+            session,
+            stop_id,
+            entry["headers"],
+            retry=retry,
+            limiter=limiter,
+            rate_limiter=entry["rate_limiter"],
+        )
+    finally:
+        entry["in_flight"] -= 1
+    if observe is not None:
+        observe(stop_id, response)
+    return response
+
+
+async def get_eta_queued(
+    queue: asyncio.Queue,
+    session: aiohttp,
+    stop_id: str,
+    position: int,
+    pool: list,
+    strategy: str,
+    retry: SourceEmtRetrySettings = None,
+    limiter: AimdLimiter = None,
+    observe: Callable[[str, bytes], None] = None,
+) -> bool:
+    """Call ETA endpoint EMT and queue the response to be stored as soon as it arrives.
+
+    Args:
+        queue (asyncio.Queue): Queue of (stop_id, response) read by `store_eta_worker`, with
+            room for every stop of the run.
+        session (aiohttp): Call session to make faster the calls to the same API.
+        stop_id (str): Id of the bus stop.
+        position (int): Position of the stop in the run.
+        pool (list): Credentials of the run, see `pick_credential`.
+        strategy (str): Strategy to choose the credential, see `pick_credential`.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        limiter (AimdLimiter): Adaptive limit of the ETA calls in flight, if any.
+        observe (Callable[[str, bytes], None]): Function called with the stop and its response,
+            to learn from it which stops to poll next.
+
+    Returns:
+        bool: True once the response is queued.
+    """
+    response = await get_eta_pooled(
+        session,
+        stop_id,
+        position,
+        pool,
+        strategy,
+        retry=retry,
+        limiter=limiter,
+        observe=observe,
+    )
+    # Never blocks, the queue has room for every stop of the run
+    queue.put_nowait((stop_id, response))
+    return True
+
+
+async def store_eta(
+    config: Settings,
+    stop_id: str,
+    response: bytes,
+    formatted_date: str,
+    formatted_date_slash: str,
+    s3_client: ClientCreatorContext = None,
+    snapshots: dict = None,
+) -> str | None:
+    """Store the raw ETA response of a stop in its own file.
+
+    Args:
+        config (Settings): Object with the config file.
+        stop_id (str): Id of the bus stop.
+        response (bytes): Raw json body of the response.
+        formatted_date (str): Datetime of the run in format %Y-%m-%dT%H%M.
+        formatted_date_slash (str): Date of the run in format year/month/day.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        snapshots (dict): Last stored snapshot by stop, see `dedup_eta`. If provided, an
+            unchanged response is stored as a reference, and the snapshot of the stop is only
+            updated once the response is stored.
+
+    Returns:
+        str | None: Object name of the stored response, None if it has an error code.
+    """
+    code = response_code(response)
+    if code != "00":
+        logger.error(f"Error code {code} in stop {stop_id} in EMT ETA")
+        return None
+
+    file_eta_name = f"eta_{stop_id}_{formatted_date}.json"
+    snapshot = None
+    if snapshots is not None:
+        response, snapshot = dedup_eta(
+            snapshots, stop_id, response, file_eta_name, formatted_date_slash, formatted_date
+        )
+    object_eta_name = (
+        Path("raw") / "emt" / formatted_date_slash / "eta" / file_eta_name
+    ).as_posix()
+    if config.storage.default == "minio":
+        await upload_obj(s3_client, config.storage.config.minio.bucket, object_eta_name, response)
+    if config.storage.default == "local":
+        path_eta = Path(config.storage.config.local.path) / object_eta_name
+        os.makedirs(path_eta.parent, exist_ok=True)
+        with open(path_eta, "wb") as file:
+            file.write(response)
+    commit_eta_snapshot(snapshots, stop_id, snapshot)
+    return object_eta_name
+
+
+async def store_eta_result(
+    config: Settings,
+    stop_id: str,
+    response: bytes,
+    results: dict,
+    formatted_date: str,
+    formatted_date_slash: str,
+    s3_client: ClientCreatorContext = None,
+    snapshots: dict = None,
+):
+    """Store the ETA response of a stop with `store_eta` and note how it went.
+
+    Args:
+        config (Settings): Object with the config file.
+        stop_id (str): Id of the bus stop.
+        response (bytes): Raw json body of the response.
+        results (dict): Lists of the `stored` object names and the stops with `errors`,
+            shared by all the stores of the run.
+        formatted_date (str): Datetime of the run in format %Y-%m-%dT%H%M.
+        formatted_date_slash (str): Date of the run in format year/month/day.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        snapshots (dict): Last stored snapshot by stop, to store unchanged responses as
+            references. None stores every response.
+    """
+    try:
+        object_eta_name = await store_eta(
+            config,
+            stop_id,
+            response,
+            formatted_date,
+            formatted_date_slash,
+            s3_client,
+            snapshots=snapshots,
+        )
+        if object_eta_name is None:
+            results["errors"].append(stop_id)
+        else:
+            results["stored"].append(object_eta_name)
+    except Exception as e:
+        results["errors"].append(stop_id)
+        logger.error(e)
+        logger.error(traceback.format_exc())
+
+
+async def store_eta_worker(
+    config: Settings,
+    queue: asyncio.Queue,
+    results: dict,
+    formatted_date: str,
+    formatted_date_slash: str,
+    s3_client: ClientCreatorContext = None,
+    snapshots: dict = None,
+):
+    """Store the ETA responses of the queue until cancelled.
+
+    Args:
+        config (Settings): Object with the config file.
+        queue (asyncio.Queue): Queue of (stop_id, response) filled by `get_eta_queued`.
+        results (dict): Lists of the `stored` object names and the stops with `errors`,
+            shared by all the workers of the run.
+        formatted_date (str): Datetime of the run in format %Y-%m-%dT%H%M.
+        formatted_date_slash (str): Date of the run in format year/month/day.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        snapshots (dict): Last stored snapshot by stop, to store unchanged responses as
+            references. None stores every response.
+    """
+    while True:
+        stop_id, response = await queue.get()
+        try:
+            await store_eta_result(
+                config,
+                stop_id,
+                response,
+                results,
+                formatted_date,
+                formatted_date_slash,
+                s3_client,
+                snapshots=snapshots,
+            )
+        finally:
+            queue.task_done()
+
+
+def eta_dedup_state_path(config: Settings) -> Path:
+    """Get the local file where the last stored ETA snapshot of each stop is kept between runs.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        Path: Path of the state file.
+    """
+    if config.sources.emt.eta_dedup_state_path is not None:
+        return Path(config.sources.emt.eta_dedup_state_path)
+    return Path(config.storage.logs.path) / "emt_eta_snapshots.json"
+
+
+def load_eta_snapshots(state_path: Path) -> dict:
+    """Get the last stored ETA snapshot of each stop, from memory or from the state file.
+
+    Args:
+        state_path (Path): Local file with the snapshots.
+
+    Returns:
+        dict: Hash, file name and date of the last stored snapshot, by stop. The dict is the
+            one kept in memory, so changes are seen by the next run of the process.
+    """
+    return read_json_state(state_path, memoize=True)
+
+
+def save_eta_snapshots(state_path: Path, snapshots: dict):
+    """Save the last stored ETA snapshot of each stop for the next processes.
+
+    Args:
+        state_path (Path): Local file with the snapshots.
+        snapshots (dict): Snapshots by stop.
+    """
+    write_json_state(state_path, snapshots)
+
+
+def eta_file_name(config: Settings, stop_id: str, formatted_date: str) -> str:
+    """Get the name of the file where the ETA response of a stop is stored in a run.
+
+    Args:
+        config (Settings): Object with the config file.
+        stop_id (str): Id of the bus stop.
+        formatted_date (str): Datetime of the run in format %Y-%m-%dT%H%M.
+
+    Returns:
+        str: File of the stop in the files layout, or the file of the run in the packed one.
+    """
+    if config.sources.emt.eta_layout == "packed":
+        return f"eta_{formatted_date}{PACKED_SUFFIXES[config.sources.emt.eta_compression]}"
+    return f"eta_{stop_id}_{formatted_date}.json"
+
+
+def eta_content_hash(response: bytes) -> str:
+    """Hash the content of an ETA response that matters, its data.
+
+    The code, the description (with the time lapsed) and the datetime that come before the
+    data change on every call, even when the arrivals do not.
+
+    Args:
+        response (bytes): Raw json body of the response.
+
+    Returns:
+        str: Hex digest of the data.
+    """
+    start = max(response.find(b'"data"'), 0)
+    return hashlib.blake2b(response[start:], digest_size=16).hexdigest()
+
+
+def dedup_eta(
+    snapshots: dict,
+    stop_id: str,
+    response: bytes,
+    file_name: str,
+    date_slash: str,
+    formatted_date: str,
+) -> tuple[bytes, dict | None]:
+    """Replace an ETA response by a reference to the last stored one if its data did not change.
+
+    References only point to snapshots of the same day, so each day can be created on its own.
+    The snapshots are not updated here: the caller commits the new snapshot with
+    `commit_eta_snapshot` once the response is stored, so a failed store is never referenced.
+
+    Args:
+        snapshots (dict): Last stored snapshot by stop.
+        stop_id (str): Id of the bus stop.
+        response (bytes): Raw json body of the response.
+        file_name (str): Name of the file where the response is stored, packed file included.
+        date_slash (str): Date of the run in format year/month/day.
+        formatted_date (str): Datetime of the run in format %Y-%m-%dT%H%M.
+
+    Returns:
+        tuple[bytes, dict | None]: The response and its new snapshot, or a reference with the
+            datetime of the run and the file of the stored snapshot and None.
+    """
+    content_hash = eta_content_hash(response)
+    last = snapshots.get(str(stop_id))
+    if (
+        last is not None
+        and last["hash"] == content_hash
+        and last["date"] == date_slash
+        # A repeated run of the same minute rewrites the snapshot, it cannot point to itself
+        and last["ref"] != file_name
+    ):
+        snapshot_datetime = datetime.datetime.strptime(formatted_date, "%Y-%m-%dT%H%M")
+        reference = {
+            "code": "00",
+            "datetime": snapshot_datetime.isoformat(),
+            "stop_id": stop_id,
+            "ref": last["ref"],
+        }
+        return json.dumps(reference).encode("utf-8"), None
+    return response, {"hash": content_hash, "ref": file_name, "date": date_slash}
+
+
+def commit_eta_snapshot(snapshots: dict, stop_id: str, snapshot: dict | None):
+    """Keep the snapshot of a stop as the last stored one, once its response is stored.
+
+    Args:
+        snapshots (dict): Last stored snapshot by stop.
+        stop_id (str): Id of the bus stop.
+        snapshot (dict | None): Snapshot returned by `dedup_eta`, None if it was a reference.
+    """
+    if snapshots is not None and snapshot is not None:
+        snapshots[str(stop_id)] = snapshot
+
+
+def eta_record(stop_id: str, eta_datetime: str, response: bytes) -> bytes:
+    """Build the NDJSON line of an ETA response for the packed layout, without decoding it.
+
+    Args:
+        stop_id (str): Id of the bus stop.
+        eta_datetime (str): Datetime of the run in ISO format.
+        response (bytes): Raw json body of the response.
+
+    Returns:
+        bytes: Json line with the stop, the datetime and the response.
+    """
+    fields = json.dumps({"stop_id": stop_id, "datetime": eta_datetime})
+    # Line breaks in a json body can only be whitespace, drop them to keep one record per line
+    response = response.replace(b"\r", b"").replace(b"\n", b"")
+    return fields[:-1].encode("utf-8") + b', "response": ' + response + b"}"
+
+
+def concurrency_state_path(config: Settings) -> Path:
+    """Get the local file where the ETA concurrency limit is kept between runs.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        Path: Path of the state file.
+    """
+    if config.sources.emt.concurrency.state_path is not None:
+        return Path(config.sources.emt.concurrency.state_path)
+    return Path(config.storage.logs.path) / "emt_concurrency.json"
+
+
+def prioritize_stops(stops: list, missed_stops: list) -> list:
+    """Order the stops so the ones that missed the previous snapshot are requested first.
+
+    Args:
+        stops (list): Ids of the bus stops.
+        missed_stops (list): Ids of the stops without data in the previous run.
+
+    Returns:
+        list: Same stops, the missed ones first and the rest in their original order.
+    """
+    missed = set(missed_stops)
+    return [stop_id for stop_id in stops if stop_id in missed] + [
+        stop_id for stop_id in stops if stop_id not in missed
+    ]
+
+
+async def wait_until_deadline(tasks: list, deadline: datetime.datetime) -> list:
+    """Wait for the tasks until the deadline and cancel the ones still pending.
+
+    Args:
+        tasks (list): Tasks with the requests.
+        deadline (datetime.datetime): Timezone aware datetime at which pending tasks are cancelled.
+
+    Returns:
+        list: Result of each task in the same order, None for the cancelled ones.
+    """
+    if not tasks:
+        return []
+    timeout = max((deadline - datetime.datetime.now(deadline.tzinfo)).total_seconds(), 0)
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    return [task.result() if task in done else None for task in tasks]
+
+
+def eta_report_name(date_slash: str, hour_minute: str) -> str:
+    """Get the object name of the ETA report of a run.
+
+    Args:
+        date_slash (str): Date of the run in format year/month/day.
+        hour_minute (str): Hour and minute of the run in format HHMM.
+
+    Returns:
+        str: Object name of the report, relative to the storage root.
+    """
+    date_day = date_slash.replace("/", "")
+    return f"raw/emt/{date_slash}/eta_report/eta_report_{date_day}T{hour_minute}.json"
+
+
+async def read_eta_report(
+    config: Settings, report_name: str, s3_client: ClientCreatorContext = None
+) -> dict:
+    """Read the ETA report of a previous run.
+
+    Args:
+        config (Settings): Object with the config file.
+        report_name (str): Object name of the report.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+
+    Returns:
+        dict: Report of the run, empty if there is none.
+    """
+    try:
+        if config.storage.default == "minio":
+            response = await read_obj(
+                config.storage.config.minio.bucket,
+                config.storage.config.minio.endpoint,
+                config.storage.config.minio.access_key,
+                config.storage.config.minio.secret_key,
+                report_name,
+                client=s3_client,
+            )
+            return json.loads(response)
+
+        report_path = Path(config.storage.config.local.path) / report_name
+        if report_path.exists():
+            with open(report_path, "r") as file:
+                return json.loads(file.read())
+    except Exception as e:
+        logger.debug(f"No ETA report from the previous run: {e}")
+    return {}
+
+
+async def save_eta_report(
+    config: Settings, report_name: str, report: dict, s3_client: ClientCreatorContext = None
+):
+    """Save the ETA report of the run.
+
+    Args:
+        config (Settings): Object with the config file.
+        report_name (str): Object name of the report.
+        report (dict): Report of the run.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+    """
+    report_json_str = json.dumps(report)
+    if config.storage.default == "minio":
+        await upload_objs(
+            config.storage.config.minio.bucket,
+            config.storage.config.minio.endpoint,
+            config.storage.config.minio.access_key,
+            config.storage.config.minio.secret_key,
+            {report_name: report_json_str},
+            client=s3_client,
+        )
+
+    if config.storage.default == "local":
+        report_path = Path(config.storage.config.local.path) / report_name
+        os.makedirs(report_path.parent, exist_ok=True)
+        with open(report_path, "w") as file:
+            file.write(report_json_str)
+
+
+async def get_emt(
+    config: Settings,
+    s3_client: ClientCreatorContext = None,
+    session: aiohttp.ClientSession = None,
+    run_deadline: float = None,
+):
     """Get all the data from EMT endpoints.
 
+    Requests still pending `run_deadline` seconds after the minute of the run started are
+    cancelled, and what completed is stored. Stops without data in the previous run are
+    requested first. Each run writes a report with its failed and cancelled stops.
+
     Args:
         config (Settings): Object with the config file..
+        s3_client (ClientCreatorContext): Shared client with s3 connection. If not provided,
+            a single client is opened for the whole run.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the run.
+        run_deadline (float): Seconds after the start of the minute at which pending requests
+            are cancelled. If not provided, `sources.emt.run_deadline` is used.
     """
     try:
         # Logger
@@ -288,20 +1166,79 @@ async def get_emt(config: Settings):
             "%Y/%m/%d"
         )  # formatted date year/month/day for storage in Minio
 
+        # Pending requests are cancelled at the deadline so the run ends inside its minute
+        if run_deadline is None:
+            run_deadline = config.sources.emt.run_deadline
+        deadline = current_datetime.replace(microsecond=0) + datetime.timedelta(
+            seconds=run_deadline
+        )
+        previous_datetime = current_datetime - datetime.timedelta(minutes=1)
+
         now = datetime.datetime.now()
 
-        access_token = await token_control(
-            config, formatted_date_slash, formatted_date_day
-        )  # Obtain token from EMT
+        async with (
+            storage_client(config, s3_client) as s3_client,
+            http_session(session, config.sources.emt.http) as session,
+        ):
+            # Index of the objects already stored today, so every "already called?" check
+            # below is a set lookup. ETA objects are left out, they are never looked up.
+            stored_objs = await list_stored_objs(
+                config,
+                [
+                    f"raw/emt/{formatted_date_slash}/{endpoint}/"
+                    for endpoint in ["login", "calendar", "line_detail"]
+                ],
+                s3_client=s3_client,
+            )
 
-        # Headers for requests to the EMT API
-        headers = {
-            "accessToken": access_token,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
+            # One token per credential, the first one that logged in also makes the
+            # line_detail and calendar calls
+            credentials = emt_credentials(config)
+            access_tokens = await asyncio.gather(
+                *[
+                    token_control(
+                        config,
+                        formatted_date_slash,
+                        formatted_date_day,
+                        s3_client=s3_client,
+                        stored_objs=stored_objs,
+                        session=session,
+                        credential_index=index,
+                    )
+                    for index in range(len(credentials))
+                ]
+            )  # Obtain tokens from EMT
+            pool = [
+                {
+                    # Headers for requests to the EMT API
+                    "headers": {
+                        "accessToken": access_token,
+                        "Content-Type": "application/json",
+                        "Accept": "application/json",
+                    },
+                    # Rate limit of the credential, shared by every run of the process
+                    "rate_limiter": credential_rate_limiter(config, credential),
+                    "in_flight": 0,
+                }
+                for credential, access_token in zip(credentials, access_tokens)
+            ]
+            # Credentials that failed to log in are left out, unless all of them failed
+            pool = [entry for entry in pool if entry["headers"]["accessToken"]] or pool
+            logger.debug(f"Using {len(pool)} of {len(credentials)} EMT credentials")
+            headers = pool[0]["headers"]
+            rate_limiter = pool[0]["rate_limiter"]
+
+            # Failed calls are retried inside each task, concurrently with the rest of the calls
+            retry = config.sources.emt.retry
+            # Rate limits of the run, to log how long the calls waited for them
+            rate_limiters = []
+            for entry in pool:
+                bucket = entry["rate_limiter"]
+                if bucket is not None and bucket not in rate_limiters:
+                    rate_limiters.append(bucket)
+            waits_before = sum(bucket.waits for bucket in rate_limiters)
+            wait_time_before = sum(bucket.wait_time for bucket in rate_limiters)
 
-        async with aiohttp.ClientSession() as session:
             # List to store tasks asynchronously
             calendar_tasks = []
             eta_tasks = []
@@ -311,81 +1248,66 @@ async def get_emt(config: Settings):
             lines_called = 0
             lines_not_called = []
             for line_id in config.sources.emt.lines:
-                if config.storage.default == "minio":
-                    object_line_detail_name = (
-                        Path("raw")
-                        / "emt"
-                        / formatted_date_slash
-                        / "line_detail"
-                        / f"line_detail_{line_id}_{formatted_date_day}.json"
-                    )
-                    # If the files are not saved, append the task of the line_detail request
-                    if not await check_s3_file_exists(
-                        endpoint_url=config.storage.config.minio.endpoint,
-                        aws_secret_access_key=config.storage.config.minio.secret_key,
-                        aws_access_key_id=config.storage.config.minio.access_key,
-                        bucket_name=config.storage.config.minio.bucket,
-                        object_name=str(object_line_detail_name),
-                    ):
-                        line_detail_task = asyncio.ensure_future(
-                            get_line_detail(session, formatted_date_day, line_id, headers)
+                object_line_detail_name = (
+                    Path("raw")
+                    / "emt"
+                    / formatted_date_slash
+                    / "line_detail"
+                    / f"line_detail_{line_id}_{formatted_date_day}.json"
+                )
+                # If the files are not saved, append the task of the line_detail request
+                if object_line_detail_name.as_posix() not in stored_objs:
+                    line_detail_task = asyncio.ensure_future(
+                        get_line_detail(
+                            session,
+                            formatted_date_day,
+                            line_id,
+                            headers,
+                            retry=retry,
+                            rate_limiter=rate_limiter,
                         )
-                        line_detail_tasks.append(line_detail_task)
-                        lines_not_called.append(line_id)
-
-                    # line already called
-                    else:
-                        lines_called += 1
-
-                elif config.storage.default == "local":
-                    object_line_detail_name = f"line_detail_{line_id}_{formatted_date_day}.json"
-                    path_dir_line_detail = (
-                        Path(config.storage.config.local.path)
-                        / "raw"
-                        / "emt"
-                        / formatted_date_slash
-                        / "line_detail"
                     )
-                    # If the files are not saved, append the task of the line_detail request
-                    if not check_local_file_exists(path_dir_line_detail, object_line_detail_name):
-                        line_detail_task = asyncio.ensure_future(
-                            get_line_detail(session, formatted_date_day, line_id, headers)
-                        )
-                        line_detail_tasks.append(line_detail_task)
-                        lines_not_called.append(line_id)
+                    line_detail_tasks.append(line_detail_task)
+                    lines_not_called.append(line_id)
 
-                    # line already called
-                    else:
-                        lines_called += 1
+                # line already called
+                else:
+                    lines_called += 1
 
             logger.debug(f"Already called {lines_called} lines")
 
             # Calendar endpoint task
-            if config.storage.default == "minio":
-                object_calendar_name = (
-                    Path("raw")
-                    / "emt"
-                    / formatted_date_slash
-                    / "calendar"
-                    / f"calendar_{formatted_date_day}.json"
-                )
-                # If the file are not saved, append the task of the calendar request
-                if not await check_s3_file_exists(
-                    endpoint_url=config.storage.config.minio.endpoint,
-                    aws_secret_access_key=config.storage.config.minio.secret_key,
-                    aws_access_key_id=config.storage.config.minio.access_key,
-                    bucket_name=config.storage.config.minio.bucket,
-                    object_name=str(object_calendar_name),
-                ):
-                    calendar_task = asyncio.ensure_future(
-                        get_calendar(session, formatted_date_day, formatted_date_day, headers)
+            object_calendar_name = (
+                Path("raw")
+                / "emt"
+                / formatted_date_slash
+                / "calendar"
+                / f"calendar_{formatted_date_day}.json"
+            )
+            # If the file are not saved, append the task of the calendar request
+            if object_calendar_name.as_posix() not in stored_objs:
+                calendar_task = asyncio.ensure_future(
+                    get_calendar(
+                        session,
+                        formatted_date_day,
+                        formatted_date_day,
+                        headers,
+                        retry=retry,
+                        rate_limiter=rate_limiter,
                     )
-                    calendar_tasks.append(calendar_task)
-                else:
-                    logger.debug("Already called Calendar")
+                )
+                calendar_tasks.append(calendar_task)
+            else:
+                logger.debug("Already called Calendar")
 
             if config.storage.default == "local":
-                object_calendar_name = f"calendar_{formatted_date_day}.json"
+                path_dir_line_detail = (
+                    Path(config.storage.config.local.path)
+                    / "raw"
+                    / "emt"
+                    / formatted_date_slash
+                    / "line_detail"
+                )
                 path_dir_calendar = (
                     Path(config.storage.config.local.path)
                     / "raw"
@@ -393,24 +1315,154 @@ async def get_emt(config: Settings):
                     / formatted_date_slash
                     / "calendar"
                 )
-                # If the file are not saved, append the task of the calendar request
-                if not check_local_file_exists(path_dir_calendar, object_calendar_name):
-                    calendar_task = asyncio.ensure_future(
-                        get_calendar(session, formatted_date_day, formatted_date_day, headers)
+
+            # Stops that missed the previous snapshot are requested first
+            previous_report = await read_eta_report(
+                config,
+                eta_report_name(
+                    previous_datetime.strftime("%Y/%m/%d"), previous_datetime.strftime("%H%M")
+                ),
+                s3_client=s3_client,
+            )
+            stops = prioritize_stops(
+                config.sources.emt.stops,
+                previous_report.get("errors", []) + previous_report.get("cancelled", []),
+            )
+
+            # Stops of the slower tiers are only requested in their slot of minutes
+            run_minute = int(current_datetime.timestamp() // 60)
+            if config.sources.emt.stop_tiers:
+                tier_stops = select_tier_stops(stops, config.sources.emt.stop_tiers, run_minute)
+                logger.debug(f"Skipping {len(stops) - len(tier_stops)} stops out of their slot")
+                stops = tier_stops
+
+            # Stops whose lines are all out of service are not requested, the windows come
+            # from the line_detail and calendar stored by the previous runs of the day
+            schedule = None
+            stop_lines = None
+            service_window = config.sources.emt.service_window
+            if service_window.enabled:
+                schedule_path = schedule_state_path(config)
+                schedule = load_schedule_state(schedule_path)
+                stop_lines = schedule["stop_lines"]
+                await update_service_windows(
+                    config,
+                    schedule["windows"],
+                    stored_objs,
+                    formatted_date_slash,
+                    formatted_date_day,
+                    s3_client=s3_client,
+                )
+                in_service_stops = select_in_service_stops(
+                    stops,
+                    schedule,
+                    current_datetime.hour * 60 + current_datetime.minute,
+                    service_window.margin,
+                    service_window.probe_interval,
+                )
+                logger.debug(f"Skipping {len(stops) - len(in_service_stops)} stops out of service")
+                stops = in_service_stops
+
+            # Stops whose buses are all observed by other polled stops are not requested
+            coverage = None
+            if config.sources.emt.coverage.enabled:
+                coverage_path = coverage_state_path(config)
+                coverage = load_coverage_state(coverage_path)
+                covering_stops = plan_stop_cover(
+                    stops,
+                    coverage["observations"],
+                    run_minute,
+                    config.sources.emt.coverage.staleness,
+                )
+                logger.debug(f"Skipping {len(stops) - len(covering_stops)} stops already covered")
+                stops = covering_stops
+
+            # Each ETA response tells which stops to poll in the next runs
+            def observe(stop_id: str, response: bytes):
+                if stop_lines is not None:
+                    learn_stop_lines(stop_lines, stop_id, response)
+                if coverage is not None:
+                    observe_buses(coverage["observations"], stop_id, response, run_minute)
+
+            # Adaptive limit of ETA calls in flight, starting where the previous run left it
+            state_path = concurrency_state_path(config)
+            limiter = AimdLimiter.load(config.sources.emt.concurrency, state_path)
+            logger.debug(f"ETA concurrency limit {limiter.limit:.1f}")
+
+            # Last stored snapshot of each stop, unchanged responses are stored as references
+            snapshots = None
+            if config.sources.emt.eta_dedup:
+                snapshots_path = eta_dedup_state_path(config)
+                snapshots = load_eta_snapshots(snapshots_path)
+
+            # In the files layout the responses are stored as they arrive, overlapping with the
+            # calls still in flight. A response is queued without waiting, so one that arrived
+            # before the deadline is never cancelled while waiting for a free writer.
+            stream_workers = config.sources.emt.eta_stream_workers
+            stream_eta = config.sources.emt.eta_layout == "files" and stream_workers > 0
+            # Object names and stops with errors of the files layout, see `store_eta_result`
+            eta_stored = {"stored": [], "errors": []}
+            if stream_eta:
+                eta_queue = asyncio.Queue(maxsize=len(stops))
+                eta_writers = [
+                    asyncio.ensure_future(
+                        store_eta_worker(
+                            config,
+                            eta_queue,
+                            eta_stored,
+                            formatted_date,
+                            formatted_date_slash,
+                            s3_client,
+                            snapshots=snapshots,
+                        )
                     )
-                    calendar_tasks.append(calendar_task)
-                else:
-                    logger.debug("Already called Calendar")
+                    for _ in range(stream_workers)
+                ]
+
+            try:
+                # Make requests to the eta for each stop, spread across the credentials
+                for position, stop_id in enumerate(stops):
+                    if stream_eta:
+                        eta_call = get_eta_queued(
+                            eta_queue,
+                            session,
+                            stop_id,
+                            position,
+                            pool,
+                            config.sources.emt.credentials_strategy,
+                            retry=retry,
+                            limiter=limiter,
+                            observe=observe,
+                        )
+                    else:
+                        eta_call = get_eta_pooled(
+                            session,
+                            stop_id,
+                            position,
+                            pool,
+                            config.sources.emt.credentials_strategy,
+                            retry=retry,
+                            limiter=limiter,
+                            observe=observe,
+                        )
+                    eta_tasks.append(asyncio.ensure_future(eta_call))
 
-            # Make requests to the eta for each stop
-            for stop_id in config.sources.emt.stops:
-                eta_task = asyncio.ensure_future(get_eta(session, stop_id, headers))
-                eta_tasks.append(eta_task)
+                # Wait for the tasks until the deadline, the pending ones are cancelled (None)
+                calendar_response, eta_responses, line_detail_responses = await asyncio.gather(
+                    wait_until_deadline(calendar_tasks, deadline),
+                    wait_until_deadline(eta_tasks, deadline),
+                    wait_until_deadline(line_detail_tasks, deadline),
+                )
 
-            # Wait for all tasks to complete
-            calendar_response = await asyncio.gather(*calendar_tasks)
-            eta_responses = await asyncio.gather(*eta_tasks)
-            line_detail_responses = await asyncio.gather(*line_detail_tasks)
+                if stream_eta:
+                    # Let the writers store what is left in the queue
+                    await eta_queue.join()
+            finally:
+                if stream_eta:
+                    # Stop the writers, also when the run fails before the queue is drained
+                    for writer in eta_writers:
+                        writer.cancel()
+                    await asyncio.gather(*eta_writers, return_exceptions=True)
 
             errors_ld = 0
             errors_eta = 0
@@ -419,6 +1471,11 @@ async def get_emt(config: Settings):
                 line_detail_dict_upload = {}
                 for line_id, response in zip(lines_not_called, line_detail_responses):
                     try:
+                        if response is None:
+                            logger.warning(
+                                f"Line {line_id} in line_detail cancelled at the deadline"
+                            )
+                            continue
                         response_json_str = json.dumps(response)
                         if response["code"] == "00":
                             if config.storage.default == "minio":
@@ -458,10 +1515,20 @@ async def get_emt(config: Settings):
                         config.storage.config.minio.access_key,
                         config.storage.config.minio.secret_key,
                         line_detail_dict_upload,
+                        client=s3_client,
                     )
 
+            limiter.save(state_path)
+            logger.debug(f"ETA concurrency limit after the run {limiter.limit:.1f}")
+            if rate_limiters:
+                waits = sum(bucket.waits for bucket in rate_limiters) - waits_before
+                wait_time = sum(bucket.wait_time for bucket in rate_limiters) - wait_time_before
+                logger.debug(f"{waits} EMT calls waited {wait_time:.2f}s for the rate limit")
+
             # Store the calendar response if present
-            if calendar_response:
+            if calendar_response and calendar_response[0] is None:
+                logger.warning("Calendar cancelled at the deadline")
+            elif calendar_response:
                 calendar_dict_upload = {}
                 try:
                     calendar_json_str = json.dumps(calendar_response)
@@ -476,11 +1543,12 @@ async def get_emt(config: Settings):
                                 config.storage.config.minio.access_key,
                                 config.storage.config.minio.secret_key,
                                 calendar_dict_upload,
+                                client=s3_client,
                             )
                         if config.storage.default == "local":
                             os.makedirs(path_dir_calendar, exist_ok=True)
                             with open(
-                                os.path.join(path_dir_calendar, object_calendar_name), "w"
+                                os.path.join(path_dir_calendar, object_calendar_name.name), "w"
                             ) as file:
                                 file.write(calendar_json_str)
                     else:
@@ -489,152 +1557,154 @@ async def get_emt(config: Settings):
                     logger.error(e)
                     logger.error(traceback.format_exc())
 
-            # Store the bus stop responses in MinIO
+            # Store the bus stop responses
             list_stops_error = []
-            eta_dict_upload = {}
-            for stop_id, response in zip(config.sources.emt.stops, eta_responses):
-                try:
-                    response_json_str = json.dumps(response)
-                    if response["code"] == "00":
-                        if config.storage.default == "minio":
-                            object_eta_name = (
-                                Path("raw")
-                                / "emt"
-                                / formatted_date_slash
-                                / "eta"
-                                / f"eta_{stop_id}_{formatted_date}.json"
-                            )
-                            eta_dict_upload[object_eta_name] = response_json_str
+            list_stops_cancelled = []
+            eta_keys_uploaded = []
+            # Responses of the run for the packed layout, one NDJSON line per stop
+            eta_records = []
+            # New snapshots by stop of the packed layout, committed once the file is stored
+            eta_snapshots_pending = {}
+            eta_datetime = current_datetime.isoformat()
+            eta_completed = []
+            for stop_id, response in zip(stops, eta_responses):
+                if response is None:
+                    list_stops_cancelled.append(stop_id)
+                else:
+                    eta_completed.append((stop_id, response))
 
-                        if config.storage.default == "local":
-                            object_eta_name = f"eta_{stop_id}_{formatted_date}.json"
-                            path_dir_eta = (
-                                Path(config.storage.config.local.path)
-                                / "raw"
-                                / "emt"
-                                / formatted_date_slash
-                                / "eta"
-                            )
-                            os.makedirs(path_dir_eta, exist_ok=True)
-                            with open(os.path.join(path_dir_eta, object_eta_name), "w") as file:
-                                file.write(response_json_str)
+            if config.sources.emt.eta_layout == "packed":
+                for stop_id, response in eta_completed:
+                    try:
+                        # The raw body is stored as received, only its code is checked
+                        code = response_code(response)
+                        if code == "00":
+                            snapshot = None
+                            if snapshots is not None:
+                                response, snapshot = dedup_eta(
+                                    snapshots,
+                                    stop_id,
+                                    response,
+                                    eta_file_name(config, stop_id, formatted_date),
+                                    formatted_date_slash,
+                                    formatted_date,
+                                )
+                            eta_records.append(eta_record(stop_id, eta_datetime, response))
+                            eta_snapshots_pending[stop_id] = snapshot
 
-                    else:  # 200 CODE BUT ERROR IN RESPONSE JSON
+                        else:  # 200 CODE BUT ERROR IN RESPONSE JSON
+                            errors_eta += 1
+                            list_stops_error.append(stop_id)
+                            logger.error(f"Error code {code} in stop {stop_id} in EMT ETA")
+
+                    except Exception as e:
                         errors_eta += 1
                         list_stops_error.append(stop_id)
-                        logger.error(f"Error code {response['code']} in stop {stop_id} in EMT ETA")
-
-                except Exception as e:
-                    errors_eta += 1
-                    list_stops_error.append(stop_id)
-                    logger.error(e)
-                    logger.error(traceback.format_exc())
-
-            # Upload the dict to s3 asynchronously if dict contains something (This means minio flag in convig was enabled)
-            if eta_dict_upload:
-                #List of str names of objects uploaded into s3
-                list_keys_str = [str(key.parent) + '/' + str(key.name) for key in eta_dict_upload]
-                logger.debug(f"Uploading {len(list_keys_str)} files")
+                        logger.error(e)
+                        logger.error(traceback.format_exc())
 
-                await upload_objs(
-                    config.storage.config.minio.bucket,
-                    config.storage.config.minio.endpoint,
-                    config.storage.config.minio.access_key,
-                    config.storage.config.minio.secret_key,
-                    eta_dict_upload,
-                )
-                
-                upload_metadata(
-                    config.storage.config.minio.bucket,
-                    config.storage.config.minio.endpoint,
-                    config.storage.config.minio.access_key,
-                    config.storage.config.minio.secret_key,
-                    list_keys_str
+            elif not stream_eta:
+                # Files layout without writers, the responses are stored once the calls end
+                await asyncio.gather(
+                    *[
+                        store_eta_result(
+                            config,
+                            stop_id,
+                            response,
+                            eta_stored,
+                            formatted_date,
+                            formatted_date_slash,
+                            s3_client,
+                            snapshots=snapshots,
+                        )
+                        for stop_id, response in eta_completed
+                    ]
                 )
 
+            if config.sources.emt.eta_layout == "files":
+                errors_eta += len(eta_stored["errors"])
+                list_stops_error.extend(eta_stored["errors"])
+                if config.storage.default == "minio":
+                    eta_keys_uploaded.extend(eta_stored["stored"])
+                logger.debug(f"Stored {len(eta_stored['stored'])} ETA responses")
 
             logger.error(f"{errors_ld} errors in Line Detail")
             logger.error(f"{errors_eta} errors in ETA, list of stops erroring: {list_stops_error}")
-            eta_dict_upload = {}
-
-            # Retry the failed petitions
-            if errors_eta > 0:
-                list_stops_error_retry = []
-                eta_tasks2 = []
-                errors_eta_retry = 0
-                # Make requests that failed to the eta for each stop
-                for stop_id in list_stops_error:
-                    eta_task = asyncio.ensure_future(get_eta(session, stop_id, headers))
-                    eta_tasks2.append(eta_task)
-
-                eta_responses2 = await asyncio.gather(*eta_tasks2)
-                for stop_id, response in zip(list_stops_error, eta_responses2):
-                    try:
-                        response_json_str = json.dumps(response)
-                        if response == -1:
-                            errors_eta_retry += 1
-                            list_stops_error_retry.append(stop_id)
-                            continue
 
-                        if response["code"] == "00":
-                            if config.storage.default == "minio":
-                                object_eta_name = (
-                                    Path("raw")
-                                    / "emt"
-                                    / formatted_date_slash
-                                    / "eta"
-                                    / f"eta_{stop_id}_{formatted_date}.json"
-                                )
-                                eta_dict_upload[object_eta_name] = response_json_str
+            # Packed layout: a single compressed NDJSON object with every response of the run
+            if eta_records:
+                compression = config.sources.emt.eta_compression
+                object_eta_name = eta_file_name(config, None, formatted_date)
+                eta_packed = pack_ndjson(eta_records, compression)
+                logger.debug(f"Packed {len(eta_records)} ETA responses in {object_eta_name}")
+                if config.storage.default == "minio":
+                    object_eta_key = (
+                        Path("raw") / "emt" / formatted_date_slash / "eta" / object_eta_name
+                    ).as_posix()
+                    await upload_objs(
+                        config.storage.config.minio.bucket,
+                        config.storage.config.minio.endpoint,
+                        config.storage.config.minio.access_key,
+                        config.storage.config.minio.secret_key,
+                        {object_eta_key: eta_packed},
+                        client=s3_client,
+                    )
+                    eta_keys_uploaded.append(object_eta_key)
 
-                            if config.storage.default == "local":
-                                object_eta_name = f"eta_{stop_id}_{formatted_date}.json"
-                                path_dir_eta = (
-                                    Path(config.storage.config.local.path)
-                                    / "raw"
-                                    / "emt"
-                                    / formatted_date_slash
-                                    / "eta"
-                                )
-                                os.makedirs(path_dir_eta, exist_ok=True)
-                                with open(
-                                    os.path.join(path_dir_eta, object_eta_name), "w"
-                                ) as file:
-                                    file.write(response_json_str)
+                if config.storage.default == "local":
+                    path_dir_eta = (
+                        Path(config.storage.config.local.path)
+                        / "raw"
+                        / "emt"
+                        / formatted_date_slash
+                        / "eta"
+                    )
+                    os.makedirs(path_dir_eta, exist_ok=True)
+                    with open(os.path.join(path_dir_eta, object_eta_name), "wb") as file:
+                        file.write(eta_packed)
 
-                        else:
-                            errors_eta_retry += 1
-                            list_stops_error_retry.append(stop_id)
-                            logger.error(f"Error code {response['code']} in stop {stop_id} in ETA after retrying")
-                    except Exception as e:
-                        errors_eta_retry += 1
-                        list_stops_error_retry.append(stop_id)
-                        logger.error(e)
-                        logger.error(traceback.format_exc())
-                logger.error(
-                    f"{errors_eta_retry} errors in ETA after retrying, "
-                    + f"list of stops erroring after retrying:, {list_stops_error_retry}"
-                )
+                for stop_id, snapshot in eta_snapshots_pending.items():
+                    commit_eta_snapshot(snapshots, stop_id, snapshot)
 
-            # Upload the dict to s3 asynchronously if dict contains something (This means minio flag in convig was enabled)
-            if eta_dict_upload:
-                #List of str names of objects uploaded into s3
-                list_keys_str = [str(key.parent) + '/' + str(key.name) for key in eta_dict_upload]
-                logger.debug(f"Uploading {len(list_keys_str)} files")
-                await upload_objs(
+            # Write this run's shard of the day's ETA manifest
+            if eta_keys_uploaded:
+                await upload_manifest(
                     config.storage.config.minio.bucket,
                     config.storage.config.minio.endpoint,
                     config.storage.config.minio.access_key,
                     config.storage.config.minio.secret_key,
-                    eta_dict_upload,
+                    eta_keys_uploaded,
+                    manifest_shard_name(current_datetime),
+                    client=s3_client,
                 )
-                upload_metadata(
-                    config.storage.config.minio.bucket,
-                    config.storage.config.minio.endpoint,
-                    config.storage.config.minio.access_key,
-                    config.storage.config.minio.secret_key,
-                    list_keys_str
+
+            if snapshots is not None:
+                save_eta_snapshots(snapshots_path, snapshots)
+            if schedule is not None:
+                save_schedule_state(schedule_path, schedule)
+            if coverage is not None:
+                save_coverage_state(coverage_path, coverage)
+
+            # Report of the run, read by the next one to prioritise the missed stops
+            if list_stops_cancelled:
+                logger.warning(
+                    f"{len(list_stops_cancelled)} ETA requests cancelled at the deadline, "
+                    + f"list of stops cancelled: {list_stops_cancelled}"
                 )
+            eta_report = {
+                "datetime": eta_datetime,
+                "deadline": deadline.isoformat(),
+                "stops": len(stops),
+                "completed": len(stops) - len(list_stops_error) - len(list_stops_cancelled),
+                "errors": list_stops_error,
+                "cancelled": list_stops_cancelled,
+            }
+            await save_eta_report(
+                config,
+                eta_report_name(formatted_date_slash, current_datetime.strftime("%H%M")),
+                eta_report,
+                s3_client=s3_client,
+            )
 
             end = datetime.datetime.now()
             logger.debug(f"Time duration of EMT extraction {end - now}")
@@ -0,0 +1,396 @@
+"""Choose the EMT stops requested in each extraction run."""
+import asyncio
+import json
+import re
+import zlib
+from pathlib import Path
+
+from aiobotocore.session import ClientCreatorContext
+from loguru import logger
+
+from inesdata_mov_datasets.handlers.retry import response_code
+from inesdata_mov_datasets.settings import Settings, SourceEmtStopTierSettings
+from inesdata_mov_datasets.utils import read_json_state, read_obj, write_json_state
+
+# "line" fields of the arrivals of an ETA response
+LINE_PATTERN = re.compile(rb'"line"\s*:\s*"?(\w+)')
+# "line" and then "bus" fields of each arrival of an ETA response, without leaving the arrival
+# (its nested objects, as the geometry, are skipped)
+LINE_BUS_PATTERN = re.compile(rb'"line"\s*:\s*"?(\w+)"?(?:[^{}]|\{[^{}]*\})*?"bus"\s*:\s*"?(\w+)')
+MINUTES_PER_DAY = 24 * 60
+
+# Keys of the schedule and coverage states, with their values when the state file has not them
+SCHEDULE_STATE_DEFAULTS = {"stop_lines": {}, "windows": {}}
+COVERAGE_STATE_DEFAULTS = {"observations": {}}
+
+
+def schedule_state_path(config: Settings) -> Path:
+    """Get the local file where the schedule state is kept between runs.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        Path: Path of the state file.
+    """
+    if config.sources.emt.service_window.state_path is not None:
+        return Path(config.sources.emt.service_window.state_path)
+    return Path(config.storage.logs.path) / "emt_schedule.json"
+
+
+def coverage_state_path(config: Settings) -> Path:
+    """Get the local file where the buses observed by stop are kept between runs.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        Path: Path of the state file.
+    """
+    if config.sources.emt.coverage.state_path is not None:
+        return Path(config.sources.emt.coverage.state_path)
+    return Path(config.storage.logs.path) / "emt_coverage.json"
+
+
+def load_schedule_state(state_path: Path) -> dict:
+    """Get the schedule state, from memory or from the state file.
+
+    Args:
+        state_path (Path): Local file with the state.
+
+    Returns:
+        dict: Lines seen at each stop (`stop_lines`) and service windows of the day
+            (`windows`). The dict is the one kept in memory, so changes are seen by the next
+            run of the process.
+    """
+    return read_json_state(state_path, defaults=SCHEDULE_STATE_DEFAULTS, memoize=True)
+
+
+def save_schedule_state(state_path: Path, state: dict):
+    """Save the schedule state for the next processes.
+
+    Args:
+        state_path (Path): Local file with the state.
+        state (dict): Schedule state.
+    """
+    write_json_state(state_path, state)
+
+
+def load_coverage_state(state_path: Path) -> dict:
+    """Get the coverage state, from memory or from the state file.
+
+    Args:
+        state_path (Path): Local file with the state.
+
+    Returns:
+        dict: Buses observed by stop (`observations`). The dict is the one kept in memory, so
+            changes are seen by the next run of the process.
+    """
+    return read_json_state(state_path, defaults=COVERAGE_STATE_DEFAULTS, memoize=True)
+
+
+def save_coverage_state(state_path: Path, state: dict):
+    """Save the coverage state for the next processes.
+
+    Args:
+        state_path (Path): Local file with the state.
+        state (dict): Coverage state.
+    """
+    write_json_state(state_path, state)
+
+
+def normalize_line(line) -> str:
+    """Get the id of a line without leading zeros, as ETA and line_detail differ on them.
+
+    Args:
+        line: Id of the line.
+
+    Returns:
+        str: Normalized id.
+    """
+    return str(line).lstrip("0") or "0"
+
+
+def learn_stop_lines(stop_lines: dict, stop_id: str, response: bytes):
+    """Add the lines arriving at a stop to the lines seen there, without decoding the response.
+
+    Args:
+        stop_lines (dict): Lines seen by stop.
+        stop_id (str): Id of the bus stop.
+        response (bytes): Raw json body of the ETA response.
+    """
+    lines = {normalize_line(line.decode()) for line in LINE_PATTERN.findall(response)}
+    known = set(stop_lines.get(str(stop_id), []))
+    if not lines <= known:
+        stop_lines[str(stop_id)] = sorted(known | lines)
+
+
+def observe_buses(observations: dict, stop_id: str, response: bytes, minute: int):
+    """Keep the buses arriving at a stop in a run, without decoding the response.
+
+    Failed responses are not kept, so the last observation of the stop gets stale.
+
+    Args:
+        observations (dict): Buses observed by stop.
+        stop_id (str): Id of the bus stop.
+        response (bytes): Raw json body of the ETA response.
+        minute (int): Minutes since the epoch of the run.
+    """
+    if response_code(response) != "00" or b'"Arrive"' not in response:
+        return
+    buses = {
+        f"{normalize_line(line.decode())}:{bus.decode()}"
+        for line, bus in LINE_BUS_PATTERN.findall(response)
+    }
+    observations[str(stop_id)] = {"minute": minute, "buses": sorted(buses)}
+
+
+def parse_service_time(value: str) -> int:
+    """Get the minute of the day of a line_detail time.
+
+    Args:
+        value (str): Time in format HH:MM.
+
+    Returns:
+        int: Minutes since midnight.
+    """
+    hours, minutes = value.split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def line_service_window(line_detail: dict, day_type: str) -> list | None:
+    """Get the minutes of the day in which a line is in service on a day type.
+
+    Args:
+        line_detail (dict): line_detail response of the line.
+        day_type (str): Day type of the calendar.
+
+    Returns:
+        list | None: First and last minute of service of both directions. The last one goes
+            past 1440 when the service ends after midnight. None if the line does not run.
+    """
+    windows = []
+    for time_table in line_detail["data"][0]["timeTable"]:
+        if str(time_table["idDayType"]) != str(day_type):
+            continue
+        for direction in ["Direction1", "Direction2"]:
+            times = time_table.get(direction) or {}
+            if not times.get("StartTime") or not times.get("StopTime"):
+                continue
+            start = parse_service_time(times["StartTime"])
+            stop = parse_service_time(times["StopTime"])
+            if stop < start:  # Service past midnight, e.g. the night network
+                stop += MINUTES_PER_DAY
+            windows.append((start, stop))
+    if not windows:
+        return None
+    return [min(start for start, _ in windows), max(stop for _, stop in windows)]
+
+
+def in_service(window: list, minute_of_day: int, margin: int) -> bool:
+    """Check if a line is in service at a minute of the day.
+
+    Args:
+        window (list): Service window from `line_service_window`.
+        minute_of_day (int): Minutes since midnight.
+        margin (int): Minutes before the start and after the end still counted as in service.
+
+    Returns:
+        bool: True if the minute is inside the window, also when the window of the day
+            before runs past midnight.
+    """
+    start, stop = window
+    return any(
+        start - margin <= minute <= stop + margin
+        for minute in [minute_of_day, minute_of_day + MINUTES_PER_DAY]
+    )
+
+
+async def read_stored_json(
+    config: Settings, object_name: str, s3_client: ClientCreatorContext = None
+) -> dict | list:
+    """Read a json object stored by a previous run.
+
+    Args:
+        config (Settings): Object with the config file.
+        object_name (str): Object name, relative to the storage root.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+
+    Returns:
+        dict | list: Content of the object.
+    """
+    if config.storage.default == "minio":
+        response = await read_obj(
+            config.storage.config.minio.bucket,
+            config.storage.config.minio.endpoint,
+            config.storage.config.minio.access_key,
+            config.storage.config.minio.secret_key,
+            object_name,
+            client=s3_client,
+        )
+        return json.loads(response)
+    with open(Path(config.storage.config.local.path) / object_name, "r") as file:
+        return json.loads(file.read())
+
+
+async def update_service_windows(
+    config: Settings,
+    windows: dict,
+    stored_objs: set,
+    date_slash: str,
+    date_day: str,
+    s3_client: ClientCreatorContext = None,
+):
+    """Load the service windows from the calendar and line_detail stored today.
+
+    Only the objects not loaded by a previous run are read.
+
+    Args:
+        config (Settings): Object with the config file.
+        windows (dict): Service windows of the day, updated in place.
+        stored_objs (set): Index of the objects already stored today.
+        date_slash (str): Date of the run in format year/month/day.
+        date_day (str): Date of the run in format yearmonthday.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+    """
+    if windows.get("date") != date_slash:
+        windows.clear()
+        windows.update({"date": date_slash, "day_type": None, "lines": {}, "loaded": []})
+
+    if windows["day_type"] is None:
+        calendar_name = f"raw/emt/{date_slash}/calendar/calendar_{date_day}.json"
+        if calendar_name not in stored_objs:
+            return
+        try:
+            calendar = await read_stored_json(config, calendar_name, s3_client)
+            calendar = calendar[0] if isinstance(calendar, list) else calendar
+            windows["day_type"] = calendar["data"][0]["dayType"]
+        except Exception as e:
+            logger.warning(f"Cannot read the day type from {calendar_name}: {e}")
+            return
+
+    line_detail_names = sorted(
+        name
+        for name in stored_objs
+        if name.startswith(f"raw/emt/{date_slash}/line_detail/") and name not in windows["loaded"]
+    )
+    line_details = await asyncio.gather(
+        *[read_stored_json(config, name, s3_client) for name in line_detail_names],
+        return_exceptions=True,
+    )
+    for name, line_detail in zip(line_detail_names, line_details):
+        try:
+            if isinstance(line_detail, Exception):
+                raise line_detail
+            line = normalize_line(line_detail["data"][0]["line"])
+            windows["lines"][line] = line_service_window(line_detail, windows["day_type"])
+            windows["loaded"].append(name)
+        except Exception as e:
+            logger.warning(f"Cannot read the service window from {name}: {e}")
+
+
+def select_in_service_stops(
+    stops: list, state: dict, minute_of_day: int, margin: int, probe_interval: int
+) -> list:
+    """Keep the stops with some line in service.
+
+    Stops without lines seen yet, or with a line whose service window is unknown, are kept.
+    Skipped stops are still requested once every `probe_interval` minutes, at a different
+    minute each, to find lines not seen there yet.
+
+    Args:
+        stops (list): Ids of the bus stops.
+        state (dict): Schedule state, see `load_schedule_state`.
+        minute_of_day (int): Minutes since midnight of the run.
+        margin (int): Minutes before the start and after the end still counted as in service.
+        probe_interval (int): Minutes between requests of a skipped stop.
+
+    Returns:
+        list: Stops to request, in their original order.
+    """
+    windows = state["windows"].get("lines", {})
+    selected = []
+    for stop_id in stops:
+        lines = state["stop_lines"].get(str(stop_id))
+        keep = (
+            not lines
+            or any(
+                line not in windows
+                or (windows[line] is not None and in_service(windows[line], minute_of_day, margin))
+                for line in lines
+            )
+            or minute_of_day % probe_interval
+            == zlib.crc32(str(stop_id).encode("utf-8")) % probe_interval
+        )
+        if keep:
+            selected.append(stop_id)
+    return selected
+
+
+def plan_stop_cover(stops: list, observations: dict, minute: int, staleness: int) -> list:
+    """Get the fewest stops that still observe every bus of the fresh observations.
+
+    The buses are identified by line, so every line keeps its whole fleet covered. The cover
+    is chosen greedily, taking each time the stop that observes most of the buses left.
+    Stops never observed or with an observation older than `staleness` minutes are polled
+    too, and every stop is polled again once every `staleness` minutes, at a different minute
+    each, so the observations the cover is built on never get stale.
+
+    Args:
+        stops (list): Ids of the bus stops.
+        observations (dict): Buses observed by stop, see `observe_buses`.
+        minute (int): Minutes since the epoch of the run.
+        staleness (int): Max minutes since the last observation of a stop.
+
+    Returns:
+        list: Stops to request, in their original order.
+    """
+    fresh = {}
+    for stop_id in stops:
+        observation = observations.get(str(stop_id))
+        if observation is not None and minute - observation["minute"] <= staleness:
+            fresh[str(stop_id)] = set(observation["buses"])
+
+    uncovered = set().union(*fresh.values())
+    cover = set()
+    while uncovered:
+        best = max(fresh, key=lambda stop_id: len(fresh[stop_id] & uncovered))
+        cover.add(best)
+        uncovered -= fresh[best]
+
+    return [
+        stop_id
+        for stop_id in stops
+        if str(stop_id) not in fresh
+        or str(stop_id) in cover
+        or minute % staleness == zlib.crc32(str(stop_id).encode("utf-8")) % staleness
+    ]
+
+
+def select_tier_stops(
+    stops: list, stop_tiers: list[SourceEmtStopTierSettings], minute: int
+) -> list:
+    """Keep the stops whose tier is polled in this run.
+
+    The stops of a tier polled every N minutes are split in N slots by their position in the
+    tier, so every minute gets the same share of them. Stops in no tier are always kept. The
+    tier stops must also be in `stops`, see `SourceEmtSettings`.
+
+    Args:
+        stops (list): Ids of the bus stops.
+        stop_tiers (list[SourceEmtStopTierSettings]): Tiers of stops polled less often.
+        minute (int): Minutes since the epoch of the run.
+
+    Returns:
+        list: Stops to request, in their original order.
+    """
+    slots = {}
+    for tier in stop_tiers:
+        for position, stop_id in enumerate(tier.stops):
+            # A stop in several tiers follows the first one
+            slots.setdefault(str(stop_id), (tier.every, position % tier.every))
+    return [
+        stop_id
+        for stop_id in stops
+        if str(stop_id) not in slots or minute % slots[str(stop_id)][0] == slots[str(stop_id)][1]
+    ]
@@ -1,37 +1,269 @@
 """Gather raw data from aemet."""
 import datetime
 import json
+import re
 import traceback
 from pathlib import Path
+from typing import Iterator
+from xml.etree import ElementTree
 import pytz
 
-import requests
-import xmltodict
+import aiohttp
+from aiobotocore.session import ClientCreatorContext
 from loguru import logger
 
 from inesdata_mov_datasets.handlers.logger import instantiate_logger
 from inesdata_mov_datasets.settings import Settings
-from inesdata_mov_datasets.utils import check_local_file_exists, check_s3_file_exists, upload_objs
+from inesdata_mov_datasets.utils import (
+    http_session,
+    list_stored_objs,
+    read_json_state,
+    storage_client,
+    upload_objs,
+    write_json_state,
+)
 
+INFORMO_URL = "https://informo.madrid.es/informo/tmadrid/pm.xml"
+# fecha_hora goes at the start of the XML, before the measurement points
+FECHA_HORA_PATTERN = re.compile(rb"<fecha_hora>\s*([^<]*?)\s*</fecha_hora>")
+# Max bytes read looking for fecha_hora before downloading the whole XML
+FECHA_HORA_PROBE_BYTES = 4096
 
-async def get_informo(config: Settings):
+# Bytes of the XML given to the parser at a time
+PARSE_CHUNK_BYTES = 64 * 1024
+
+async def fetch_informo(session: aiohttp.ClientSession) -> bytes:
+    """Download the Informo XML.
+
+    Args:
+        session (aiohttp.ClientSession): Call session to make faster the calls to the same API.
+
+    Returns:
+        bytes: Content of the XML.
+    """
+    async with session.get(INFORMO_URL) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+def pm_record(element: ElementTree.Element) -> dict:
+    """Get the record of a measurement point, as xmltodict read it.
+
+    Values are kept as the text of the XML (coordinates with their decimal comma) and empty
+    fields are None, so the stored files and the created datasets do not change.
+
+    Args:
+        element (ElementTree.Element): `pm` element of the XML.
+
+    Returns:
+        dict: Fields of the point.
+    """
+    return {field.tag: (field.text or "").strip() or None for field in element}
+
+
+def iter_informo_elements(content: bytes) -> Iterator[tuple[str, str | dict]]:
+    """Parse the Informo XML incrementally, without building its whole tree.
+
+    Args:
+        content (bytes): Content of the XML.
+
+    Yields:
+        tuple[str, str | dict]: ("fecha_hora", date of the XML) and ("pm", record of a
+            measurement point) in the order of the XML.
+
+    Raises:
+        ElementTree.ParseError: If the XML is not valid.
+    """
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    root = None
+    depth = 0
+    for start in range(0, len(content), PARSE_CHUNK_BYTES):
+        parser.feed(content[start : start + PARSE_CHUNK_BYTES])
+        for event, element in parser.read_events():
+            if event == "start":
+                depth += 1
+                if root is None:
+                    root = element
+                continue
+            depth -= 1
+            # Only the children of the root, fields inside a pm are read with it
+            if depth != 1:
+                continue
+            if element.tag == "pm":
+                yield "pm", pm_record(element)
+            elif element.tag == "fecha_hora":
+                yield "fecha_hora", (element.text or "").strip()
+            # Drop the element already read, the tree never grows past one point
+            root.remove(element)
+    parser.close()
+
+
+def parse_informo(content: bytes) -> json:
+    """Parse the Informo XML with its measurement points read lazily.
+
+    Args:
+        content (bytes): Content of the XML.
+
+    Returns:
+        json: `{"pms": {"fecha_hora": str, "pm": iterator of records}}`, the same layout
+            stored before. The records are parsed while the iterator is consumed, once.
+
+    Raises:
+        ValueError: If the XML does not start with its fecha_hora.
+        ElementTree.ParseError: If the XML is not valid.
+    """
+    elements = iter_informo_elements(content)
+    tag, fecha_hora = next(elements, (None, None))
+    if tag != "fecha_hora":
+        raise ValueError("INFORMO XML without fecha_hora before its measurement points")
+    records = (record for tag, record in elements if tag == "pm")
+    return {"pms": {"fecha_hora": fecha_hora, "pm": records}}
+
+
+def informo_json_chunks(data: json) -> Iterator[str]:
+    """Serialize Informo data in pieces, one measurement point at a time.
+
+    Args:
+        data (json): Informo data, its `pm` can be an iterator of records.
+
+    Yields:
+        str: Pieces of the json, equal to `json.dumps(data)` once joined.
+    """
+    yield '{"pms": {'
+    for position, (key, value) in enumerate(data["pms"].items()):
+        yield f"{', ' if position else ''}{json.dumps(key)}: "
+        if key == "pm" and not isinstance(value, (dict, str)):
+            yield "["
+            for index, record in enumerate(value):
+                yield f"{', ' if index else ''}{json.dumps(record)}"
+            yield "]"
+        else:
+            yield json.dumps(value)
+    yield "}}"
+
+
+def informo_validators_path(config: Settings) -> Path:
+    """Get the local file where the validators of the last stored XML are kept between runs.
+
+    Args:
+        config (Settings): Object with the config file.
+
+    Returns:
+        Path: Path of the state file.
+    """
+    if config.sources.informo.state_path is not None:
+        return Path(config.sources.informo.state_path)
+    return Path(config.storage.logs.path) / "informo_validators.json"
+
+
+def load_informo_validators(state_path: Path) -> dict:
+    """Get the validators of the last stored XML, from memory or from the state file.
+
+    Args:
+        state_path (Path): Local file with the validators.
+
+    Returns:
+        dict: ETag, Last-Modified and fecha_hora of the last stored XML, empty if there is none.
+    """
+    return read_json_state(state_path, memoize=True)
+
+
+def save_informo_validators(state_path: Path, validators: dict):
+    """Save the validators of the last stored XML for the next runs.
+
+    Args:
+        state_path (Path): Local file with the validators.
+        validators (dict): ETag, Last-Modified and fecha_hora of the XML.
+    """
+    write_json_state(state_path, validators)
+
+
+async def fetch_informo_if_changed(
+    session: aiohttp.ClientSession, validators: dict
+) -> tuple[bytes | None, dict]:
+    """Download the Informo XML unless it did not change since the last stored one.
+
+    The call is conditional on the ETag and Last-Modified of the last XML. If the server
+    still sends it, only the start of the body is read to compare its fecha_hora, and the rest
+    is not downloaded when it is the same.
+
+    Args:
+        session (aiohttp.ClientSession): Call session to make faster the calls to the same API.
+        validators (dict): ETag, Last-Modified and fecha_hora of the last stored XML.
+
+    Returns:
+        tuple[bytes | None, dict]: Content of the XML, None if it did not change, and the
+            validators of this response.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    async with session.get(INFORMO_URL, headers=headers) as response:
+        if response.status == 304:
+            return None, validators
+        response.raise_for_status()
+        received = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fecha_hora": None,
+        }
+
+        # Read just the start of the XML, up to its fecha_hora
+        head = b""
+        while b"</fecha_hora>" not in head and len(head) < FECHA_HORA_PROBE_BYTES:
+            chunk = await response.content.read(1024)
+            if not chunk:
+                break
+            head += chunk
+        match = FECHA_HORA_PATTERN.search(head)
+        if match is not None:
+            received["fecha_hora"] = match.group(1).decode()
+            if received["fecha_hora"] == validators.get("fecha_hora"):
+                return None, received
+
+        return head + await response.content.read(), received
+
+
+async def get_informo(
+    config: Settings,
+    s3_client: ClientCreatorContext = None,
+    session: aiohttp.ClientSession = None,
+):
     """Request informo API to get data from Madrid traffic.
 
     Args:
         config (Settings): Object with the config file.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the run.
     """
     try:
         # Logger
         instantiate_logger(config, "INFORMO", "extract")
         logger.info("Extracting INFORMO")
         now = datetime.datetime.now()
-        url_informo = "https://informo.madrid.es/informo/tmadrid/pm.xml"
 
-        r = requests.get(url_informo)
-        # Parse XML
-        xml_dict = xmltodict.parse(r.content)
+        # Validators of the last stored XML, an unchanged XML is neither parsed nor stored
+        validators_path = informo_validators_path(config)
+        validators = load_informo_validators(validators_path)
+        async with http_session(session) as session:
+            content, received = await fetch_informo_if_changed(session, validators)
+
+        if content is None:
+            logger.debug("INFORMO not changed since the last stored XML")
+        else:
+            # Parse XML, the measurement points are read while they are stored
+            xml_dict = parse_informo(content)
+
+            async with storage_client(config, s3_client) as s3_client:
+                await save_informo(config, xml_dict, s3_client=s3_client)
 
-        await save_informo(config, xml_dict)
+        # Only once the XML is stored, a failed run is repeated by the next one
+        if received is not validators:
+            save_informo_validators(validators_path, received)
 
         end = datetime.datetime.now()
         logger.debug(f"Time duration of INFORMO extraction {end - now}")
@@ -41,12 +273,21 @@ async def get_informo(config: Settings):
         logger.error(traceback.format_exc())
 
 
-async def save_informo(config: Settings, data: json):
+async def save_informo(
+    config: Settings,
+    data: json,
+    s3_client: ClientCreatorContext = None,
+    stored_objs: set = None,
+):
     """Save informo json.
 
     Args:
         config (Settings): Object with the config file.
-        data (json): Data with informo in json format.
+        data (json): Data with informo in json format, see `parse_informo`. Its measurement
+            points are only read if they have to be stored.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+        stored_objs (set): Index of the Informo objects already stored today. If not provided,
+            it is listed from the storage.
     """
     # Get the last update date from the response
     date_from_file = data["pms"]["fecha_hora"]
@@ -64,21 +305,21 @@ async def save_informo(config: Settings, data: json):
         "%Y/%m/%d"
     )  # formatted date year/month/day for storage in Minio
 
+    # Index of the objects already stored today
+    if stored_objs is None:
+        stored_objs = await list_stored_objs(
+            config, [f"raw/informo/{formatted_date_slash}/"], s3_client=s3_client
+        )
+
     if config.storage.default == "minio":
         # Define the object name
         object_name = (
             Path("raw") / "informo" / formatted_date_slash / f"informo_{formated_date}.json"
         )
         # Check if the Minio object exists
-        if not await check_s3_file_exists(
-            endpoint_url=config.storage.config.minio.endpoint,
-            aws_secret_access_key=config.storage.config.minio.secret_key,
-            aws_access_key_id=config.storage.config.minio.access_key,
-            bucket_name=config.storage.config.minio.bucket,
-            object_name=str(object_name),
-        ):
+        if object_name.as_posix() not in stored_objs:
             # Convert data to JSON string
-            response_json_str = json.dumps(data)
+            response_json_str = "".join(informo_json_chunks(data))
 
             informo_dict_upload = {}
             informo_dict_upload[str(object_name)] = response_json_str
@@ -88,6 +329,7 @@ async def save_informo(config: Settings, data: json):
                 config.storage.config.minio.access_key,
                 config.storage.config.minio.secret_key,
                 informo_dict_upload,
+                client=s3_client,
             )
         else:
             logger.debug("Already called INFORMO in the past 5 minutes")
@@ -98,15 +340,13 @@ async def save_informo(config: Settings, data: json):
             Path(config.storage.config.local.path) / "raw" / "informo" / formatted_date_slash
         )
         # Check if the file exists
-        if not check_local_file_exists(path_save_informo, object_name):
-            # Convert data to JSON string
-            response_json_str = json.dumps(data)
-
+        if f"raw/informo/{formatted_date_slash}/{object_name}" not in stored_objs:
             # Create directories if they don't exist
             path_save_informo.mkdir(parents=True, exist_ok=True)
 
-            # Write JSON data to file
+            # Write JSON data to file as it is serialized
             with open(path_save_informo / object_name, "w") as file:
-                file.write(response_json_str)
+                for chunk in informo_json_chunks(data):
+                    file.write(chunk)
         else:
             logger.debug("Already called INFORMO in the past 5 minutes")
@@ -1,23 +1,38 @@
 """Gather raw data from aemet."""
 
+import json
 import traceback
 
-import requests
+import aiohttp
 from loguru import logger
 
+from inesdata_mov_datasets.handlers.rate_limit import get_token_bucket
+from inesdata_mov_datasets.handlers.response_cache import cached_fetch
 from inesdata_mov_datasets.settings import Settings
+from inesdata_mov_datasets.sources.extract.aemet import AEMET_MUNICIPALITY_URL, fetch_aemet
+from inesdata_mov_datasets.utils import http_session
 
 
-async def get_filter_aemet(config: Settings):
-    """Request aemet API to get data from Madrid weather.
+async def get_filter_aemet(
+    config: Settings, session: aiohttp.ClientSession = None, municipality: str = None
+):
+    """Request aemet API to get the weather of a municipality.
+
+    The forecast is reused from the in-process cache for `sources.filter_cache.aemet` seconds,
+    and concurrent calls share a single request. The calls go through the AEMET rate limit
+    shared with the extraction.
 
     Args:
         config (Settings): Object with the config file.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the call.
+        municipality (str): INE code of the municipality. If not provided, the first one of
+            `sources.aemet.municipalities` is used.
     """
     try:
-        url_madrid = (
-            "https://opendata.aemet.es/opendata/api/prediccion/especifica/municipio/horaria/28079"
-        )
+        if municipality is None:
+            municipality = config.sources.aemet.municipalities[0]
+        url = AEMET_MUNICIPALITY_URL.format(municipality)
 
         headers = {
             "api_key": config.sources.aemet.credentials.api_key,
@@ -25,8 +40,15 @@ async def get_filter_aemet(config: Settings):
             "Accept": "application/json",
         }
 
-        r = requests.get(url_madrid, headers=headers)
-        r_json = requests.get(r.json()["datos"]).json()
+        rate_limiter = get_token_bucket(config.sources.aemet.rate_limit, key="aemet")
+
+        async def fetch() -> json:
+            async with http_session(session) as aemet_session:
+                return await fetch_aemet(aemet_session, url, headers, rate_limiter=rate_limiter)
+
+        r_json = await cached_fetch(
+            ("aemet", municipality, None), config.sources.filter_cache.aemet, fetch
+        )
 
         logger.info("Extracted AEMET")
 
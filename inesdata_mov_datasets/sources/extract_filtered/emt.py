@@ -9,14 +9,27 @@ import aiohttp
 import pytz
 from loguru import logger
 
-from inesdata_mov_datasets.settings import Settings
+from inesdata_mov_datasets.handlers.rate_limit import TokenBucket
+from inesdata_mov_datasets.handlers.response_cache import cached_fetch
+from inesdata_mov_datasets.handlers.retry import request_json
+from inesdata_mov_datasets.settings import Settings, SourceEmtRetrySettings
 from inesdata_mov_datasets.sources.extract.emt import (
+    credential_rate_limiter,
+    emt_credentials,
     get_calendar,
     token_control,
 )
+from inesdata_mov_datasets.utils import http_session
 
 
-async def get_eta(session: aiohttp, stop_id: str, line_id: str, headers: json) -> json:
+async def get_eta(
+    session: aiohttp,
+    stop_id: str,
+    line_id: str,
+    headers: json,
+    retry: SourceEmtRetrySettings = None,
+    rate_limiter: TokenBucket = None,
+) -> json:
     """Make the API call to ETA endpoint.
 
     Args:
@@ -24,6 +37,8 @@ async def get_eta(session: aiohttp, stop_id: str, line_id: str, headers: json) -
         stop_id (str): Id of the bus stop.
         line_id (str): Id of the bus line.
         headers (json): Headers of the http call.
+        retry (SourceEmtRetrySettings): Retry policy. If not provided, a single attempt is made.
+        rate_limiter (TokenBucket): Rate limit of the EMT calls, if any.
 
     Returns:
         json: Response of the petition in json format.
@@ -38,22 +53,49 @@ async def get_eta(session: aiohttp, stop_id: str, line_id: str, headers: json) -
         f"https://openapi.emtmadrid.es/v2/transport/busemtmad/stops/{stop_id}/arrives/{line_id}"
     )
 
-    async with session.post(eta_url, headers=headers, json=body) as response:
-        try:
-            return await response.json()
-        except Exception as e:
-            logger.error(f"Error in ETA call stop {stop_id} to the server")
-            logger.error(e)
-            return {"code": -1}
+    try:
+        return await request_json(
+            session,
+            "POST",
+            eta_url,
+            retry=retry,
+            rate_limiter=rate_limiter,
+            headers=headers,
+            json=body,
+        )
+    except Exception as e:
+        logger.error(f"Error in ETA call stop {stop_id} to the server")
+        logger.error(e)
+        return {"code": -1}
+
+
+def is_emt_ok(response: json) -> bool:
+    """Whether an EMT response is a success, the only ones cached.
+
+    Args:
+        response (json): Response of an EMT call.
+
+    Returns:
+        bool: True if its code is "00".
+    """
+    return isinstance(response, dict) and response.get("code") == "00"
 
 
-async def get_filter_emt(config: Settings, stop_id: str, line_id: str):
+async def get_filter_emt(
+    config: Settings, stop_id: str, line_id: str, session: aiohttp.ClientSession = None
+):
     """Get all the data from EMT endpoints.
 
+    The ETA of a stop and line and the calendar of the day are reused from the in-process
+    cache for `sources.filter_cache` seconds, and concurrent identical calls share a single
+    request. The token is only checked when a call is actually made.
+
     Args:
         config (Settings): Object with the config file.
         stop_id (str): The stop id.
         line_id (str): The line id.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the call.
     """
     try:
         # Get the timezone from Madrid and formated the dates for the object_name of the files
@@ -65,39 +107,62 @@ async def get_filter_emt(config: Settings, stop_id: str, line_id: str):
         formatted_date_slash = current_datetime.strftime(
             "%Y/%m/%d"
         )  # formatted date year/month/day for storage in Minio
-
-        access_token = await token_control(
-            config, formatted_date_slash, formatted_date_day
-        )  # Obtain token from EMT
-
-        # Headers for requests to the EMT API
-        headers = {
-            "accessToken": access_token,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-
-        async with aiohttp.ClientSession() as session:
-            # List to store tasks asynchronously
-            calendar_tasks = []
-            eta_tasks = []
-
-            # ETA
-            eta_task = asyncio.ensure_future(get_eta(session, stop_id, line_id, headers))
-
-            eta_tasks.append(eta_task)
-
-            # Calendar
-            calendar_task = asyncio.ensure_future(
-                get_calendar(session, formatted_date_day, formatted_date_day, headers)
-            )
-            calendar_tasks.append(calendar_task)
-
-            eta_responses = await asyncio.gather(*eta_tasks)
-            calendar_responses = await asyncio.gather(*calendar_tasks)
-
-            logger.info("Extracted EMT")
-            return eta_responses[0], calendar_responses[0]
+        ttls = config.sources.filter_cache
+
+        async def emt_headers(emt_session: aiohttp.ClientSession) -> json:
+            access_token = await token_control(
+                config, formatted_date_slash, formatted_date_day, session=emt_session
+            )  # Obtain token from EMT
+
+            # Headers for requests to the EMT API
+            return {
+                "accessToken": access_token,
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+            }
+
+        # Rate limit of the first credential, the one of the token
+        rate_limiter = credential_rate_limiter(config, emt_credentials(config)[0])
+
+        async def fetch_eta() -> json:
+            async with http_session(session, config.sources.emt.http) as emt_session:
+                return await get_eta(
+                    emt_session,
+                    stop_id,
+                    line_id,
+                    await emt_headers(emt_session),
+                    retry=config.sources.emt.retry,
+                    rate_limiter=rate_limiter,
+                )
+
+        async def fetch_calendar() -> json:
+            async with http_session(session, config.sources.emt.http) as emt_session:
+                return await get_calendar(
+                    emt_session,
+                    formatted_date_day,
+                    formatted_date_day,
+                    await emt_headers(emt_session),
+                    retry=config.sources.emt.retry,
+                    rate_limiter=rate_limiter,
+                )
+
+        eta_response, calendar_response = await asyncio.gather(
+            cached_fetch(
+                ("emt_eta", str(stop_id), str(line_id)),
+                ttls.eta,
+                fetch_eta,
+                cacheable=is_emt_ok,
+            ),
+            cached_fetch(
+                ("emt_calendar", formatted_date_day, None),
+                ttls.calendar,
+                fetch_calendar,
+                cacheable=is_emt_ok,
+            ),
+        )
+
+        logger.info("Extracted EMT")
+        return eta_response, calendar_response
 
     except Exception as e:
         logger.error(e)
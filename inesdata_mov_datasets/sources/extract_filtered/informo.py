@@ -2,31 +2,47 @@
 
 import traceback
 
-import requests
-import xmltodict
+import aiohttp
 from loguru import logger
 
+from inesdata_mov_datasets.handlers.response_cache import cached_fetch
 from inesdata_mov_datasets.settings import Settings
+from inesdata_mov_datasets.sources.extract.informo import fetch_informo, parse_informo
+from inesdata_mov_datasets.utils import http_session
 
 
-async def get_filter_informo(config: Settings):
+async def get_filter_informo(config: Settings, session: aiohttp.ClientSession = None):
     """Request informo API to get data from Madrid traffic.
 
+    The parsed data is reused from the in-process cache for `sources.filter_cache.informo`
+    seconds, and concurrent calls share a single request.
+
     Args:
         config (Settings): Object with the config file.
+        session (aiohttp.ClientSession): Shared http session. If not provided, a new one is
+            opened for the call.
+
+    Returns:
+        json: `pms` of the XML, `{"fecha_hora": str, "pm": list}`, with the fields of the
+            measurement points as text, as they are stored by the extraction.
     """
     try:
-        url_informo = "https://informo.madrid.es/informo/tmadrid/pm.xml"
 
-        r = requests.get(url_informo)
+        async def fetch() -> dict:
+            async with http_session(session) as informo_session:
+                content = await fetch_informo(informo_session)
+
+            # Parse XML
+            pms = parse_informo(content)["pms"]
+            return {"fecha_hora": pms["fecha_hora"], "pm": list(pms["pm"])}
 
-        # Parse XML
-        xml_dict = xmltodict.parse(r.content)
-        # await save_informo(config, xml_dict)
+        data = await cached_fetch(
+            ("informo", None, None), config.sources.filter_cache.informo, fetch
+        )
 
         logger.info("Extracted INFORMO")
 
-        return xml_dict["pms"]
+        return data
 
     except Exception as e:
         logger.error(e)
@@ -1,15 +1,39 @@
 """File with utils functions."""
 import asyncio
+import copy
+import gzip
+import io
+import datetime
+import json
 import os
+import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import AsyncIterator, Iterator
 import botocore
+import botocore.exceptions
 from botocore.client import Config as BotoConfig
 import aiofiles.os
+import aiohttp
 import yaml
+from aiobotocore.config import AioConfig
 from aiobotocore.session import ClientCreatorContext, get_session
 from loguru import logger
 
-from inesdata_mov_datasets.settings import Settings
+from inesdata_mov_datasets.settings import Settings, SourceEmtHttpSettings
+
+# Folder, next to the uploaded objects, where each run writes its manifest shard
+MANIFEST_DIR = "_manifest"
+
+# File suffix of the packed (compressed NDJSON) raw layout for each compression
+PACKED_SUFFIXES = {"gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+
+# Default timeouts of the http calls to the sources, in seconds
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10)
+
+# Local json states kept between the runs of the process, by file
+_json_states = {}
+
 
 def list_objs(bucket: str, prefix: str, endpoint_url: str, aws_secret_access_key: str, aws_access_key_id: str) -> list:
     """List objects from s3 bucket.
@@ -41,6 +65,167 @@ def list_objs(bucket: str, prefix: str, endpoint_url: str, aws_secret_access_key
 
     return keys
 
+@asynccontextmanager
+async def s3_client_context(
+    endpoint_url: str,
+    aws_secret_access_key: str,
+    aws_access_key_id: str,
+    client: ClientCreatorContext = None,
+    max_pool_connections: int = 10,
+) -> AsyncIterator[ClientCreatorContext]:
+    """Yield an s3 client, reusing the given one or opening a new one for the block.
+
+    Args:
+        endpoint_url (str): Url of minio bucket.
+        aws_secret_access_key (str): Minio password.
+        aws_access_key_id (str): Minio user.
+        client (ClientCreatorContext): Already opened client. If provided it is yielded
+            as is and it is not closed when the block ends.
+        max_pool_connections (int): Size of the connection pool of a new client.
+
+    Yields:
+        ClientCreatorContext: Client with s3 connection.
+    """
+    if client is not None:
+        yield client
+        return
+
+    session = get_session()
+    async with session.create_client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_secret_access_key=aws_secret_access_key,
+        aws_access_key_id=aws_access_key_id,
+        config=AioConfig(max_pool_connections=max_pool_connections),
+    ) as new_client:
+        yield new_client
+
+
+@asynccontextmanager
+async def storage_client(
+    config: Settings, client: ClientCreatorContext = None
+) -> AsyncIterator[ClientCreatorContext]:
+    """Open the storage context shared by all the s3 calls of an extraction run.
+
+    Args:
+        config (Settings): Object with the config file.
+        client (ClientCreatorContext): Already opened client to reuse, if any.
+
+    Yields:
+        ClientCreatorContext: Client with s3 connection, or None if storage is local.
+    """
+    if config.storage.default != "minio":
+        yield client
+        return
+
+    minio = config.storage.config.minio
+    async with s3_client_context(
+        endpoint_url=minio.endpoint,
+        aws_secret_access_key=minio.secret_key,
+        aws_access_key_id=minio.access_key,
+        client=client,
+        max_pool_connections=minio.max_pool_connections,
+    ) as s3_client:
+        yield s3_client
+
+
+@asynccontextmanager
+async def http_session(
+    session: aiohttp.ClientSession = None, http_settings: SourceEmtHttpSettings = None
+) -> AsyncIterator[aiohttp.ClientSession]:
+    """Yield an http session, reusing the given one or opening a new one for the block.
+
+    Args:
+        session (aiohttp.ClientSession): Already opened session. If provided it is yielded
+            as is and it is not closed when the block ends.
+        http_settings (SourceEmtHttpSettings): Connection pool and timeouts of a new session.
+            If not provided, aiohttp default pool and HTTP_TIMEOUT are used.
+
+    Yields:
+        aiohttp.ClientSession: Session with the http connection pool.
+    """
+    if session is not None:
+        yield session
+        return
+
+    connector = None
+    timeout = HTTP_TIMEOUT
+    if http_settings is not None:
+        connector = aiohttp.TCPConnector(
+            limit=http_settings.limit,
+            limit_per_host=http_settings.limit_per_host,
+            keepalive_timeout=http_settings.keepalive_timeout,
+            ttl_dns_cache=http_settings.ttl_dns_cache,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=http_settings.total_timeout,
+            connect=http_settings.connect_timeout,
+            sock_read=http_settings.read_timeout,
+        )
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as new_session:
+        yield new_session
+
+
+async def list_s3_objs(client: ClientCreatorContext, bucket: str, prefix: str) -> list:
+    """List objects from s3 bucket with an already opened client.
+
+    Args:
+        client (ClientCreatorContext): Client with s3 connection.
+        bucket (str): Name of the bucket.
+        prefix (str): Prefix to list.
+
+    Returns:
+        list: List of the objects listed.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    keys = []
+    async for result in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for c in result.get("Contents", []):
+            keys.append(c.get("Key"))
+
+    return keys
+
+
+async def list_stored_objs(
+    config: Settings, prefixes: list, s3_client: ClientCreatorContext = None
+) -> set:
+    """Build an in-memory index of the objects already stored under some prefixes.
+
+    Keys are relative to the storage root (e.g. ``raw/emt/2024/03/11/calendar/calendar_20240311.json``)
+    for both minio and local storage, so existence checks are set lookups.
+
+    Args:
+        config (Settings): Object with the config file.
+        prefixes (list): Prefixes (directories) to list.
+        s3_client (ClientCreatorContext): Shared client with s3 connection, if any.
+
+    Returns:
+        set: Keys of the stored objects.
+    """
+    stored_objs = set()
+    if config.storage.default == "minio":
+        minio = config.storage.config.minio
+        async with s3_client_context(
+            minio.endpoint, minio.secret_key, minio.access_key, s3_client
+        ) as client:
+            keys_by_prefix = await asyncio.gather(
+                *[list_s3_objs(client, minio.bucket, prefix) for prefix in prefixes]
+            )
+        for keys in keys_by_prefix:
+            stored_objs.update(keys)
+
+    elif config.storage.default == "local":
+        for prefix in prefixes:
+            local_dir = Path(config.storage.config.local.path) / prefix
+            if local_dir.is_dir():
+                stored_objs.update(
+                    (Path(prefix) / name).as_posix() for name in os.listdir(local_dir)
+                )
+
+    return stored_objs
+
+
 def async_download(
     bucket: str,
     prefix: str,
@@ -98,8 +283,8 @@ async def download_obj(
         await aiofiles.os.makedirs(os.path.dirname(os.path.join(output_path, key)), exist_ok=True)
         obj = await get_obj(client, bucket, key)
 
-        async with aiofiles.open(os.path.join(output_path, key), "w") as out:
-            await out.write(obj.decode())
+        async with aiofiles.open(os.path.join(output_path, key), "wb") as out:
+            await out.write(obj)
 
 
 async def download_objs(
@@ -131,19 +316,9 @@ async def download_objs(
         logger.debug("Downloading files from s3")
         
         if "/eta" in prefix:
-            metadata_path = prefix + "metadata.txt"
-            
-            response = await client.get_object(Bucket = bucket, Key = metadata_path)
-            async with response['Body'] as stream:
-                keys = await stream.read()
-                keys = keys.decode('utf-8')
+            keys_list = await read_manifest(client, bucket, prefix)
 
             semaphore = asyncio.BoundedSemaphore(10000)
-            keys_list = keys.split('\n')
-            
-            #eliminate blank strings (EOL)
-            keys_list = [elemento.rstrip() for elemento in keys_list if elemento.rstrip() != '']
-
             tasks = []
             logger.debug(f"Downloading {len(keys_list)} files from emt endpoint")
             completed_tasks_count = 0
@@ -175,6 +350,7 @@ async def read_obj(
     aws_access_key_id: str,
     aws_secret_access_key: str,
     object_name: str,
+    client: ClientCreatorContext = None,
 ) -> str:
     """Read a single object from s3.
 
@@ -184,16 +360,13 @@ async def read_obj(
         aws_access_key_id (str): Minio user.
         aws_secret_access_key (str): Minio password.
         object_name (str): Name of the object.
+        client (ClientCreatorContext): Shared client with s3 connection, if any.
 
     Returns:
         str: Content from object.
     """
-    session = get_session()
-    async with session.create_client(
-        "s3",
-        endpoint_url=endpoint_url,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_access_key_id=aws_access_key_id,
+    async with s3_client_context(
+        endpoint_url, aws_secret_access_key, aws_access_key_id, client
     ) as client:
         resp = await client.get_object(Bucket=bucket, Key=object_name)
         obj = await resp["Body"].read()
@@ -201,55 +374,121 @@ async def read_obj(
         return data_str
 
 
-async def upload_obj(client: ClientCreatorContext, bucket: str, key: str, object_value: str):
+async def upload_obj(
+    client: ClientCreatorContext, bucket: str, key: str, object_value: str | bytes
+):
     """Upload an object to s3.
 
     Args:
         client (ClientCreatorContext): Client with s3 connection.
         bucket (str): Bucket name.
         key (str): Name of the object.
-        object_value (str): Content of the object.
+        object_value (str | bytes): Content of the object.
+    """
+    if isinstance(object_value, str):
+        object_value = object_value.encode("utf-8")
+    await client.put_object(Bucket=bucket, Key=str(key), Body=object_value)
+
+def manifest_shard_name(run_datetime: datetime.datetime) -> str:
+    """Get a name for the manifest shard of a run that no other run can take.
+
+    Two runs of the same minute (a daemon tick and a manual run, or a rerun) must not
+    overwrite each other's shard, so the time of the run is followed by the process id and
+    a random suffix.
+
+    Args:
+        run_datetime (datetime.datetime): Datetime of the run.
+
+    Returns:
+        str: Name of the shard, e.g. 123005_4242_1f3a9c2e.
     """
-    await client.put_object(Bucket=bucket, Key=str(key), Body=object_value.encode("utf-8"))
+    return f"{run_datetime.strftime('%H%M%S')}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+
 
-def upload_metadata(
+async def upload_manifest(
     bucket: str,
     endpoint_url: str,
     aws_access_key_id: str,
     aws_secret_access_key: str,
-    keys: list
+    keys: list,
+    shard_name: str,
+    client: ClientCreatorContext = None,
 ):
-    session = botocore.session.get_session()
-    client = session.create_client(
-        "s3",
-        endpoint_url=endpoint_url,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_access_key_id=aws_access_key_id,
-        use_ssl=False, #TODO Change all s3 function connections to manage the ssl by config parameter
-    )
-    
-    #Get the prefix of the metadata from the first name of the object from the keys list
-    prefix = "/".join(keys[0].split('/')[:-1]) + '/metadata.txt'
-    try:
-        #If file exists in the bucket
-        response = client.get_object(Bucket=bucket, Key=prefix)
-        #Get the previous content of the file
-        content = response['Body'].read().decode('utf-8')
-        #add the new names of files written
-        new_content = content + '\n' + '\n'.join(keys)
-    except :
-        #if metadata file does not exist (first execution of the day)
-        new_content = '\n'.join(keys)
-
-    # upload s3
-    client.put_object(Bucket=bucket, Key=prefix, Body=new_content.encode('utf-8'))
-    
+    """Write the names of the objects uploaded by a run as a new shard of the day's manifest.
+
+    Each run writes its own small ``_manifest/<shard_name>.txt`` object next to the uploaded
+    objects, so the manifest is never read back or rewritten and overlapping runs do not
+    overwrite each other.
+
+    Args:
+        bucket (str): Bucket name.
+        endpoint_url (str): Url of minio bucket.
+        aws_access_key_id (str): Minio user.
+        aws_secret_access_key (str): Minio password.
+        keys (list): Names of the objects uploaded.
+        shard_name (str): Name of the shard, unique per run, see `manifest_shard_name`.
+        client (ClientCreatorContext): Shared client with s3 connection, if any.
+    """
+    async with s3_client_context(
+        endpoint_url, aws_secret_access_key, aws_access_key_id, client
+    ) as client:
+        # Get the prefix of the manifest from the first name of the object from the keys list
+        prefix = "/".join(keys[0].split("/")[:-1])
+        shard_key = f"{prefix}/{MANIFEST_DIR}/{shard_name}.txt"
+        await client.put_object(Bucket=bucket, Key=shard_key, Body="\n".join(keys).encode("utf-8"))
+
+
+async def read_manifest(client: ClientCreatorContext, bucket: str, prefix: str) -> list:
+    """Read the names of the objects listed in all the shards of a day's manifest.
+
+    The legacy ``metadata.txt`` file is also read if present, for days extracted before
+    the manifest was sharded.
+
+    Args:
+        client (ClientCreatorContext): Client with s3 connection.
+        bucket (str): Bucket name.
+        prefix (str): Path to raw data directory from minio.
+
+    Returns:
+        list: Names of the objects, without duplicates.
+
+    Raises:
+        botocore.exceptions.ClientError: If a shard, or an existing ``metadata.txt``, cannot
+            be read.
+    """
+    shard_keys = await list_s3_objs(client, bucket, f"{prefix}{MANIFEST_DIR}/")
+
+    async def read_shard(key: str) -> str:
+        return (await get_obj(client, bucket, key)).decode("utf-8")
+
+    async def read_legacy_metadata() -> str:
+        try:
+            return await read_shard(prefix + "metadata.txt")
+        except botocore.exceptions.ClientError as e:
+            # Only days extracted before the manifest was sharded have it
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return ""
+            raise
+
+    # A shard that cannot be read fails the read, its keys are never silently dropped
+    shards = await asyncio.gather(*[read_shard(key) for key in shard_keys], read_legacy_metadata())
+
+    # eliminate blank strings (EOL) and keys written by several shards
+    keys = {}
+    for shard in shards:
+        for line in shard.split("\n"):
+            if line.rstrip() != "":
+                keys[line.rstrip()] = None
+    return list(keys)
+
+
 async def upload_objs(
     bucket: str,
     endpoint_url: str,
     aws_access_key_id: str,
     aws_secret_access_key: str,
     objects_dict: dict,
+    client: ClientCreatorContext = None,
 ):
     """Upload objects to s3.
 
@@ -259,13 +498,10 @@ async def upload_objs(
         aws_access_key_id (str): Minio user.
         aws_secret_access_key (str): Minio password.
         objects_dict (dict): Dict ofobjects to upload.
+        client (ClientCreatorContext): Shared client with s3 connection, if any.
     """
-    session = get_session()
-    async with session.create_client(
-        "s3",
-        endpoint_url=endpoint_url,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_access_key_id=aws_access_key_id,
+    async with s3_client_context(
+        endpoint_url, aws_secret_access_key, aws_access_key_id, client
     ) as client:
         keys = objects_dict.keys()
         tasks = [upload_obj(client, bucket, key, objects_dict[key]) for key in keys]
@@ -304,12 +540,64 @@ def check_local_file_exists(path_dir: Path, object_name: str) -> bool:
         return False
 
 
+def read_json_state(path: Path, defaults: dict = None, memoize: bool = False) -> dict:
+    """Read a local json file with the state kept between runs.
+
+    Args:
+        path (Path): Local file with the state.
+        defaults (dict): Keys set in the state when it does not have them.
+        memoize (bool): Keep the state in memory, so the next calls with the same path return
+            the same dict, with the changes made by the process.
+
+    Returns:
+        dict: State of the file, empty (plus defaults) if there is no valid state file.
+    """
+    if memoize and str(path) in _json_states:
+        return _json_states[str(path)]
+    state = {}
+    try:
+        with open(path, "r") as file:
+            state = json.loads(file.read())
+        if not isinstance(state, dict):
+            raise ValueError("the state is not a json object")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring state file {path}: {e}")
+        state = {}
+    for key, value in (defaults or {}).items():
+        state.setdefault(key, copy.deepcopy(value))
+    if memoize:
+        _json_states[str(path)] = state
+    return state
+
+
+def write_json_state(path: Path, state: dict):
+    """Save a local json file with the state for the next runs.
+
+    If the state of the file is kept in memory, it is replaced by the saved one.
+
+    Args:
+        path (Path): Local file with the state.
+        state (dict): State to save.
+    """
+    if str(path) in _json_states:
+        _json_states[str(path)] = state
+    os.makedirs(Path(path).parent, exist_ok=True)
+    # Write and rename, a concurrent run never reads a half written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(json.dumps(state))
+    os.replace(tmp_path, path)
+
+
 async def check_s3_file_exists(
     endpoint_url: str,
     aws_secret_access_key: str,
     aws_access_key_id: str,
     bucket_name: str,
     object_name: str,
+    client: ClientCreatorContext = None,
 ) -> bool:
     """Check if a file exists in an S3 bucket.
 
@@ -319,19 +607,80 @@ async def check_s3_file_exists(
         aws_access_key_id (str): The AWS access key ID.
         bucket_name (str): Bucket name.
         object_name (str): Object name.
+        client (ClientCreatorContext): Shared client with s3 connection, if any.
 
     Returns:
         bool: True if file is detected, False otherwise.
     """
-    session = get_session()
-    async with session.create_client(
-        "s3",
-        endpoint_url=endpoint_url,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_access_key_id=aws_access_key_id,
+    async with s3_client_context(
+        endpoint_url, aws_secret_access_key, aws_access_key_id, client
     ) as client:
         try:
             await client.head_object(Bucket=bucket_name, Key=object_name)
             return True
         except:
             return False
+
+
+def _import_zstandard():
+    """Import the optional zstandard package, needed for the zstd packed layout."""
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstd compression requires the zstandard package: pip install zstandard"
+        ) from e
+    return zstandard
+
+
+def is_packed_file(name: str) -> bool:
+    """Check if a raw file uses the packed (compressed NDJSON) layout.
+
+    Args:
+        name (str): Name of the file.
+
+    Returns:
+        bool: True if the file is packed, False otherwise.
+    """
+    return str(name).endswith(tuple(PACKED_SUFFIXES.values()))
+
+
+def pack_ndjson(records: list, compression: str = "gzip") -> bytes:
+    """Serialize records as newline-delimited JSON and compress them.
+
+    Args:
+        records (list): Json serializable records, one per line. Records already encoded
+            as a json line (bytes) are written as they are.
+        compression (str): Compression to use: gzip or zstd.
+
+    Returns:
+        bytes: Compressed NDJSON content.
+    """
+    data = b"\n".join(
+        record if isinstance(record, bytes) else json.dumps(record).encode("utf-8")
+        for record in records
+    )
+    if compression == "gzip":
+        return gzip.compress(data)
+    elif compression == "zstd":
+        return _import_zstandard().ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression {compression}, use gzip or zstd")
+
+
+def read_ndjson(path: Path) -> Iterator[dict]:
+    """Read the records of a packed file, detecting the compression from its suffix.
+
+    Args:
+        path (Path): Path of the packed file.
+
+    Yields:
+        dict: Each record of the file.
+    """
+    with open(path, "rb") as raw:
+        if str(path).endswith(PACKED_SUFFIXES["zstd"]):
+            stream = _import_zstandard().ZstdDecompressor().stream_reader(raw)
+        else:
+            stream = gzip.GzipFile(fileobj=raw)
+        for line in io.TextIOWrapper(stream, encoding="utf-8"):
+            if line.strip():
+                yield json.loads(line)
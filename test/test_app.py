@@ -1,3 +1,5 @@
+from unittest.mock import AsyncMock, patch
+
 from typer.testing import CliRunner
 
 from inesdata_mov_datasets.__main__ import app
@@ -41,3 +43,10 @@ def test_command_extract():
     result = runner.invoke(app, ["create", "--config-path", "config.yaml", "--sources", bad_source])
     assert result.exit_code == 2
     assert """Invalid value for '--sources': '{}' is not one of 'all', 'emt',""".format(bad_source) in result.stdout
+
+def test_command_extract_daemon():
+    # if --daemon is provided, the daemon is run with the selected sources.
+    with patch("inesdata_mov_datasets.__main__.run_daemon", new_callable=AsyncMock) as mock_run_daemon:
+        result = runner.invoke(app, ["extract", "--config-path", "config.yaml", "--sources", "informo", "--daemon"])
+    assert result.exit_code == 0
+    assert mock_run_daemon.await_args.args[1] == ["informo"]
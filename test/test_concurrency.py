@@ -0,0 +1,84 @@
+import pytest
+import asyncio
+import json
+from inesdata_mov_datasets.handlers.concurrency import AimdLimiter
+from inesdata_mov_datasets.settings import SourceEmtConcurrencySettings
+
+
+@pytest.fixture
+def concurrency_settings():
+    """Fixture con los parámetros del limitador."""
+    return SourceEmtConcurrencySettings(
+        initial_limit=4, min_limit=2, max_limit=5, decrease_factor=0.5, latency_target=10
+    )
+
+
+###################### AimdLimiter
+def test_aimd_limiter_bounds(concurrency_settings):
+    """Test para verificar que el límite inicial se ajusta a los límites configurados."""
+    assert AimdLimiter(concurrency_settings).limit == 4
+    assert AimdLimiter(concurrency_settings, 100).limit == 5
+    assert AimdLimiter(concurrency_settings, 0).limit == 2
+
+
+@pytest.mark.asyncio
+async def test_aimd_limiter_additive_increase(concurrency_settings):
+    """Test para verificar que las llamadas rápidas y correctas aumentan el límite poco a poco."""
+    limiter = AimdLimiter(concurrency_settings)
+    for _ in range(4):
+        start = await limiter.acquire()
+        await limiter.release(start, overloaded=False)
+
+    assert 4.9 < limiter.limit <= 5
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_aimd_limiter_multiplicative_decrease_once(concurrency_settings):
+    """Test para verificar que una ráfaga de errores reduce el límite una sola vez."""
+    limiter = AimdLimiter(concurrency_settings)
+    starts = [await limiter.acquire() for _ in range(4)]
+    for start in starts:
+        await limiter.release(start, overloaded=True)
+
+    assert limiter.limit == 2
+
+    # Una llamada posterior a la reducción vuelve a reducir, sin bajar del mínimo
+    start = await limiter.acquire()
+    await limiter.release(start, overloaded=True)
+    assert limiter.limit == 2
+
+
+@pytest.mark.asyncio
+async def test_aimd_limiter_waits_for_slot(concurrency_settings):
+    """Test para verificar que no se superan las llamadas en curso permitidas."""
+    limiter = AimdLimiter(concurrency_settings, 2)
+    first = await limiter.acquire()
+    await limiter.acquire()
+
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    await limiter.release(first, overloaded=False)
+    await asyncio.wait_for(waiting, 1)
+    assert limiter.in_flight == 2
+
+
+def test_aimd_limiter_save_and_load(concurrency_settings, tmp_path):
+    """Test para verificar que el límite se conserva entre ejecuciones."""
+    state_path = tmp_path / "state" / "emt_concurrency.json"
+    limiter = AimdLimiter(concurrency_settings, 3.5)
+    limiter.save(state_path)
+
+    assert json.loads(state_path.read_text())["limit"] == 3.5
+    assert AimdLimiter.load(concurrency_settings, state_path).limit == 3.5
+
+
+def test_aimd_limiter_load_missing_or_invalid(concurrency_settings, tmp_path):
+    """Test para verificar que sin estado válido se usa el límite inicial."""
+    assert AimdLimiter.load(concurrency_settings, tmp_path / "missing.json").limit == 4
+
+    state_path = tmp_path / "emt_concurrency.json"
+    state_path.write_text("not json")
+    assert AimdLimiter.load(concurrency_settings, state_path).limit == 4
@@ -54,6 +54,39 @@ def test_generate_df_from_file_success():
     assert result_df["temperatura_value"].iloc[0] == 15
     assert result_df["viento_value"].iloc[0] == 10
 
+def test_generate_df_from_file_elaborado():
+    """Test para verificar que se añade la fecha de elaboración de la predicción."""
+    mock_content = [{
+        "elaborado": "2024-10-07T12:00:00",
+        "prediccion": {
+            "dia": [{
+                "fecha": "2024/10/07",
+                "temperatura": [{"periodo": 0, "value": 15}],
+            }]
+        }
+    }]
+
+    result_df = generate_df_from_file(mock_content, "2024/10/07")
+
+    assert list(result_df["elaborado"]) == ["2024-10-07T12:00:00"]
+
+def test_generate_df_from_file_municipality():
+    """Test para verificar que se añade el municipio de la predicción."""
+    mock_content = [{
+        "id": "28005",
+        "nombre": "Alcalá de Henares",
+        "prediccion": {
+            "dia": [{
+                "fecha": "2024/10/07",
+                "temperatura": [{"periodo": 0, "value": 15}, {"periodo": 1, "value": 14}],
+            }]
+        }
+    }]
+
+    result_df = generate_df_from_file(mock_content, "2024/10/07")
+
+    assert list(result_df["municipality"]) == ["28005", "28005"]
+
 # Caso con predicción vacía
 def test_generate_df_from_file_empty_prediction():
     """Test cuando no hay predicción en el contenido."""
@@ -9,6 +9,7 @@ from unittest.mock import patch, mock_open, MagicMock
 from pydantic import BaseModel
 from inesdata_mov_datasets.sources.create.emt import generate_calendar_df_from_file, generate_calendar_day_df, create_calendar_emt, generate_line_df_from_file, generate_line_day_df, create_line_detail_emt, generate_eta_df_from_file, generate_eta_day_df, create_eta_emt, join_calendar_line_datasets, join_eta_dataset, create_emt
 from inesdata_mov_datasets.settings import Settings
+from inesdata_mov_datasets.utils import pack_ndjson
 
 ###################### generate_calendar_df_from_file
 def test_generate_calendar_df_from_file():
@@ -470,6 +471,59 @@ def test_generate_eta_day_df_no_files(mock_storage_path):
     # Verifica que el DataFrame resultante esté vacío
     assert result_df.empty
 
+def test_generate_eta_day_df_packed(mock_storage_path):
+    """Test para verificar la lectura del formato empaquetado (NDJSON comprimido) junto a ficheros JSON sueltos."""
+    def eta_content(stop, bus, datetime_str):
+        return {
+            "code": "00",
+            "data": [{"Arrive": [{"line": 10, "stop": stop, "bus": bus, "geometry": {"coordinates": [10.0, 20.0]}}]}],
+            "datetime": datetime_str,
+        }
+
+    raw_storage_dir = Path(mock_storage_path) / "raw" / "emt" / "2024/10/08" / "eta"
+    raw_storage_dir.mkdir(parents=True)
+    records = [
+        {"stop_id": 1, "datetime": "2024-10-08T09:00:00+02:00", "response": eta_content(1, 100, "2024-10-08T09:00:00")},
+        {"stop_id": 2, "datetime": "2024-10-08T09:00:00+02:00", "response": eta_content(2, 200, "2024-10-08T09:00:00")},
+    ]
+    (raw_storage_dir / "eta_2024-10-08T0900.ndjson.gz").write_bytes(pack_ndjson(records, "gzip"))
+    with open(raw_storage_dir / "eta_3_2024-10-08T0901.json", "w") as f:
+        json.dump(eta_content(3, 300, "2024-10-08T09:01:00"), f)
+
+    result_df = generate_eta_day_df(mock_storage_path, "2024/10/08")
+
+    assert result_df.shape[0] == 3
+    assert sorted(result_df["stop"].tolist()) == [1, 2, 3]
+
+def test_generate_eta_day_df_references(mock_storage_path):
+    """Test para verificar que las instantáneas guardadas como referencia se expanden con su fecha."""
+    def eta_content(stop, bus, datetime_str):
+        return {
+            "code": "00",
+            "data": [{"Arrive": [{"line": 10, "stop": stop, "bus": bus, "geometry": {"coordinates": [10.0, 20.0]}}]}],
+            "datetime": datetime_str,
+        }
+
+    raw_storage_dir = Path(mock_storage_path) / "raw" / "emt" / "2024/10/08" / "eta"
+    raw_storage_dir.mkdir(parents=True)
+    # Formato por fichero: la parada 1 no cambia en el minuto siguiente
+    with open(raw_storage_dir / "eta_1_2024-10-08T0900.json", "w") as f:
+        json.dump(eta_content(1, 100, "2024-10-08T09:00:00"), f)
+    with open(raw_storage_dir / "eta_1_2024-10-08T0901.json", "w") as f:
+        json.dump({"code": "00", "datetime": "2024-10-08T09:01:00", "stop_id": 1, "ref": "eta_1_2024-10-08T0900.json"}, f)
+    # Formato empaquetado: la parada 2 no cambia en el minuto siguiente
+    records = [{"stop_id": 2, "datetime": "2024-10-08T09:00:00+02:00", "response": eta_content(2, 200, "2024-10-08T09:00:00")}]
+    (raw_storage_dir / "eta_2024-10-08T0900.ndjson.gz").write_bytes(pack_ndjson(records, "gzip"))
+    reference = {"code": "00", "datetime": "2024-10-08T09:01:00", "stop_id": 2, "ref": "eta_2024-10-08T0900.ndjson.gz"}
+    records = [{"stop_id": 2, "datetime": "2024-10-08T09:01:00+02:00", "response": reference}]
+    (raw_storage_dir / "eta_2024-10-08T0901.ndjson.gz").write_bytes(pack_ndjson(records, "gzip"))
+
+    result_df = generate_eta_day_df(mock_storage_path, "2024/10/08")
+
+    assert result_df.shape[0] == 4
+    assert sorted(result_df["stop"].tolist()) == [1, 1, 2, 2]
+    assert sorted(result_df["datetime"].astype(str).unique().tolist()) == ["2024-10-08 09:00:00", "2024-10-08 09:01:00"]
+
 ###################### create_eta_emt
 @pytest.fixture
 def settings_create_eta_emt():
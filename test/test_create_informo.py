@@ -4,6 +4,7 @@ from unittest.mock import patch, MagicMock, mock_open
 from pathlib import Path
 from datetime import datetime
 from inesdata_mov_datasets.sources.create.informo import generate_df_from_file, generate_day_df, create_informo
+from inesdata_mov_datasets.sources.extract.informo import parse_informo
 
 ###################### generate_df_from_file
 @patch('inesdata_mov_datasets.sources.create.informo.logger')  # Parchea el logger para evitar la salida real en los tests
@@ -68,6 +69,16 @@ def test_generate_df_from_file_no_pm_key(mock_logger):
     # Verificar que el DataFrame resultante está vacío
     assert result_df.empty, "El DataFrame no debe estar vacío si falta la clave 'pm'"
 
+def test_generate_df_from_file_parsed_xml():
+    """Test para verificar la generación de DataFrame directamente desde el XML de Informo."""
+    content = b"<pms><fecha_hora>01/10/2024 12:00:00</fecha_hora><pm><idelem>1</idelem><intensidad>10</intensidad></pm><pm><idelem>2</idelem><intensidad>15</intensidad></pm></pms>"
+
+    result_df = generate_df_from_file(parse_informo(content)["pms"])
+
+    assert list(result_df["idelem"]) == ["1", "2"]
+    assert list(result_df["intensidad"]) == ["10", "15"]
+    assert (result_df["datetime"] == pd.Timestamp(2024, 10, 1, 12)).all()
+
 ###################### generate_day_df
 @patch('inesdata_mov_datasets.sources.create.informo.logger')
 @patch('inesdata_mov_datasets.sources.create.informo.os.listdir')
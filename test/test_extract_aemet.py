@@ -1,10 +1,11 @@
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
-import requests
+from aioresponses import aioresponses
 import datetime
 from pathlib import Path
 import pytz
-from inesdata_mov_datasets.sources.extract.aemet import get_aemet, save_aemet  # Cambia esto por el nombre real de tu módulo
+from inesdata_mov_datasets.sources.extract.aemet import aemet_object_name, get_aemet, save_aemet  # Cambia esto por el nombre real de tu módulo
+from inesdata_mov_datasets.settings import SourceAemetRefreshSettings, RateLimitSettings
 
 ###################### get_aemet
 @pytest.fixture
@@ -14,26 +15,31 @@ def mock_settings():
     settings.sources = MagicMock()
     settings.sources.aemet.credentials = MagicMock()
     settings.sources.aemet.credentials.api_key = "test-api-key"
+    settings.sources.aemet.municipalities = ["28079"]
+    settings.sources.aemet.rate_limit = RateLimitSettings(rate=1000, burst=1000)
     return settings
 
+AEMET_URL = "https://opendata.aemet.es/opendata/api/prediccion/especifica/municipio/horaria/28079"
+
 @patch('inesdata_mov_datasets.sources.extract.aemet.instantiate_logger')  # Cambia esto por el nombre real de tu módulo
 @patch('inesdata_mov_datasets.sources.extract.aemet.logger.info')  # Cambia esto por el nombre real de tu módulo
 @patch('inesdata_mov_datasets.sources.extract.aemet.logger.debug')  # Cambia esto por el nombre real de tu módulo
 @patch('inesdata_mov_datasets.sources.extract.aemet.logger.error')  # Cambia esto por el nombre real de tu módulo
-@patch('inesdata_mov_datasets.sources.extract.aemet.requests.get')  # Cambia esto por el nombre real de tu módulo
 @patch('inesdata_mov_datasets.sources.extract.aemet.save_aemet')  # Cambia esto por el nombre real de tu módulo
 @pytest.mark.asyncio
-async def test_get_aemet(mock_save_aemet, mock_requests_get, mock_error, mock_debug, mock_info, mock_instantiate_logger, mock_settings):
+async def test_get_aemet(mock_save_aemet, mock_error, mock_debug, mock_info, mock_instantiate_logger, mock_settings):
     """Test para verificar la extracción de datos de AEMET."""
     
-    # Configura la respuesta simulada de requests.get
-    mock_requests_get.side_effect = [
-        MagicMock(status_code=200, json=lambda: {"datos": "https://example.com/aemet_data.json"}),  # Primera llamada para la URL de AEMET
-        MagicMock(status_code=200, json=lambda: {"temperature": 22})  # Segunda llamada para los datos
-    ]
+    with aioresponses() as m:
+        # Primera llamada para la URL de AEMET y segunda llamada para los datos
+        m.get(AEMET_URL, payload={"datos": "https://example.com/aemet_data.json"})
+        m.get("https://example.com/aemet_data.json", body='{"temperature": 22}', content_type="text/plain")
 
-    # Ejecutar la función
-    await get_aemet(mock_settings)
+        # Ejecutar la función
+        await get_aemet(mock_settings)
+
+        # Verificar que se hacen las dos llamadas
+        assert len(m.requests) == 2
 
     # Verificar que se llama a instantiate_logger
     mock_instantiate_logger.assert_called_once_with(mock_settings, "AEMET", "extract")
@@ -42,15 +48,106 @@ async def test_get_aemet(mock_save_aemet, mock_requests_get, mock_error, mock_de
     mock_info.assert_any_call("Extracting AEMET")
     mock_info.assert_any_call("Extracted AEMET")
 
-    # Verificar que se llama a requests.get dos veces
-    assert mock_requests_get.call_count == 2
-
     # Verificar que se llama a save_aemet con los datos obtenidos
-    mock_save_aemet.assert_called_once_with(mock_settings, {"temperature": 22})
+    mock_save_aemet.assert_called_once_with(
+        mock_settings, {"temperature": 22}, s3_client=None, stored_objs=set(), municipality="28079"
+    )
 
     # Verificar que se llama a logger.debug
     mock_debug.assert_called()
 
+@patch('inesdata_mov_datasets.sources.extract.aemet.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.aemet.logger.error')
+@patch('inesdata_mov_datasets.sources.extract.aemet.save_aemet')
+@pytest.mark.asyncio
+async def test_get_aemet_http_error(mock_save_aemet, mock_error, mock_instantiate_logger, mock_settings):
+    """Test para verificar que un error HTTP de AEMET se registra y no se guarda nada."""
+
+    with aioresponses() as m:
+        m.get(AEMET_URL, status=500)
+
+        await get_aemet(mock_settings)
+
+    assert mock_error.call_count == 2
+    mock_save_aemet.assert_not_called()
+
+@patch('inesdata_mov_datasets.sources.extract.aemet.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.aemet.list_stored_objs')
+@patch('inesdata_mov_datasets.sources.extract.aemet.save_aemet')
+@pytest.mark.asyncio
+async def test_get_aemet_already_stored(mock_save_aemet, mock_list_stored_objs, mock_instantiate_logger, mock_settings):
+    """Test para verificar que no se llama a AEMET si la predicción del día ya está guardada."""
+    current_datetime = datetime.datetime.now(pytz.timezone("Europe/Madrid"))
+    mock_list_stored_objs.return_value = {
+        f"raw/aemet/{current_datetime.strftime('%Y/%m/%d')}/aemet_{current_datetime.strftime('%Y%m%d')}.json"
+    }
+
+    with aioresponses() as m:
+        await get_aemet(mock_settings)
+
+        # Verificar que no se hace ninguna llamada
+        assert len(m.requests) == 0
+
+    mock_save_aemet.assert_not_called()
+
+@patch('inesdata_mov_datasets.sources.extract.aemet.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.aemet.list_stored_objs')
+@patch('inesdata_mov_datasets.sources.extract.aemet.save_aemet')
+@pytest.mark.asyncio
+async def test_get_aemet_municipalities(mock_save_aemet, mock_list_stored_objs, mock_instantiate_logger, mock_settings):
+    """Test para verificar que se extraen varios municipios y se omiten los ya guardados."""
+    current_datetime = datetime.datetime.now(pytz.timezone("Europe/Madrid"))
+    mock_settings.sources.aemet.municipalities = ["28079", "28005", "28006"]
+    mock_list_stored_objs.return_value = {
+        f"raw/aemet/{current_datetime.strftime('%Y/%m/%d')}/aemet_28006_{current_datetime.strftime('%Y%m%d')}.json"
+    }
+    base_url = AEMET_URL.rsplit("/", 1)[0]
+
+    with aioresponses() as m:
+        for municipality in ["28079", "28005"]:
+            m.get(f"{base_url}/{municipality}", payload={"datos": f"https://example.com/{municipality}.json"})
+            m.get(f"https://example.com/{municipality}.json", payload=[{"id": municipality}])
+
+        await get_aemet(mock_settings)
+
+        # Dos llamadas por cada municipio que no está guardado
+        assert len(m.requests) == 4
+
+    saved = sorted(call.kwargs["municipality"] for call in mock_save_aemet.call_args_list)
+    assert saved == ["28005", "28079"]
+    for call in mock_save_aemet.call_args_list:
+        assert call.args[1] == [{"id": call.kwargs["municipality"]}]
+
+
+###################### aemet_object_name
+def test_aemet_object_name():
+    """Test para verificar el nombre de la predicción según la política de refresco."""
+    config = MagicMock()
+    current_datetime = datetime.datetime(2024, 10, 9, 14, 35)
+    forecast = [{"elaborado": "2024-10-09T12:00:00"}]
+
+    config.sources.aemet.refresh = SourceAemetRefreshSettings()
+    assert aemet_object_name(config, current_datetime) == "raw/aemet/2024/10/09/aemet_20241009.json"
+
+    config.sources.aemet.refresh = SourceAemetRefreshSettings(policy="hours", hours=6)
+    assert aemet_object_name(config, current_datetime) == "raw/aemet/2024/10/09/aemet_20241009T1200.json"
+
+    # La versión de la predicción solo se conoce tras descargarla
+    config.sources.aemet.refresh = SourceAemetRefreshSettings(policy="vintage")
+    assert aemet_object_name(config, current_datetime) is None
+    assert aemet_object_name(config, current_datetime, forecast) == "raw/aemet/2024/10/09/aemet_20241009T1200.json"
+
+
+def test_aemet_object_name_municipality():
+    """Test para verificar que el nombre incluye el municipio salvo para Madrid."""
+    config = MagicMock()
+    config.sources.aemet.refresh = SourceAemetRefreshSettings()
+    current_datetime = datetime.datetime(2024, 10, 9, 14, 35)
+
+    assert aemet_object_name(config, current_datetime, municipality="28079") == "raw/aemet/2024/10/09/aemet_20241009.json"
+    assert aemet_object_name(config, current_datetime, municipality="28005") == "raw/aemet/2024/10/09/aemet_28005_20241009.json"
+
+
 ###################### save_aemet
 @pytest.fixture
 def mock_settings_minio():
@@ -75,12 +172,12 @@ def mock_settings_local():
     return settings
 
 @patch('inesdata_mov_datasets.sources.extract.aemet.upload_objs')  # Cambia esto por el nombre real de tu módulo
-@patch('inesdata_mov_datasets.sources.extract.aemet.check_s3_file_exists')  # Cambia esto por el nombre real de tu módulo
+@patch('inesdata_mov_datasets.sources.extract.aemet.list_stored_objs')  # Cambia esto por el nombre real de tu módulo
 @patch('inesdata_mov_datasets.sources.extract.aemet.logger.debug')  # Cambia esto por el nombre real de tu módulo
 @pytest.mark.asyncio
-async def test_save_aemet_minio(mock_debug, mock_check_s3_file_exists, mock_upload_objs, mock_settings_minio):
+async def test_save_aemet_minio(mock_debug, mock_list_stored_objs, mock_upload_objs, mock_settings_minio):
     """Test para verificar la funcionalidad de guardar datos de AEMET en MinIO."""
-    mock_check_s3_file_exists.return_value = False  
+    mock_list_stored_objs.return_value = set()  # Simulamos que el archivo no existe
     data = {"temperature": 22}  # Datos de prueba
 
     # Ejecutar la función
@@ -88,50 +185,72 @@ async def test_save_aemet_minio(mock_debug, mock_check_s3_file_exists, mock_uplo
 
     europe_timezone = pytz.timezone("Europe/Madrid")
     current_datetime = datetime.datetime.now(europe_timezone).replace(second=0)
-    formatted_date_day = current_datetime.strftime(
-        "%Y%m%d"
-    )  # formatted date year|month|day all together
     formatted_date_slash = current_datetime.strftime(
         "%Y/%m/%d"
     )
-    # Verificar que check_s3_file_exists fue llamado con los parámetros correctos
-    mock_check_s3_file_exists.assert_called_once_with(
-        endpoint_url=mock_settings_minio.storage.config.minio.endpoint,
-        aws_secret_access_key=mock_settings_minio.storage.config.minio.secret_key,
-        aws_access_key_id=mock_settings_minio.storage.config.minio.access_key,
-        bucket_name=mock_settings_minio.storage.config.minio.bucket,
-        object_name=f"raw/aemet/{formatted_date_slash}/aemet_{formatted_date_day}.json"  # Aquí se puede especificar el objeto esperado, si es necesario
+    # Verificar que se listan los objetos del día con los parámetros correctos
+    mock_list_stored_objs.assert_called_once_with(
+        mock_settings_minio, [f"raw/aemet/{formatted_date_slash}/"], s3_client=None
     )
 
     # Verificar que se llama a upload_objs
     mock_upload_objs.assert_called_once()
 
 @patch('inesdata_mov_datasets.sources.extract.aemet.upload_objs')  # Cambia esto por el nombre real de tu módulo
-@patch('inesdata_mov_datasets.sources.extract.aemet.check_local_file_exists')  # Cambia esto por el nombre real de tu módulo
 @patch('inesdata_mov_datasets.sources.extract.aemet.logger.debug')  # Cambia esto por el nombre real de tu módulo
 @pytest.mark.asyncio
-async def test_save_aemet_local(mock_debug, mock_check_local_file_exists, mock_upload_objs, mock_settings_local):
+async def test_save_aemet_minio_already_stored(mock_debug, mock_upload_objs, mock_settings_minio):
+    """Test para verificar que no se sube de nuevo la predicción si ya está en el índice del día."""
+    europe_timezone = pytz.timezone("Europe/Madrid")
+    current_datetime = datetime.datetime.now(europe_timezone).replace(second=0)
+    formatted_date_day = current_datetime.strftime("%Y%m%d")
+    formatted_date_slash = current_datetime.strftime("%Y/%m/%d")
+    stored_objs = {f"raw/aemet/{formatted_date_slash}/aemet_{formatted_date_day}.json"}
+
+    # Ejecutar la función
+    await save_aemet(mock_settings_minio, {"temperature": 22}, stored_objs=stored_objs)
+
+    # Verificar que no se llama a upload_objs
+    mock_upload_objs.assert_not_called()
+    mock_debug.assert_called_with("Already called AEMET today")
+
+@patch('inesdata_mov_datasets.sources.extract.aemet.upload_objs')  # Cambia esto por el nombre real de tu módulo
+@patch('inesdata_mov_datasets.sources.extract.aemet.list_stored_objs')  # Cambia esto por el nombre real de tu módulo
+@patch('inesdata_mov_datasets.sources.extract.aemet.logger.debug')  # Cambia esto por el nombre real de tu módulo
+@pytest.mark.asyncio
+async def test_save_aemet_local(mock_debug, mock_list_stored_objs, mock_upload_objs, mock_settings_local):
     """Test para verificar la funcionalidad de guardar datos de AEMET localmente."""
-    mock_check_local_file_exists.return_value = False  # Simulamos que el archivo no existe
+    mock_list_stored_objs.return_value = set()  # Simulamos que el archivo no existe
     data = {"temperature": 22}  # Datos de prueba
 
     # Ejecutar la función
     await save_aemet(mock_settings_local, data)
     europe_timezone = pytz.timezone("Europe/Madrid")
     current_datetime = datetime.datetime.now(europe_timezone).replace(second=0)
-    formatted_date_day = current_datetime.strftime(
-        "%Y%m%d"
-    )  # formatted date year|month|day all together
     formatted_date_slash = current_datetime.strftime(
         "%Y/%m/%d"
     )
 
-    # Verificar que check_local_file_exists fue llamado con los parámetros correctos
-    mock_check_local_file_exists.assert_called_once_with(
-        Path(f"/tmp/raw/aemet/{formatted_date_slash}"),
-        f"aemet_{formatted_date_day}.json"  # Aquí se puede especificar el objeto esperado, si es necesario
+    # Verificar que se listan los objetos del día con los parámetros correctos
+    mock_list_stored_objs.assert_called_once_with(
+        mock_settings_local, [f"raw/aemet/{formatted_date_slash}/"], s3_client=None
     )
 
     # Verificar que no se llama a upload_objs, ya que se guarda localmente
     mock_upload_objs.assert_not_called()
 
+
+@patch('inesdata_mov_datasets.sources.extract.aemet.list_stored_objs', return_value=set())
+@pytest.mark.asyncio
+async def test_save_aemet_vintage_local(mock_list_stored_objs, tmp_path):
+    """Test para verificar que con la política vintage se guarda cada predicción publicada."""
+    settings = MagicMock()
+    settings.storage.default = "local"
+    settings.storage.config.local.path = str(tmp_path)
+    settings.sources.aemet.refresh = SourceAemetRefreshSettings(policy="vintage")
+
+    await save_aemet(settings, [{"elaborado": "2024-10-09T12:00:00"}])
+    await save_aemet(settings, [{"elaborado": "2024-10-09T18:00:00"}])
+
+    stored = sorted(path.name for path in tmp_path.glob("raw/aemet/*/*/*/*.json"))
+    assert stored == ["aemet_20241009T1200.json", "aemet_20241009T1800.json"]
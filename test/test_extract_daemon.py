@@ -0,0 +1,184 @@
+import pytest
+import asyncio
+import datetime
+import pytz
+from unittest.mock import AsyncMock, MagicMock, patch
+from inesdata_mov_datasets.sources.extract.daemon import (
+    due_sources,
+    extract_source,
+    extract_sources,
+    next_minute,
+    run_daemon,
+    sleep_until,
+)
+
+SOURCES = ["emt", "aemet", "informo"]
+
+
+###################### due_sources
+def test_due_sources_every_minute():
+    """Test para verificar que en un minuto cualquiera solo toca EMT."""
+    tick = datetime.datetime(2024, 3, 11, 10, 7)
+    assert due_sources(tick, SOURCES, 60) == ["emt"]
+
+
+def test_due_sources_informo_every_five_minutes():
+    """Test para verificar que Informo se extrae en los múltiplos de 5 minutos."""
+    tick = datetime.datetime(2024, 3, 11, 10, 35)
+    assert due_sources(tick, SOURCES, 60) == ["emt", "informo"]
+
+
+def test_due_sources_aemet_cadence():
+    """Test para verificar que AEMET respeta la cadencia configurada."""
+    assert due_sources(datetime.datetime(2024, 3, 11, 10, 0), SOURCES, 60) == SOURCES
+    assert due_sources(datetime.datetime(2024, 3, 11, 10, 30), SOURCES, 60) == ["emt", "informo"]
+    assert due_sources(datetime.datetime(2024, 3, 11, 10, 30), SOURCES, 30) == SOURCES
+
+
+def test_due_sources_selected():
+    """Test para verificar que solo se devuelven las fuentes seleccionadas."""
+    tick = datetime.datetime(2024, 3, 11, 10, 0)
+    assert due_sources(tick, ["informo"], 60) == ["informo"]
+
+
+###################### next_minute
+def test_next_minute():
+    """Test para verificar el siguiente límite de minuto."""
+    now = datetime.datetime(2024, 3, 11, 10, 59, 42, 1234)
+    assert next_minute(now) == datetime.datetime(2024, 3, 11, 11, 0)
+
+
+###################### sleep_until
+@pytest.mark.asyncio
+async def test_sleep_until_past():
+    """Test para verificar que no se duerme si la hora ya ha pasado."""
+    tick = datetime.datetime.now(pytz.utc) - datetime.timedelta(seconds=1)
+    with patch("inesdata_mov_datasets.sources.extract.daemon.asyncio.sleep") as mock_sleep:
+        await sleep_until(tick)
+    mock_sleep.assert_not_called()
+
+
+###################### extract_source
+@patch("inesdata_mov_datasets.sources.extract.daemon.get_informo", new_callable=AsyncMock)
+@patch("inesdata_mov_datasets.sources.extract.daemon.get_aemet", new_callable=AsyncMock)
+@patch("inesdata_mov_datasets.sources.extract.daemon.get_emt", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_extract_source(mock_get_emt, mock_get_aemet, mock_get_informo):
+    """Test para verificar que cada fuente reutiliza los clientes compartidos."""
+    config = MagicMock()
+    s3_client = MagicMock()
+    session = MagicMock()
+
+    await extract_source(config, "emt", s3_client=s3_client, session=session)
+    await extract_source(config, "aemet", s3_client=s3_client, session=session)
+    await extract_source(config, "informo", s3_client=s3_client, session=session)
+
+    mock_get_emt.assert_awaited_once_with(config, s3_client=s3_client, session=session)
+    mock_get_aemet.assert_awaited_once_with(config, s3_client=s3_client, session=session)
+    mock_get_informo.assert_awaited_once_with(config, s3_client=s3_client, session=session)
+
+
+###################### extract_sources
+@patch("inesdata_mov_datasets.sources.extract.daemon.extract_source")
+@pytest.mark.asyncio
+async def test_extract_sources_concurrent(mock_extract_source):
+    """Test para verificar que las fuentes se extraen a la vez y no una detrás de otra."""
+    config = MagicMock()
+    config.storage.default = "local"
+
+    async def slow_extraction(*args, **kwargs):
+        await asyncio.sleep(0.2)
+
+    mock_extract_source.side_effect = slow_extraction
+
+    start = datetime.datetime.now()
+    durations = await extract_sources(config, SOURCES)
+    elapsed = datetime.datetime.now() - start
+
+    assert list(durations) == SOURCES
+    assert elapsed < datetime.timedelta(seconds=0.5)
+    sessions = {call.kwargs["session"] for call in mock_extract_source.call_args_list}
+    assert len(sessions) == 1
+
+
+@patch("inesdata_mov_datasets.sources.extract.daemon.logger.error")
+@patch("inesdata_mov_datasets.sources.extract.daemon.extract_source")
+@pytest.mark.asyncio
+async def test_extract_sources_failure_isolated(mock_extract_source, mock_error):
+    """Test para verificar que el fallo de una fuente no detiene las demás."""
+    config = MagicMock()
+    config.storage.default = "local"
+
+    async def extraction(config, source, **kwargs):
+        if source == "aemet":
+            raise RuntimeError("AEMET down")
+
+    mock_extract_source.side_effect = extraction
+
+    durations = await extract_sources(config, SOURCES)
+
+    assert list(durations) == ["emt", "informo"]
+    mock_error.assert_called_once_with("Extraction of aemet failed: AEMET down")
+
+
+@patch("inesdata_mov_datasets.sources.extract.daemon.get_emt", new_callable=AsyncMock)
+@patch("inesdata_mov_datasets.sources.extract.daemon.logger.error")
+@pytest.mark.asyncio
+async def test_extract_source_error(mock_error, mock_get_emt):
+    """Test para verificar que los errores de una fuente se registran sin propagarse."""
+    mock_get_emt.side_effect = Exception("EMT down")
+
+    await extract_source(MagicMock(), "emt")
+
+    mock_error.assert_any_call(mock_get_emt.side_effect)
+
+
+###################### run_daemon
+@patch("inesdata_mov_datasets.sources.extract.daemon.sleep_until", new_callable=AsyncMock)
+@patch("inesdata_mov_datasets.sources.extract.daemon.extract_source", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_run_daemon(mock_extract_source, mock_sleep_until):
+    """Test para verificar que el demonio lanza las fuentes en cada minuto con los mismos clientes."""
+    config = MagicMock()
+    config.storage.default = "local"
+    config.sources.aemet.daemon_interval = 60
+
+    # Cada minuto se cede el control al bucle de eventos, como en la espera real
+    async def tick(*args, **kwargs):
+        await asyncio.sleep(0)
+
+    mock_sleep_until.side_effect = tick
+
+    await run_daemon(config, ["emt"], max_ticks=3)
+
+    assert mock_sleep_until.await_count == 3
+    assert mock_extract_source.await_count == 3
+    sessions = {call.kwargs["session"] for call in mock_extract_source.await_args_list}
+    assert len(sessions) == 1
+
+
+@patch("inesdata_mov_datasets.sources.extract.daemon.sleep_until", new_callable=AsyncMock)
+@patch("inesdata_mov_datasets.sources.extract.daemon.logger.warning")
+@patch("inesdata_mov_datasets.sources.extract.daemon.extract_source")
+@pytest.mark.asyncio
+async def test_run_daemon_skips_running_source(mock_extract_source, mock_warning, mock_sleep_until):
+    """Test para verificar que no se solapan dos extracciones de la misma fuente."""
+    config = MagicMock()
+    config.storage.default = "local"
+    release = asyncio.Event()
+
+    async def slow_extraction(*args, **kwargs):
+        await release.wait()
+
+    mock_extract_source.side_effect = slow_extraction
+
+    async def tick(*args, **kwargs):
+        if mock_sleep_until.await_count == 2:
+            asyncio.get_running_loop().call_soon(release.set)
+
+    mock_sleep_until.side_effect = tick
+
+    await run_daemon(config, ["emt"], max_ticks=2)
+
+    assert mock_extract_source.call_count == 1
+    mock_warning.assert_called_once()
@@ -1,12 +1,22 @@
+import asyncio
 import pytest
 from aiohttp import ClientSession
 from aioresponses import aioresponses
+from yarl import URL
 from unittest.mock import patch, AsyncMock, MagicMock
 import os
 import json
 import datetime
-from inesdata_mov_datasets.sources.extract.emt import get_calendar, get_line_detail, get_eta, login_emt, token_control,  get_emt
-from inesdata_mov_datasets.settings import Settings
+import time
+import pytz
+import zlib
+from inesdata_mov_datasets.sources.extract.emt import get_calendar, get_line_detail, get_eta, login_emt, token_control,  get_emt, prioritize_stops, emt_credentials, login_object_name, pick_credential, eta_record, store_eta, dedup_eta, commit_eta_snapshot, eta_content_hash, load_eta_snapshots, save_eta_snapshots, token_cache_path, refresh_token, wait_until_deadline, eta_report_name, read_eta_report
+from inesdata_mov_datasets.settings import Settings, SourceEmtConcurrencySettings, SourceEmtCoverageSettings, SourceEmtCredentialsSettings, RateLimitSettings, SourceEmtRetrySettings, SourceEmtServiceWindowSettings, SourceEmtStopTierSettings, SourceEmtTokenSettings
+from inesdata_mov_datasets.handlers import token_cache
+from inesdata_mov_datasets.sources.extract.emt_schedule import save_coverage_state, save_schedule_state
+from inesdata_mov_datasets.handlers.rate_limit import TokenBucket
+from inesdata_mov_datasets import utils
+from inesdata_mov_datasets.utils import read_ndjson
 
 ###################### get_calendar
 @pytest.mark.asyncio
@@ -133,7 +143,7 @@ async def test_get_eta_success():
             result = await get_eta(session, stop_id, headers)
 
             # Verificar que el resultado sea el esperado
-            assert result == mock_response
+            assert json.loads(result) == mock_response
 
 @pytest.mark.asyncio
 async def test_get_eta_error():
@@ -155,48 +165,64 @@ async def test_get_eta_error():
             result = await get_eta(session, stop_id, headers)
 
             # Verificar que el resultado sea un error manejado
-            assert result == {"code": -1}
+            assert result == b'{"code": -1}'
+
+@pytest.mark.asyncio
+async def test_get_eta_timeout():
+    """Test para verificar que un timeout en get_eta se devuelve como error y no se propaga."""
+
+    stop_id = "456"
+    headers = {"Authorization": "Bearer your_token"}
+
+    async with ClientSession() as session:
+        eta_url = f"https://openapi.emtmadrid.es/v2/transport/busemtmad/stops/{stop_id}/arrives/"
+
+        with aioresponses() as m:
+            m.post(eta_url, exception=asyncio.TimeoutError())  # Simular un timeout
+
+            result = await get_eta(session, stop_id, headers)
+
+            assert result == b'{"code": -1}'
 
 ###################### login_emt
 @pytest.fixture
 def mock_settings():
     """Fixture para simular la configuración de settings."""
     settings = MagicMock()
-    settings.sources.emt.credentials.x_client_id = "test_client_id"
-    settings.sources.emt.credentials.passkey = "test_passkey"
+    settings.sources.emt.credentials = SourceEmtCredentialsSettings(
+        x_client_id="test_client_id", passkey="test_passkey"
+    )
+    settings.sources.emt.retry = SourceEmtRetrySettings(max_attempts=1)
+    settings.sources.emt.rate_limit = RateLimitSettings()
     settings.storage.default = "local"
     return settings
 
-@patch('inesdata_mov_datasets.sources.extract.emt.requests.get')
+LOGIN_URL = "https://openapi.emtmadrid.es/v2/mobilitylabs/user/login/"
+
 @patch('builtins.open', new_callable=MagicMock)
 @patch('os.makedirs')
 @pytest.mark.asyncio
-async def test_login_emt_success(mock_makedirs, mock_open, mock_requests_get, mock_settings):
+async def test_login_emt_success(mock_makedirs, mock_open, mock_settings):
     """Test para verificar el inicio de sesión exitoso en EMT."""
 
-    # Simula la respuesta de la API
-    mock_response = MagicMock()
-    mock_response.json.return_value = {
-        "data": [{"accessToken": "mock_access_token"}]
-    }
-    mock_requests_get.return_value = mock_response
+    with aioresponses() as m:
+        # Simula la respuesta de la API
+        m.get(LOGIN_URL, payload={"data": [{"accessToken": "mock_access_token"}]})
 
-    # Llama a la función
-    token = await login_emt(mock_settings, object_login_name="login_response.json", local_path="/test/storage/")
-    # Verifica que el token retornado sea el esperado
-    assert token == "mock_access_token"
+        # Llama a la función
+        token = await login_emt(mock_settings, object_login_name="login_response.json", local_path="/test/storage/")
 
-    # Verifica que se llamara a requests.get con los headers correctos
-    mock_requests_get.assert_called_once_with(
-        "https://openapi.emtmadrid.es/v2/mobilitylabs/user/login/",
-        headers={
+        # Verifica que se llamara al login con los headers correctos
+        request = m.requests[("GET", URL(LOGIN_URL))][0]
+        assert request.kwargs["headers"] == {
             "X-ClientId": "test_client_id",
             "passKey": "test_passkey",
             "Content-Type": "application/json",
             "Accept": "application/json",
-        },
-        verify=True
-    )
+        }
+
+    # Verifica que el token retornado sea el esperado
+    assert token == "mock_access_token"
 
     # Verifica que se creara el directorio si no existe
     mock_makedirs.assert_called_once_with("/test/storage/", exist_ok=True)
@@ -204,34 +230,61 @@ async def test_login_emt_success(mock_makedirs, mock_open, mock_requests_get, mo
     # Verifica que se escribiera el archivo con la respuesta de la API
     mock_open.assert_called_once_with("/test/storage/login_response.json", "w")
 
-@patch('inesdata_mov_datasets.sources.extract.emt.requests.get')
 @pytest.mark.asyncio
-async def test_login_emt_failure(mock_requests_get, mock_settings):
+async def test_login_emt_failure(mock_settings):
     """Test para verificar el manejo de errores en el inicio de sesión."""
 
-    # Simula una respuesta de error de la API
-    mock_response = MagicMock()
-    mock_response.json.return_value = {
-        "data": []
-    }
-    mock_requests_get.return_value = mock_response
+    with aioresponses() as m:
+        # Simula una respuesta de error de la API
+        m.get(LOGIN_URL, payload={"data": []})
 
-    # Llama a la función
-    token = await login_emt(mock_settings, "login_response.json")
+        # Llama a la función
+        token = await login_emt(mock_settings, "login_response.json")
+
+        # Verifica que se llamara al login una vez
+        assert len(m.requests[("GET", URL(LOGIN_URL))]) == 1
 
     # Verifica que el token retornado sea una cadena vacía
     assert token == ""
 
-    # Verifica que se llamara a requests.get una vez
-    mock_requests_get.assert_called_once()
+@pytest.mark.asyncio
+async def test_login_emt_shared_session(mock_settings):
+    """Test para verificar que el login reutiliza la sesión http compartida."""
+
+    with aioresponses() as m:
+        m.get(LOGIN_URL, payload={"data": [{"accessToken": "mock_access_token"}]})
+        async with ClientSession() as session:
+            token = await login_emt(mock_settings, "login_response.json", session=session)
+            # La sesión compartida no se cierra al terminar el login
+            assert not session.closed
+
+    assert token == "mock_access_token"
+
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_login_emt_success_code_not_00(mock_sleep, mock_settings):
+    """Test para verificar que un login con código de éxito distinto de "00" no se reintenta."""
+    mock_settings.sources.emt.retry = SourceEmtRetrySettings(max_attempts=3)
+
+    with aioresponses() as m:
+        m.get(LOGIN_URL, payload={"code": "01", "data": [{"accessToken": "new_access_token"}]})
+
+        token = await login_emt(mock_settings, "login_response.json")
+
+        # Una única llamada, sin reintentos ni esperas
+        assert len(m.requests[("GET", URL(LOGIN_URL))]) == 1
+
+    assert token == "new_access_token"
+    mock_sleep.assert_not_awaited()
     
 #TODO ###################### token_control
 @pytest.fixture
-def mock_config():
+def mock_config(tmp_path):
     """Fixture para simular la configuración de settings."""
     settings = MagicMock()
     settings.storage.default = "local"  # Cambiar a "minio" si es necesario para otros tests
     settings.storage.config.local.path = "/tmp"
+    settings.sources.emt.token = SourceEmtTokenSettings(cache_path=str(tmp_path / "emt_tokens.json"))
     return settings
 
 
@@ -276,11 +329,12 @@ async def test_token_control_regenerate_token(mock_config, mock_login_emt, mock_
     assert token == "new_token"
 
 @pytest.fixture
-def mock_config_minio():
+def mock_config_minio(tmp_path):
     """Fixture para simular la configuración de settings."""
     settings = MagicMock()
     settings.storage.default = "minio"  # Cambiar a "minio" si es necesario para otros tests
     settings.storage.config.local.path = "/tmp"
+    settings.sources.emt.token = SourceEmtTokenSettings(cache_path=str(tmp_path / "emt_tokens.json"))
     return settings
 
 @patch('inesdata_mov_datasets.sources.extract.emt.check_s3_file_exists')
@@ -299,6 +353,363 @@ async def test_token_control_minio_file_not_exists(mock_login_emt, mock_check_s3
     mock_check_s3_file_exists.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_token_control_second_credential(mock_config, mock_login_emt, mock_check_local_file_exists):
+    """Test para verificar que cada credencial guarda su login en su propio fichero."""
+    credentials = [
+        SourceEmtCredentialsSettings(x_client_id="id_1", passkey="key_1"),
+        SourceEmtCredentialsSettings(x_client_id="id_2", passkey="key_2"),
+    ]
+    mock_config.sources.emt.credentials = credentials
+    mock_check_local_file_exists.return_value = False
+    mock_login_emt.return_value = "token_2"
+
+    token = await token_control(mock_config, "2024/10/08", "20241008", credential_index=1)
+
+    assert token == "token_2"
+    assert mock_login_emt.call_args.args[1] == "login_20241008_1.json"
+    assert mock_login_emt.call_args.kwargs["credentials"] is credentials[1]
+
+
+@pytest.mark.asyncio
+async def test_token_control_memory_cache(mock_config, mock_login_emt, mock_check_local_file_exists):
+    """Test para verificar que un token válido en memoria se usa sin leer el almacenamiento."""
+    mock_config.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="memory_id", passkey="key")
+    token_cache.remember_token("memory_id", "memory_token", time.time() + 3600)
+
+    token = await token_control(mock_config, "2024/10/08", "20241008")
+
+    assert token == "memory_token"
+    mock_check_local_file_exists.assert_not_called()
+    mock_login_emt.assert_not_called()
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.refresh_token', new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_token_control_refresh_in_background(mock_refresh_token, mock_config, mock_login_emt):
+    """Test para verificar que un token a punto de caducar se devuelve y se renueva en segundo plano."""
+    mock_config.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="expiring_id", passkey="key")
+    token_cache.remember_token("expiring_id", "old_token", time.time() + 60)
+
+    token = await token_control(mock_config, "2024/10/08", "20241008")
+    await asyncio.sleep(0)
+
+    assert token == "old_token"
+    mock_refresh_token.assert_awaited_once_with(mock_config, "2024/10/08", "20241008", 0)
+    mock_login_emt.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_token_control_shared_cache(mock_config, mock_login_emt, mock_check_local_file_exists):
+    """Test para verificar que se usa el token que otro proceso dejó en la caché compartida."""
+    mock_config.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="shared_id", passkey="key")
+    token_cache.save_shared_token(
+        token_cache_path(mock_config), "shared_id", {"token": "shared_token", "expiration": time.time() + 3600}
+    )
+
+    token = await token_control(mock_config, "2024/10/08", "20241008")
+
+    assert token == "shared_token"
+    assert token_cache.get_cached_token("shared_id")["token"] == "shared_token"
+    mock_login_emt.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_token_control_saves_shared_cache(mock_config, mock_check_local_file_exists):
+    """Test para verificar que el token de un login nuevo se comparte con otros procesos."""
+    mock_config.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="login_id", passkey="key")
+    mock_check_local_file_exists.return_value = False
+
+    async def login(*args, **kwargs):
+        token_cache.remember_token("login_id", "new_token", time.time() + 3600)
+        return "new_token"
+
+    with patch('inesdata_mov_datasets.sources.extract.emt.login_emt', side_effect=login):
+        token = await token_control(mock_config, "2024/10/08", "20241008")
+
+    assert token == "new_token"
+    shared = token_cache.read_shared_tokens(token_cache_path(mock_config))
+    assert shared["login_id"]["token"] == "new_token"
+
+
+@pytest.mark.asyncio
+async def test_refresh_token_already_refreshed(mock_config, mock_login_emt):
+    """Test para verificar que no se repite el login si otro proceso ya renovó el token."""
+    mock_config.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="refreshed_id", passkey="key")
+    token_cache.save_shared_token(
+        token_cache_path(mock_config), "refreshed_id", {"token": "fresh_token", "expiration": time.time() + 3600}
+    )
+
+    await refresh_token(mock_config, "2024/10/08", "20241008")
+
+    mock_login_emt.assert_not_called()
+    assert token_cache.get_cached_token("refreshed_id")["token"] == "fresh_token"
+
+
+###################### credentials
+def test_emt_credentials():
+    """Test para verificar que las credenciales se devuelven siempre como lista."""
+    config = MagicMock()
+    credential = SourceEmtCredentialsSettings(email="a@b.c", password="pass")
+    config.sources.emt.credentials = credential
+    assert emt_credentials(config) == [credential]
+
+    config.sources.emt.credentials = [credential, credential]
+    assert emt_credentials(config) == [credential, credential]
+
+
+def test_login_object_name():
+    """Test para verificar que la primera credencial mantiene el nombre de siempre."""
+    assert login_object_name("20241008") == "login_20241008.json"
+    assert login_object_name("20241008", 2) == "login_20241008_2.json"
+
+
+def test_pick_credential():
+    """Test para verificar el reparto de las llamadas entre credenciales."""
+    pool = [
+        {"headers": {}, "rate_limiter": None, "in_flight": 3},
+        {"headers": {}, "rate_limiter": None, "in_flight": 1},
+    ]
+    assert [pick_credential(pool, position, "round_robin") for position in range(3)] == [pool[0], pool[1], pool[0]]
+    assert pick_credential(pool, 0, "least_loaded") is pool[1]
+
+    # Con límite de tasa se elige la credencial que antes tiene un token libre
+    pool[0]["rate_limiter"] = TokenBucket(rate=10, burst=1)
+    pool[1]["rate_limiter"] = TokenBucket(rate=10, burst=1)
+    pool[1]["rate_limiter"].tokens = -5
+    assert pick_credential(pool, 0, "least_loaded") is pool[0]
+
+
+###################### eta_record
+def test_eta_record():
+    """Test para verificar la línea NDJSON de una respuesta sin decodificarla."""
+    record = eta_record("1", "2024-03-11T12:30:00+01:00", b'{"code":"00",\n "data":[]}')
+
+    assert b"\n" not in record
+    assert json.loads(record) == {"stop_id": "1", "datetime": "2024-03-11T12:30:00+01:00", "response": {"code": "00", "data": []}}
+
+
+###################### ETA dedup
+def test_eta_content_hash():
+    """Test para verificar que el hash solo depende de los datos de la respuesta."""
+    first = b'{"code":"00","description":"lapsed: 10","datetime":"2024-03-11T12:30:01","data":[{"Arrive":[]}]}'
+    second = b'{"code":"00","description":"lapsed: 25","datetime":"2024-03-11T12:31:02","data":[{"Arrive":[]}]}'
+    other = b'{"code":"00","description":"lapsed: 25","datetime":"2024-03-11T12:31:02","data":[{"Arrive":[{"bus":1}]}]}'
+    assert eta_content_hash(first) == eta_content_hash(second)
+    assert eta_content_hash(first) != eta_content_hash(other)
+
+
+def test_dedup_eta():
+    """Test para verificar que una respuesta sin cambios se sustituye por una referencia del mismo día."""
+    snapshots = {}
+    first = b'{"code":"00","datetime":"2024-03-11T12:30:01","data":[]}'
+    second = b'{"code":"00","datetime":"2024-03-11T12:31:01","data":[]}'
+
+    response, snapshot = dedup_eta(snapshots, 1, first, "eta_1_2024-03-11T1230.json", "2024/03/11", "2024-03-11T1230")
+    assert response == first
+    # La instantánea no se guarda hasta que la respuesta se ha almacenado
+    assert snapshots == {}
+    commit_eta_snapshot(snapshots, 1, snapshot)
+
+    reference, snapshot = dedup_eta(snapshots, 1, second, "eta_1_2024-03-11T1231.json", "2024/03/11", "2024-03-11T1231")
+    assert json.loads(reference) == {"code": "00", "datetime": "2024-03-11T12:31:00", "stop_id": 1, "ref": "eta_1_2024-03-11T1230.json"}
+    assert snapshot is None
+
+    # Una ejecución repetida del mismo minuto no se referencia a sí misma
+    assert dedup_eta(snapshots, 1, first, "eta_1_2024-03-11T1230.json", "2024/03/11", "2024-03-11T1230")[0] == first
+    # Al cambiar de día se vuelve a guardar la respuesta completa
+    response, snapshot = dedup_eta(snapshots, 1, first, "eta_1_2024-03-12T0000.json", "2024/03/12", "2024-03-12T0000")
+    assert response == first
+    commit_eta_snapshot(snapshots, 1, snapshot)
+    assert snapshots["1"]["date"] == "2024/03/12"
+
+
+def test_save_and_load_eta_snapshots(tmp_path):
+    """Test para verificar que las últimas instantáneas se conservan entre procesos."""
+    state_path = tmp_path / "state" / "emt_eta_snapshots.json"
+    save_eta_snapshots(state_path, {"1": {"hash": "abc", "ref": "eta_1.json", "date": "2024/03/11"}})
+
+    assert load_eta_snapshots(state_path) == {"1": {"hash": "abc", "ref": "eta_1.json", "date": "2024/03/11"}}
+    # En el mismo proceso se reutiliza el diccionario en memoria
+    assert load_eta_snapshots(state_path) is load_eta_snapshots(state_path)
+    assert load_eta_snapshots(tmp_path / "missing.json") == {}
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control', return_value="fake_token")
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar', return_value={"code": "00"})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail', return_value={"code": "00"})
+@pytest.mark.asyncio
+async def test_get_emt_dedup_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                   mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que una parada sin cambios se guarda como referencia a la ejecución anterior."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    mock_settings_get_emt.sources.emt.stops = ["1"]
+    mock_settings_get_emt.sources.emt.eta_dedup = True
+    mock_settings_get_emt.sources.emt.eta_dedup_state_path = str(tmp_path / "emt_eta_snapshots.json")
+    mock_get_eta.return_value = b'{"code": "00", "data": [{"Arrive": []}]}'
+
+    # Ejecución anterior con la misma respuesta
+    europe_timezone = pytz.timezone("Europe/Madrid")
+    previous = datetime.datetime.now(europe_timezone) - datetime.timedelta(minutes=1)
+    previous_name = f"eta_1_{previous.strftime('%Y-%m-%dT%H%M')}.json"
+    save_eta_snapshots(
+        tmp_path / "emt_eta_snapshots.json",
+        {"1": {"hash": eta_content_hash(mock_get_eta.return_value), "ref": previous_name, "date": datetime.datetime.now(europe_timezone).strftime("%Y/%m/%d")}},
+    )
+
+    await get_emt(mock_settings_get_emt)
+
+    eta_files = list(tmp_path.glob("raw/emt/*/*/*/eta/*"))
+    assert len(eta_files) == 1
+    assert json.loads(eta_files[0].read_text())["ref"] == previous_name
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control', return_value="fake_token")
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar', return_value={"code": "00"})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail', return_value={"code": "00"})
+@pytest.mark.asyncio
+async def test_get_emt_service_window_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                            mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que no se piden las paradas con todas sus líneas fuera de servicio."""
+    state_path = tmp_path / "emt_schedule.json"
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    # Con un intervalo de 1441 minutos la parada 1753 nunca se sondea
+    mock_settings_get_emt.sources.emt.stops = ["1", "1753"]
+    mock_settings_get_emt.sources.emt.service_window = SourceEmtServiceWindowSettings(
+        enabled=True, probe_interval=1441, state_path=str(state_path)
+    )
+    mock_get_eta.return_value = b'{"code": "00", "data": [{"Arrive": [{"line": "1"}]}]}'
+
+    # Calendario y line_detail guardados por una ejecución anterior del día: la línea 2 no circula hoy
+    europe_timezone = pytz.timezone("Europe/Madrid")
+    now = datetime.datetime.now(europe_timezone)
+    day_dir = tmp_path / "raw" / "emt" / now.strftime("%Y/%m/%d")
+    (day_dir / "calendar").mkdir(parents=True)
+    (day_dir / "calendar" / f"calendar_{now.strftime('%Y%m%d')}.json").write_text(
+        json.dumps([{"code": "00", "data": [{"dayType": "LA"}]}])
+    )
+    (day_dir / "line_detail").mkdir()
+    (day_dir / "line_detail" / f"line_detail_2_{now.strftime('%Y%m%d')}.json").write_text(
+        json.dumps({"code": "00", "data": [{"line": "2", "timeTable": [
+            {"idDayType": "FE", "Direction1": {"StartTime": "00:00", "StopTime": "23:59"}, "Direction2": {}}
+        ]}]})
+    )
+    save_schedule_state(state_path, {"stop_lines": {"1753": ["2"]}, "windows": {}})
+    utils._json_states.clear()
+
+    await get_emt(mock_settings_get_emt)
+
+    assert [call.args[1] for call in mock_get_eta.call_args_list] == ["1"]
+    # Las líneas de la parada pedida se aprenden de su respuesta
+    assert json.loads(state_path.read_text())["stop_lines"] == {"1": ["1"], "1753": ["2"]}
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control', return_value="fake_token")
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar', return_value={"code": "00"})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail', return_value={"code": "00"})
+@pytest.mark.asyncio
+async def test_get_emt_coverage_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                      mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que no se piden las paradas cuyos autobuses ya observa otra parada."""
+    state_path = tmp_path / "emt_coverage.json"
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    minute = int(datetime.datetime.now(pytz.timezone("Europe/Madrid")).replace(second=0).timestamp() // 60)
+    # Parada que no toca volver a pedir en este minuto ni en el siguiente
+    covered = next(
+        str(stop) for stop in range(2, 100)
+        if zlib.crc32(str(stop).encode("utf-8")) % 1441 not in [minute % 1441, (minute + 1) % 1441]
+    )
+    mock_settings_get_emt.sources.emt.stops = ["1", covered]
+    mock_settings_get_emt.sources.emt.coverage = SourceEmtCoverageSettings(
+        enabled=True, staleness=1441, state_path=str(state_path)
+    )
+    mock_get_eta.return_value = b'{"code": "00", "data": [{"Arrive": [{"line": "1", "bus": 10}]}]}'
+    save_coverage_state(state_path, {"observations": {
+        "1": {"minute": minute - 1, "buses": ["1:10", "1:11"]},
+        covered: {"minute": minute - 1, "buses": ["1:10"]},
+    }})
+    utils._json_states.clear()
+
+    await get_emt(mock_settings_get_emt)
+
+    assert [call.args[1] for call in mock_get_eta.call_args_list] == ["1"]
+    assert json.loads(state_path.read_text())["observations"]["1"]["buses"] == ["1:10"]
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control', return_value="fake_token")
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta', return_value=b'{"code": "00", "data": []}')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar', return_value={"code": "00"})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail', return_value={"code": "00"})
+@pytest.mark.asyncio
+async def test_get_emt_stop_tiers_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                        mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que las paradas de un nivel lento solo se piden en su minuto."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    mock_settings_get_emt.sources.emt.stops = ["1", "2", "3"]
+    # Con 1441 paradas en un nivel de 1441 minutos, cada minuto toca una sola
+    mock_settings_get_emt.sources.emt.stop_tiers = [
+        SourceEmtStopTierSettings(every=1441, stops=[2, 3] + list(range(4, 1443)))
+    ]
+
+    await get_emt(mock_settings_get_emt)
+
+    stops_called = [call.args[1] for call in mock_get_eta.call_args_list]
+    assert stops_called[0] == "1"
+    assert len(stops_called) <= 2
+
+
+###################### prioritize_stops
+def test_prioritize_stops():
+    """Test para verificar que las paradas sin datos en la ejecución anterior van primero."""
+    assert prioritize_stops([1, 2, 3, 4], [3, 1]) == [1, 3, 2, 4]
+    assert prioritize_stops([1, 2, 3], []) == [1, 2, 3]
+
+
+###################### wait_until_deadline
+@pytest.mark.asyncio
+async def test_wait_until_deadline_cancels_pending():
+    """Test para verificar que las peticiones pendientes en el límite se cancelan."""
+
+    async def response(delay, value):
+        await asyncio.sleep(delay)
+        return value
+
+    fast = asyncio.ensure_future(response(0, "fast"))
+    slow = asyncio.ensure_future(response(10, "slow"))
+    deadline = datetime.datetime.now(pytz.utc) + datetime.timedelta(seconds=0.2)
+
+    results = await wait_until_deadline([fast, slow], deadline)
+
+    assert results == ["fast", None]
+    assert slow.cancelled()
+
+
+###################### eta report
+def test_eta_report_name():
+    """Test para verificar el nombre del informe de una ejecución."""
+    assert eta_report_name("2024/03/11", "1005") == "raw/emt/2024/03/11/eta_report/eta_report_20240311T1005.json"
+
+
+@pytest.mark.asyncio
+async def test_read_eta_report_missing(tmp_path):
+    """Test para verificar que sin informe previo se devuelve un diccionario vacío."""
+    config = MagicMock()
+    config.storage.default = "local"
+    config.storage.config.local.path = str(tmp_path)
+    assert await read_eta_report(config, eta_report_name("2024/03/11", "1005")) == {}
+
+
 ###################### get_emt
 @pytest.fixture
 def mock_settings_get_emt():
@@ -307,6 +718,15 @@ def mock_settings_get_emt():
     settings.sources = MagicMock()
     settings.sources.emt.lines = ["line1", "line2"]  # Ejemplo de líneas
     settings.sources.emt.stops = ["1", "2"]  # Ejemplo de paradas
+    settings.sources.emt.run_deadline = 3600  # Límite holgado para que no se cancele nada
+    settings.sources.emt.concurrency = SourceEmtConcurrencySettings(state_path="/fake/path/emt_concurrency.json")
+    settings.sources.emt.rate_limit = RateLimitSettings()
+    settings.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="id", passkey="key")
+    settings.sources.emt.eta_stream_workers = 2
+    settings.sources.emt.eta_dedup = False
+    settings.sources.emt.service_window = SourceEmtServiceWindowSettings()
+    settings.sources.emt.coverage = SourceEmtCoverageSettings()
+    settings.sources.emt.stop_tiers = []
     settings.storage.default = "local"  # Cambia a "minio" si es necesario
     settings.storage.config.local.path = "/fake/path"  # Ruta ficticia para pruebas
     return settings
@@ -321,23 +741,21 @@ def mock_settings_get_emt():
 @patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')  
 @patch('inesdata_mov_datasets.sources.extract.emt.get_eta')  
 @patch('inesdata_mov_datasets.sources.extract.emt.upload_objs')  
-@patch('inesdata_mov_datasets.sources.extract.emt.check_local_file_exists')  
-@patch('inesdata_mov_datasets.sources.extract.emt.check_s3_file_exists')  
+@patch('inesdata_mov_datasets.sources.extract.emt.list_stored_objs')  
 @pytest.mark.asyncio
-async def test_get_emt_local(mock_check_s3_file_exists, mock_check_local_file_exists, mock_upload_objs,
+async def test_get_emt_local(mock_list_stored_objs, mock_upload_objs,
                         mock_get_eta, mock_get_calendar, mock_get_line_detail,
                         mock_token_control, mock_error, mock_debug, mock_info, mock_instantiate_logger, mock_settings_get_emt):
     """Test para verificar la extracción de datos de EMT."""
 
     # Configura los mocks
     mock_token_control.return_value = "fake_token"
-    mock_check_local_file_exists.return_value = False  # Simula que los archivos no existen
-    mock_check_s3_file_exists.return_value = False  # Simula que los archivos no existen en S3
+    mock_list_stored_objs.return_value = set()  # Simula que los archivos no existen
 
     # Simula las respuestas de los métodos asíncronos
     mock_get_line_detail.return_value = {"code": "00", "data": "line_data"}
     mock_get_calendar.return_value = {"code": "00", "data": "calendar_data"}
-    mock_get_eta.return_value = {"code": "00", "data": "eta_data"}
+    mock_get_eta.return_value = b'{"code": "00", "data": "eta_data"}'
 
     # Ejecutar la función
     await get_emt(mock_settings_get_emt)
@@ -349,6 +767,9 @@ async def test_get_emt_local(mock_check_s3_file_exists, mock_check_local_file_ex
     mock_info.assert_any_call("Extracting EMT")
     mock_info.assert_any_call("Extracted EMT")
 
+    # Verificar que se listan una única vez los objetos del día
+    mock_list_stored_objs.assert_called_once()
+
     # Verificar que se llama a token_control una vez
     assert mock_token_control.call_count ==1  # Verifica que se llama con los argumentos correctos
 
@@ -366,6 +787,25 @@ async def test_get_emt_local(mock_check_s3_file_exists, mock_check_local_file_ex
     mock_debug.assert_called()
 
 
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.list_stored_objs')
+@patch('inesdata_mov_datasets.sources.extract.emt.wait_until_deadline')
+@pytest.mark.asyncio
+async def test_get_emt_stops_writers_on_error(mock_wait_until_deadline, mock_list_stored_objs,
+                        mock_token_control, mock_instantiate_logger, mock_settings_get_emt):
+    """Test para verificar que los escritores de ETA se paran aunque la ejecución falle."""
+    mock_token_control.return_value = "fake_token"
+    mock_list_stored_objs.return_value = set()
+    mock_wait_until_deadline.side_effect = Exception("Unexpected error")
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+
+    await get_emt(mock_settings_get_emt)
+
+    writers = [task for task in asyncio.all_tasks() if "store_eta_worker" in repr(task.get_coro())]
+    assert writers == []
+
+
 @patch('inesdata_mov_datasets.sources.extract.emt.check_local_file_exists')
 @patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
 @pytest.mark.asyncio
@@ -378,6 +818,294 @@ async def test_get_emt_file_exists_local(mock_check_local_file_exists, mock_get_
     mock_get_line_detail.assert_not_called()
 
 
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
+@patch('inesdata_mov_datasets.sources.extract.emt.list_stored_objs')
+@pytest.mark.asyncio
+async def test_get_emt_already_stored_index(mock_list_stored_objs, mock_get_line_detail, mock_get_calendar,
+                                            mock_get_eta, mock_token_control, mock_instantiate_logger, mock_settings_get_emt):
+    """Test para verificar que el índice del día evita repetir line_detail y calendar."""
+    today = datetime.datetime.now(pytz.timezone("Europe/Madrid"))
+    date_slash = today.strftime("%Y/%m/%d")
+    date_day = today.strftime("%Y%m%d")
+    mock_list_stored_objs.return_value = {
+        f"raw/emt/{date_slash}/line_detail/line_detail_line1_{date_day}.json",
+        f"raw/emt/{date_slash}/line_detail/line_detail_line2_{date_day}.json",
+        f"raw/emt/{date_slash}/calendar/calendar_{date_day}.json",
+    }
+    mock_token_control.return_value = "fake_token"
+    mock_get_eta.return_value = b'{"code": "00", "data": "eta_data"}'
+
+    await get_emt(mock_settings_get_emt)
+
+    # El índice se pasa a token_control para la comprobación del login
+    assert mock_token_control.call_args.kwargs["stored_objs"] == mock_list_stored_objs.return_value
+    mock_get_line_detail.assert_not_called()
+    mock_get_calendar.assert_not_called()
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
+@pytest.mark.asyncio
+async def test_get_emt_packed_layout_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                           mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que con el formato empaquetado se escribe un único NDJSON comprimido por ejecución."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "packed"
+    mock_settings_get_emt.sources.emt.eta_compression = "gzip"
+    mock_token_control.return_value = "fake_token"
+    mock_get_line_detail.return_value = {"code": "00", "data": "line_data"}
+    mock_get_calendar.return_value = {"code": "00", "data": "calendar_data"}
+    mock_get_eta.side_effect = lambda session, stop_id, headers, **kwargs: json.dumps({"code": "00", "data": f"eta_{stop_id}"}).encode()
+
+    await get_emt(mock_settings_get_emt)
+
+    eta_files = list(tmp_path.glob("raw/emt/*/*/*/eta/*"))
+    assert len(eta_files) == 1
+    assert eta_files[0].name.endswith(".ndjson.gz")
+    records = list(read_ndjson(eta_files[0]))
+    assert [record["stop_id"] for record in records] == ["1", "2"]
+    assert records[0]["response"] == {"code": "00", "data": "eta_1"}
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
+@pytest.mark.asyncio
+async def test_get_emt_multiple_credentials_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                                  mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que las paradas se reparten entre los tokens de las credenciales
+    y que las credenciales sin token se descartan."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    mock_settings_get_emt.sources.emt.stops = ["1", "2", "3", "4"]
+    mock_settings_get_emt.sources.emt.credentials_strategy = "round_robin"
+    mock_settings_get_emt.sources.emt.credentials = [
+        SourceEmtCredentialsSettings(x_client_id="id_1", passkey="key_1"),
+        SourceEmtCredentialsSettings(x_client_id="id_2", passkey="key_2"),
+        SourceEmtCredentialsSettings(x_client_id="id_3", passkey="key_3"),
+    ]
+    tokens = ["token_1", "", "token_3"]  # La segunda credencial no consigue hacer login
+    mock_token_control.side_effect = lambda *args, credential_index, **kwargs: tokens[credential_index]
+    mock_get_line_detail.return_value = {"code": "00", "data": "line_data"}
+    mock_get_calendar.return_value = {"code": "00", "data": "calendar_data"}
+    mock_get_eta.return_value = b'{"code": "00", "data": "eta_data"}'
+
+    await get_emt(mock_settings_get_emt)
+
+    assert mock_token_control.call_count == 3
+    tokens_by_stop = {call.args[1]: call.args[2]["accessToken"] for call in mock_get_eta.call_args_list}
+    assert tokens_by_stop == {"1": "token_1", "2": "token_3", "3": "token_1", "4": "token_3"}
+    # line_detail y calendar usan el primer token
+    assert mock_get_calendar.call_args.args[3]["accessToken"] == "token_1"
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
+@pytest.mark.asyncio
+async def test_get_emt_deadline_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                      mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que en el límite se cancelan las peticiones lentas, se guarda lo completado
+    y la siguiente ejecución pide primero las paradas canceladas."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    mock_token_control.return_value = "fake_token"
+    mock_get_line_detail.return_value = {"code": "00", "data": "line_data"}
+    mock_get_calendar.return_value = {"code": "00", "data": "calendar_data"}
+
+    async def eta(session, stop_id, headers, **kwargs):
+        if stop_id == "2":
+            await asyncio.sleep(10)  # Parada que no responde antes del límite
+        return json.dumps({"code": "00", "data": f"eta_{stop_id}"}).encode()
+
+    mock_get_eta.side_effect = eta
+
+    # Límite ya cercano respecto al inicio del minuto actual
+    europe_timezone = pytz.timezone("Europe/Madrid")
+    now = datetime.datetime.now(europe_timezone)
+    if now.second >= 58:  # Evitar que la ejecución empiece en el minuto siguiente
+        await asyncio.sleep(3)
+        now = datetime.datetime.now(europe_timezone)
+    run_deadline = now.second + now.microsecond / 1e6 + 0.3
+
+    await get_emt(mock_settings_get_emt, run_deadline=run_deadline)
+
+    # Se guarda la parada completada y no la cancelada
+    eta_files = [path.name for path in tmp_path.glob("raw/emt/*/*/*/eta/*")]
+    assert len(eta_files) == 1
+    assert eta_files[0].startswith("eta_1_")
+
+    # El informe de la ejecución recoge la parada cancelada
+    report_files = list(tmp_path.glob("raw/emt/*/*/*/eta_report/*.json"))
+    assert len(report_files) == 1
+    report = json.loads(report_files[0].read_text())
+    assert report["cancelled"] == ["2"]
+    assert report["completed"] == 1
+
+    # La siguiente ejecución lee el informe anterior y prioriza la parada cancelada
+    with patch('inesdata_mov_datasets.sources.extract.emt.read_eta_report', return_value=report):
+        mock_get_eta.side_effect = None
+        mock_get_eta.return_value = b'{"code": "00", "data": "eta"}'
+        await get_emt(mock_settings_get_emt)
+        assert [call.args[1] for call in mock_get_eta.call_args_list[-2:]] == ["2", "1"]
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
+@pytest.mark.asyncio
+async def test_get_emt_deadline_slow_writers_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                                   mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que una respuesta recibida antes del límite no se cancela esperando a los escritores."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    mock_settings_get_emt.sources.emt.eta_stream_workers = 1
+    mock_settings_get_emt.sources.emt.stops = ["1", "2", "3", "4"]
+    mock_token_control.return_value = "fake_token"
+    mock_get_line_detail.return_value = {"code": "00", "data": "line_data"}
+    mock_get_calendar.return_value = {"code": "00", "data": "calendar_data"}
+    mock_get_eta.return_value = b'{"code": "00", "data": "eta"}'
+
+    # Un único escritor lento, que no vacía la cola antes del límite
+    async def slow_store_eta(*args, **kwargs):
+        await asyncio.sleep(0.2)
+        return await store_eta(*args, **kwargs)
+
+    europe_timezone = pytz.timezone("Europe/Madrid")
+    now = datetime.datetime.now(europe_timezone)
+    if now.second >= 58:  # Evitar que la ejecución empiece en el minuto siguiente
+        await asyncio.sleep(3)
+        now = datetime.datetime.now(europe_timezone)
+    run_deadline = now.second + now.microsecond / 1e6 + 0.1
+
+    with patch('inesdata_mov_datasets.sources.extract.emt.store_eta', side_effect=slow_store_eta):
+        await get_emt(mock_settings_get_emt, run_deadline=run_deadline)
+
+    # Todas las respuestas se guardan y ninguna se da por cancelada
+    assert len(list(tmp_path.glob("raw/emt/*/*/*/eta/*"))) == 4
+    report_files = list(tmp_path.glob("raw/emt/*/*/*/eta_report/*.json"))
+    report = json.loads(report_files[0].read_text())
+    assert report["cancelled"] == []
+    assert report["completed"] == 4
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar')
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
+@pytest.mark.asyncio
+async def test_get_emt_stored_after_calls_local(mock_get_line_detail, mock_get_calendar, mock_get_eta,
+                                                mock_token_control, mock_instantiate_logger, mock_settings_get_emt, tmp_path):
+    """Test para verificar que sin escritores las respuestas se guardan al terminar las llamadas."""
+    mock_settings_get_emt.storage.config.local.path = str(tmp_path)
+    mock_settings_get_emt.sources.emt.eta_layout = "files"
+    mock_settings_get_emt.sources.emt.eta_stream_workers = 0
+    mock_token_control.return_value = "fake_token"
+    mock_get_line_detail.return_value = {"code": "00", "data": "line_data"}
+    mock_get_calendar.return_value = {"code": "00", "data": "calendar_data"}
+    mock_get_eta.return_value = b'{"code": "00", "data": "eta_data"}'
+
+    await get_emt(mock_settings_get_emt)
+
+    eta_files = list(tmp_path.glob("raw/emt/*/*/*/eta/*"))
+    assert len(eta_files) == 2
+    assert eta_files[0].read_bytes() == b'{"code": "00", "data": "eta_data"}'
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.emt.token_control', return_value="fake_token")
+@patch('inesdata_mov_datasets.sources.extract.emt.list_stored_objs', return_value=set())
+@patch('inesdata_mov_datasets.sources.extract.emt.read_eta_report', return_value={})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail', return_value={"code": "00"})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_calendar', return_value={"code": "00"})
+@patch('inesdata_mov_datasets.sources.extract.emt.get_eta')
+@patch('inesdata_mov_datasets.sources.extract.emt.upload_obj')
+@patch('inesdata_mov_datasets.sources.extract.emt.upload_objs')
+@patch('inesdata_mov_datasets.sources.extract.emt.upload_manifest')
+@pytest.mark.parametrize("stream_workers", [2, 0])
+@pytest.mark.asyncio
+async def test_get_emt_streaming_minio(mock_upload_manifest, mock_upload_objs, mock_upload_obj, mock_get_eta,
+                                       mock_get_calendar, mock_get_line_detail, mock_read_eta_report,
+                                       mock_list_stored_objs, mock_token_control, mock_instantiate_logger,
+                                       mock_settings_get_emt_minio, stream_workers):
+    """Test para verificar que las respuestas se suben a s3 con `store_eta`, con o sin escritores,
+    y se anotan en el manifiesto."""
+    mock_settings_get_emt_minio.sources.emt.eta_layout = "files"
+    mock_settings_get_emt_minio.sources.emt.eta_stream_workers = stream_workers
+    mock_get_eta.side_effect = lambda session, stop_id, headers, **kwargs: (
+        b'{"code": "00"}' if stop_id == "1" else b'{"code": "99"}'
+    )
+
+    await get_emt(mock_settings_get_emt_minio)
+
+    # Solo se sube la respuesta correcta, con los bytes recibidos
+    mock_upload_obj.assert_awaited_once()
+    key, body = mock_upload_obj.call_args.args[2:]
+    assert key.startswith("raw/emt/") and "/eta/eta_1_" in key
+    assert body == b'{"code": "00"}'
+    assert mock_upload_manifest.call_args.args[4] == [key]
+
+    # La parada con error queda en el informe de la ejecución
+    report = [
+        json.loads(list(call.args[4].values())[0])
+        for call in mock_upload_objs.call_args_list
+        if "eta_report" in str(list(call.args[4].keys())[0])
+    ][0]
+    assert report["errors"] == ["2"]
+
+
+###################### store_eta
+@pytest.mark.asyncio
+async def test_store_eta_local(tmp_path):
+    """Test para verificar que la respuesta se guarda tal cual y que las erróneas no se guardan."""
+    config = MagicMock()
+    config.storage.default = "local"
+    config.storage.config.local.path = str(tmp_path)
+
+    name = await store_eta(config, "1", b'{"code":"00"}', "2024-03-11T1230", "2024/03/11")
+    assert name == "raw/emt/2024/03/11/eta/eta_1_2024-03-11T1230.json"
+    assert (tmp_path / name).read_bytes() == b'{"code":"00"}'
+
+    assert await store_eta(config, "2", b'{"code":"99"}', "2024-03-11T1230", "2024/03/11") is None
+    assert not (tmp_path / "raw/emt/2024/03/11/eta/eta_2_2024-03-11T1230.json").exists()
+
+
+@patch('inesdata_mov_datasets.sources.extract.emt.upload_obj', new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_store_eta_failure_keeps_snapshot(mock_upload_obj):
+    """Test para verificar que una instantánea que no se pudo guardar no se referencia después."""
+    config = MagicMock()
+    config.storage.default = "minio"
+    snapshots = {}
+    first = b'{"code":"00","datetime":"2024-03-11T12:30:01","data":[]}'
+    second = b'{"code":"00","datetime":"2024-03-11T12:31:01","data":[]}'
+
+    mock_upload_obj.side_effect = Exception("S3 down")
+    with pytest.raises(Exception):
+        await store_eta(config, "1", first, "2024-03-11T1230", "2024/03/11", MagicMock(), snapshots=snapshots)
+    assert snapshots == {}
+
+    # La siguiente ejecución guarda la respuesta completa, no una referencia al fichero perdido
+    mock_upload_obj.side_effect = None
+    await store_eta(config, "1", second, "2024-03-11T1231", "2024/03/11", MagicMock(), snapshots=snapshots)
+    assert mock_upload_obj.await_args.args[3] == second
+    assert snapshots["1"]["ref"] == "eta_1_2024-03-11T1231.json"
+
+
 @patch('inesdata_mov_datasets.sources.extract.emt.get_line_detail')
 @patch('inesdata_mov_datasets.sources.extract.emt.logger.error')
 @pytest.mark.asyncio
@@ -393,7 +1121,7 @@ async def test_get_emt_line_detail_error_local(mock_logger_error,mock_get_line_d
 @patch('inesdata_mov_datasets.sources.extract.emt.logger.error')
 @pytest.mark.asyncio
 async def test_get_emt_eta_errors_local(mock_logger_error,mock_get_eta, mock_settings_get_emt):
-    mock_get_eta.return_value = {"code": "99", "error": "ETA Error"}  # Simula error en las paradas
+    mock_get_eta.return_value = b'{"code": "99", "error": "ETA Error"}'  # Simula error en las paradas
     
     await get_emt(mock_settings_get_emt)
     
@@ -425,7 +1153,7 @@ async def test_get_emt_minio_success():
             with patch("inesdata_mov_datasets.sources.extract.emt.check_s3_file_exists", return_value=False) as mock_check_s3:
                 with patch("inesdata_mov_datasets.sources.extract.emt.get_line_detail", return_value={"code": "00"}) as mock_line_detail:
                     with patch("inesdata_mov_datasets.sources.extract.emt.get_calendar", return_value={"code": "00"}) as mock_calendar:
-                        with patch("inesdata_mov_datasets.sources.extract.emt.get_eta", return_value={"code": "00"}) as mock_eta:
+                        with patch("inesdata_mov_datasets.sources.extract.emt.get_eta", return_value=b'{"code": "00"}') as mock_eta:
                             with patch("inesdata_mov_datasets.sources.extract.emt.upload_objs") as mock_upload_objs:
                                 # Ejecución de la función a probar
                                 await get_emt(config)
@@ -446,6 +1174,15 @@ def mock_settings_get_emt_minio():
     settings.sources = MagicMock()
     settings.sources.emt.lines = ["line1", "line2"]  # Ejemplo de líneas
     settings.sources.emt.stops = ["1", "2"]  # Ejemplo de paradas
+    settings.sources.emt.run_deadline = 3600  # Límite holgado para que no se cancele nada
+    settings.sources.emt.concurrency = SourceEmtConcurrencySettings(state_path="/fake/path/emt_concurrency.json")
+    settings.sources.emt.rate_limit = RateLimitSettings()
+    settings.sources.emt.credentials = SourceEmtCredentialsSettings(x_client_id="id", passkey="key")
+    settings.sources.emt.eta_stream_workers = 2
+    settings.sources.emt.eta_dedup = False
+    settings.sources.emt.service_window = SourceEmtServiceWindowSettings()
+    settings.sources.emt.coverage = SourceEmtCoverageSettings()
+    settings.sources.emt.stop_tiers = []
     settings.storage.default = "minio"  # Cambia a "minio" si es necesario
     settings.storage.config.minio.endpoint = "http://localhost:9000"
     settings.storage.config.minio.access_key = "minio_access_key"
@@ -464,7 +1201,7 @@ async def test_get_emt_minio_error_handling(mock_settings_get_emt_minio):
             
             # Simulamos errores en la respuesta de los endpoints
             with patch("inesdata_mov_datasets.sources.extract.emt.get_line_detail", return_value={"code": "01"}):  # Error en line_detail
-                with patch("inesdata_mov_datasets.sources.extract.emt.get_eta", return_value={"code": "01"}):  # Error en ETA
+                with patch("inesdata_mov_datasets.sources.extract.emt.get_eta", return_value=b'{"code": "01"}'):  # Error en ETA
                     with patch("inesdata_mov_datasets.sources.extract.emt.upload_objs") as mock_upload_objs:
                         await get_emt(mock_settings_get_emt_minio)
                         
@@ -0,0 +1,252 @@
+import json
+import pytest
+from unittest.mock import MagicMock
+from inesdata_mov_datasets.settings import SourceEmtStopTierSettings
+from inesdata_mov_datasets import utils
+from inesdata_mov_datasets.sources.extract.emt_schedule import (
+    in_service,
+    learn_stop_lines,
+    line_service_window,
+    load_coverage_state,
+    load_schedule_state,
+    normalize_line,
+    observe_buses,
+    plan_stop_cover,
+    save_coverage_state,
+    save_schedule_state,
+    select_in_service_stops,
+    select_tier_stops,
+    update_service_windows,
+)
+
+LINE_DETAIL = {
+    "code": "00",
+    "data": [
+        {
+            "line": "001",
+            "timeTable": [
+                {
+                    "idDayType": "LA",
+                    "Direction1": {"StartTime": "07:00", "StopTime": "23:00"},
+                    "Direction2": {"StartTime": "06:30", "StopTime": "22:30"},
+                },
+                {
+                    "idDayType": "FE",
+                    "Direction1": {"StartTime": "09:00", "StopTime": "21:00"},
+                    "Direction2": {"StartTime": "09:00", "StopTime": "21:00"},
+                },
+            ],
+        }
+    ],
+}
+
+
+###################### learn_stop_lines
+def test_learn_stop_lines():
+    """Test para verificar que se aprenden las líneas de una parada sin decodificar la respuesta."""
+    stop_lines = {"1": ["27"]}
+    learn_stop_lines(stop_lines, "1", b'{"code":"00","data":[{"Arrive":[{"line":"027"},{"line": "N1"}]}]}')
+    assert stop_lines == {"1": ["27", "N1"]}
+
+    learn_stop_lines(stop_lines, "2", b'{"code": -1}')
+    assert "2" not in stop_lines
+
+
+def test_normalize_line():
+    """Test para verificar que los ceros a la izquierda no distinguen las líneas."""
+    assert normalize_line("001") == normalize_line(1) == "1"
+    assert normalize_line("0") == "0"
+
+
+###################### observe_buses
+def test_observe_buses():
+    """Test para verificar que se guardan los autobuses que llegan a una parada."""
+    observations = {}
+    observe_buses(observations, "1", b'{"code":"00","data":[{"Arrive":[{"line":"027","bus":4680},{"line":"N1","bus":1}]}]}', 100)
+    assert observations == {"1": {"minute": 100, "buses": ["27:4680", "N1:1"]}}
+
+    # Una respuesta con error no sustituye la última observación
+    observe_buses(observations, "1", b'{"code": -1}', 101)
+    assert observations["1"]["minute"] == 100
+
+
+def test_observe_buses_raw():
+    """Test para verificar que cada autobús se empareja con su línea sin decodificar la respuesta."""
+    observations = {}
+    response = (
+        b'{"code": "00", "data": [{"Arrive": ['
+        b'{"line": "27", "stop": "72", "bus": 5535, "geometry": {"type": "Point", "coordinates": [-3.6, 40.4]}},'
+        b'{"line": "N1", "stop": "72", "geometry": {"type": "Point"}},'
+        b'{"line": "5", "stop": "72", "bus": "4680"}'
+        b'], "StopInfo": [{"lines": [{"line": "150"}]}]}]}'
+    )
+    observe_buses(observations, "1", response, 100)
+    # La llegada sin autobús no toma el autobús de la siguiente
+    assert observations["1"]["buses"] == ["27:5535", "5:4680"]
+
+    observe_buses(observations, "2", b'{"code":"00","data":[{"Arrive":[]}]}', 100)
+    assert observations["2"] == {"minute": 100, "buses": []}
+
+
+###################### line_service_window
+def test_line_service_window():
+    """Test para verificar la ventana de servicio de una línea en un tipo de día."""
+    assert line_service_window(LINE_DETAIL, "LA") == [6 * 60 + 30, 23 * 60]
+    assert line_service_window(LINE_DETAIL, "FE") == [9 * 60, 21 * 60]
+    assert line_service_window(LINE_DETAIL, "SA") is None
+
+
+def test_line_service_window_night():
+    """Test para verificar que el servicio nocturno termina pasada la medianoche."""
+    night = {"data": [{"line": "N1", "timeTable": [
+        {"idDayType": "LA", "Direction1": {"StartTime": "23:45", "StopTime": "05:30"}, "Direction2": {}},
+    ]}]}
+    assert line_service_window(night, "LA") == [23 * 60 + 45, 24 * 60 + 5 * 60 + 30]
+
+
+###################### in_service
+def test_in_service():
+    """Test para verificar si una línea está en servicio en un minuto del día."""
+    assert in_service([420, 1380], 600, 0)
+    assert not in_service([420, 1380], 400, 0)
+    assert in_service([420, 1380], 400, 30)
+    # Servicio nocturno del día anterior
+    assert in_service([1425, 1770], 60, 0)
+    assert not in_service([1425, 1770], 600, 0)
+
+
+###################### select_in_service_stops
+def test_select_in_service_stops():
+    """Test para verificar que solo se omiten las paradas con todas sus líneas fuera de servicio."""
+    state = {
+        "stop_lines": {"1": ["1"], "2": ["2"], "3": ["1", "2"], "4": ["3"], "5": ["2"]},
+        "windows": {"lines": {"1": [420, 1380], "2": None}},
+    }
+    # 1: en servicio, 2: sin servicio hoy, 3: alguna línea en servicio,
+    # 4: línea sin ventana conocida, 6: sin líneas vistas
+    stops = ["1", "2", "3", "4", "6"]
+    assert select_in_service_stops(stops, state, 600, 15, 1441) == ["1", "3", "4", "6"]
+    assert select_in_service_stops(stops, state, 100, 15, 1441) == ["4", "6"]
+
+
+def test_select_in_service_stops_probe():
+    """Test para verificar que cada parada omitida se sondea una vez por intervalo."""
+    state = {"stop_lines": {str(stop): ["2"] for stop in range(100)}, "windows": {"lines": {"2": None}}}
+    stops = [str(stop) for stop in range(100)]
+    probes = [select_in_service_stops(stops, state, minute, 15, 10) for minute in range(10)]
+    assert sorted(stop for probe in probes for stop in probe) == sorted(stops)
+
+
+def test_select_in_service_stops_without_windows():
+    """Test para verificar que sin ventanas cargadas se piden todas las paradas."""
+    state = {"stop_lines": {"1": ["1"]}, "windows": {}}
+    assert select_in_service_stops(["1"], state, 100, 15, 1441) == ["1"]
+
+
+###################### update_service_windows
+@pytest.fixture
+def mock_config_local(tmp_path):
+    """Fixture para simular una configuración con almacenamiento local."""
+    config = MagicMock()
+    config.storage.default = "local"
+    config.storage.config.local.path = str(tmp_path)
+    return config
+
+
+def store(tmp_path, object_name, content):
+    """Guarda un objeto en el almacenamiento local de pruebas."""
+    path = tmp_path / object_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(content))
+    return object_name
+
+
+@pytest.mark.asyncio
+async def test_update_service_windows(mock_config_local, tmp_path):
+    """Test para verificar que se cargan las ventanas del día y no se vuelven a leer."""
+    calendar_name = store(tmp_path, "raw/emt/2024/03/11/calendar/calendar_20240311.json",
+                          [{"code": "00", "data": [{"dayType": "LA"}]}])
+    line_name = store(tmp_path, "raw/emt/2024/03/11/line_detail/line_detail_1_20240311.json", LINE_DETAIL)
+    windows = {}
+
+    await update_service_windows(mock_config_local, windows, {calendar_name, line_name}, "2024/03/11", "20240311")
+
+    assert windows["day_type"] == "LA"
+    assert windows["lines"] == {"1": [390, 1380]}
+    assert windows["loaded"] == [line_name]
+
+    # Un objeto ya cargado no se vuelve a leer
+    (tmp_path / line_name).unlink()
+    await update_service_windows(mock_config_local, windows, {calendar_name, line_name}, "2024/03/11", "20240311")
+    assert windows["lines"] == {"1": [390, 1380]}
+
+    # Un día nuevo empieza sin ventanas
+    await update_service_windows(mock_config_local, windows, set(), "2024/03/12", "20240312")
+    assert windows == {"date": "2024/03/12", "day_type": None, "lines": {}, "loaded": []}
+
+
+###################### load_schedule_state
+def test_save_and_load_schedule_state(tmp_path):
+    """Test para verificar que el estado se conserva entre procesos y en memoria."""
+    state_path = tmp_path / "emt_schedule.json"
+    save_schedule_state(state_path, {"stop_lines": {"1": ["1"]}, "windows": {}})
+
+    utils._json_states.clear()
+    state = load_schedule_state(state_path)
+    assert state["stop_lines"] == {"1": ["1"]}
+    assert load_schedule_state(state_path) is state
+    assert load_schedule_state(tmp_path / "missing.json") == {"stop_lines": {}, "windows": {}}
+
+
+###################### load_coverage_state
+def test_save_and_load_coverage_state(tmp_path):
+    """Test para verificar que el estado de cobertura solo guarda las observaciones."""
+    state_path = tmp_path / "emt_coverage.json"
+    state = load_coverage_state(state_path)
+    assert state == {"observations": {}}
+
+    state["observations"]["1"] = {"minute": 10, "buses": ["1:10"]}
+    save_coverage_state(state_path, state)
+    assert json.loads(state_path.read_text()) == {"observations": {"1": {"minute": 10, "buses": ["1:10"]}}}
+
+
+###################### plan_stop_cover
+def test_plan_stop_cover():
+    """Test para verificar que se eligen las mínimas paradas que observan todos los autobuses."""
+    observations = {
+        "1": {"minute": 100, "buses": ["1:10", "1:11"]},
+        "2": {"minute": 100, "buses": ["1:10", "1:11", "2:20"]},
+        "3": {"minute": 100, "buses": ["2:20"]},
+        "4": {"minute": 100, "buses": ["2:21"]},
+        "5": {"minute": 90, "buses": ["2:22"]},
+    }
+    # 2 y 4 cubren todos los autobuses, 5 está caducada y 6 no se ha observado nunca
+    assert plan_stop_cover(["1", "2", "3", "4", "5", "6"], observations, 101, 1441) == ["2", "4", "5", "6"]
+
+
+def test_plan_stop_cover_refresh():
+    """Test para verificar que cada parada se vuelve a pedir una vez por intervalo de caducidad."""
+    observations = {str(stop): {"minute": 100, "buses": ["1:10"]} for stop in range(100)}
+    stops = [str(stop) for stop in range(100)]
+    plans = [plan_stop_cover(stops, observations, minute, 5) for minute in range(101, 106)]
+    assert {stop for plan in plans for stop in plan} == set(stops)
+    assert all(len(plan) < len(stops) for plan in plans)
+
+
+###################### select_tier_stops
+def test_select_tier_stops():
+    """Test para verificar que cada nivel se pide con su frecuencia y repartido entre los minutos."""
+    stops = list(range(1, 22))
+    stop_tiers = [
+        SourceEmtStopTierSettings(every=2, stops=list(range(2, 12))),
+        SourceEmtStopTierSettings(every=5, stops=list(range(12, 22))),
+    ]
+    runs = [select_tier_stops(stops, stop_tiers, minute) for minute in range(10)]
+
+    # La parada 1 no está en ningún nivel y se pide siempre
+    assert all(1 in run for run in runs)
+    # Cada parada se pide tantas veces como le corresponde en 10 minutos
+    assert all(sum(stop in run for run in runs) == 5 for stop in range(2, 12))
+    assert all(sum(stop in run for run in runs) == 2 for stop in range(12, 22))
+    # La carga es la misma en todos los minutos: 1 + 10 / 2 + 10 / 5
+    assert all(len(run) == 8 for run in runs)
@@ -1,23 +1,31 @@
 import pytest
 import asyncio
 from unittest.mock import MagicMock,patch, mock_open
-from inesdata_mov_datasets.sources.extract.informo import get_informo, save_informo
-import xmltodict
+from inesdata_mov_datasets.sources.extract.informo import INFORMO_URL, fetch_informo_if_changed, get_informo, informo_json_chunks, informo_validators_path, iter_informo_elements, load_informo_validators, parse_informo, save_informo, save_informo_validators
+from inesdata_mov_datasets import utils
+from aiohttp import ClientSession
+from aioresponses import aioresponses
+from yarl import URL
 from pathlib import Path
 from loguru import logger
 import json
+import xmltodict
 import pytz
 import datetime
 
+XML_INFORMO = b"<pms><fecha_hora>09/10/2024 14:30:00</fecha_hora><pm><idelem>1</idelem></pm></pms>"
+
 
 ###################### get_informo
 @pytest.fixture
-def mock_settings():
+def mock_settings(tmp_path):
     """Fixture para simular la configuración de settings."""
     settings = MagicMock()
     settings.sources = MagicMock()
     settings.sources.informo.credentials = MagicMock()
     settings.sources.informo.credentials.api_key = "test-api-key"
+    settings.sources.informo.state_path = None
+    settings.storage.logs.path = str(tmp_path)
     return settings
 
 # Parcheamos las dependencias de la función get_informo
@@ -25,20 +33,20 @@ def mock_settings():
 @patch('inesdata_mov_datasets.sources.extract.informo.logger.info')  
 @patch('inesdata_mov_datasets.sources.extract.informo.logger.debug')  
 @patch('inesdata_mov_datasets.sources.extract.informo.logger.error')  
-@patch('inesdata_mov_datasets.sources.extract.informo.requests.get')  
 @patch('inesdata_mov_datasets.sources.extract.informo.save_informo')  
 @pytest.mark.asyncio
-async def test_get_informo(mock_save_informo, mock_requests_get, mock_error, mock_debug, mock_info, mock_instantiate_logger, mock_settings):
+async def test_get_informo(mock_save_informo, mock_error, mock_debug, mock_info, mock_instantiate_logger, mock_settings):
     """Test para verificar la extracción de datos de INFORMO."""
     
-    # Configurar la respuesta simulada de requests.get
-    mock_response_content = "<xml><data>Datos de ejemplo</data></xml>"
-    mock_requests_get.return_value = MagicMock(status_code=200, content=mock_response_content)
+    # Configurar la respuesta simulada de Informo
+    with aioresponses() as m:
+        m.get(INFORMO_URL, body=XML_INFORMO)
 
-    # Ejecutar la función
-    await get_informo(mock_settings)
+        # Ejecutar la función
+        await get_informo(mock_settings)
 
-    parsed_data = xmltodict.parse(mock_response_content)
+        # Verificar que se llama a Informo una vez
+        assert len(m.requests[("GET", URL(INFORMO_URL))]) == 1
 
     # Verificar que se llama a instantiate_logger
     mock_instantiate_logger.assert_called_once_with(mock_settings, "INFORMO", "extract")
@@ -47,37 +55,124 @@ async def test_get_informo(mock_save_informo, mock_requests_get, mock_error, moc
     mock_info.assert_any_call("Extracting INFORMO")
     mock_info.assert_any_call("Extracted INFORMO")
 
-    # Verificar que se llama a requests.get una vez
-    mock_requests_get.assert_called_once_with("https://informo.madrid.es/informo/tmadrid/pm.xml")
     # Verificar que se llama a save_informo con los datos obtenidos
-    mock_save_informo.assert_called_once_with(mock_settings, parsed_data)
+    mock_save_informo.assert_called_once()
+    data = mock_save_informo.call_args.args[1]
+    assert data["pms"]["fecha_hora"] == "09/10/2024 14:30:00"
+    assert list(data["pms"]["pm"]) == [{"idelem": "1"}]
 
     # Verificar que se llama a logger.debug
     mock_debug.assert_called()
 
+@patch('inesdata_mov_datasets.sources.extract.informo.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.informo.save_informo')
+@pytest.mark.asyncio
+async def test_get_informo_not_changed(mock_save_informo, mock_instantiate_logger, mock_settings):
+    """Test para verificar que un XML sin cambios no se procesa ni se guarda."""
+    with aioresponses() as m:
+        m.get(INFORMO_URL, body=XML_INFORMO, headers={"ETag": '"v1"'})
+        m.get(INFORMO_URL, body=XML_INFORMO, headers={"ETag": '"v2"'})
+
+        await get_informo(mock_settings)
+        await get_informo(mock_settings)
+
+        # La segunda llamada es condicional al ETag de la primera
+        second_call = m.requests[("GET", URL(INFORMO_URL))][1]
+        assert second_call.kwargs["headers"]["If-None-Match"] == '"v1"'
+
+    mock_save_informo.assert_called_once()
+    # Los validadores se guardan para los siguientes procesos
+    validators_path = informo_validators_path(mock_settings)
+    assert json.loads(validators_path.read_text()) == {"etag": '"v2"', "last_modified": None, "fecha_hora": "09/10/2024 14:30:00"}
+
+
+@patch('inesdata_mov_datasets.sources.extract.informo.instantiate_logger')
+@patch('inesdata_mov_datasets.sources.extract.informo.save_informo', side_effect=Exception("Error al guardar"))
+@pytest.mark.asyncio
+async def test_get_informo_validators_after_save(mock_save_informo, mock_instantiate_logger, mock_settings):
+    """Test para verificar que si falla el guardado no se recuerdan los validadores."""
+    with aioresponses() as m:
+        m.get(INFORMO_URL, body=XML_INFORMO, headers={"ETag": '"v1"'})
+
+        await get_informo(mock_settings)
+
+    assert load_informo_validators(informo_validators_path(mock_settings)) == {}
+
+
+###################### fetch_informo_if_changed
+@pytest.mark.asyncio
+async def test_fetch_informo_if_changed_not_modified():
+    """Test para verificar que una respuesta 304 no descarga el XML."""
+    validators = {"etag": '"v1"', "last_modified": "Wed, 09 Oct 2024 12:30:00 GMT", "fecha_hora": "09/10/2024 14:30:00"}
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.get(INFORMO_URL, status=304)
+
+            content, received = await fetch_informo_if_changed(session, validators)
+
+            headers = m.requests[("GET", URL(INFORMO_URL))][0].kwargs["headers"]
+
+    assert content is None
+    assert received is validators
+    assert headers == {"If-None-Match": '"v1"', "If-Modified-Since": "Wed, 09 Oct 2024 12:30:00 GMT"}
+
+
+@pytest.mark.asyncio
+async def test_fetch_informo_if_changed_new_fecha_hora():
+    """Test para verificar que un XML con otra fecha_hora se descarga entero."""
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.get(INFORMO_URL, body=XML_INFORMO)
+
+            content, received = await fetch_informo_if_changed(session, {"fecha_hora": "09/10/2024 14:25:00"})
+
+    assert content == XML_INFORMO
+    assert received["fecha_hora"] == "09/10/2024 14:30:00"
+
+
+###################### save_informo_validators
+def test_save_and_load_informo_validators(tmp_path):
+    """Test para verificar que los validadores se conservan entre procesos."""
+    state_path = tmp_path / "informo_validators.json"
+    save_informo_validators(state_path, {"etag": '"v1"'})
+    utils._json_states.clear()
+
+    assert load_informo_validators(state_path) == {"etag": '"v1"'}
+    assert load_informo_validators(tmp_path / "missing.json") == {}
+
+
+def test_informo_validators_path(mock_settings, tmp_path):
+    """Test para verificar el fichero de los validadores, configurable o en la carpeta de logs."""
+    assert informo_validators_path(mock_settings) == tmp_path / "informo_validators.json"
+
+    mock_settings.sources.informo.state_path = str(tmp_path / "state" / "validators.json")
+    assert informo_validators_path(mock_settings) == tmp_path / "state" / "validators.json"
+
 # Fixture para simular la configuración de settings
 @pytest.fixture
-def mock_settings():
+def mock_settings(tmp_path):
     """Fixture para simular la configuración de settings."""
     settings = MagicMock()
     settings.sources = MagicMock()
     settings.sources.informo.credentials = MagicMock()
     settings.sources.informo.credentials.api_key = "test-api-key"
+    settings.sources.informo.state_path = None
+    settings.storage.logs.path = str(tmp_path)
     return settings
 
 # Test para manejar un error HTTP en la solicitud
 @patch('inesdata_mov_datasets.sources.extract.informo.instantiate_logger')   
 @patch('inesdata_mov_datasets.sources.extract.informo.logger.error')   
-@patch('inesdata_mov_datasets.sources.extract.informo.requests.get')   
 @pytest.mark.asyncio
-async def test_get_informo_http_error(mock_requests_get, mock_error_logger, mock_instantiate_logger, mock_settings):
+async def test_get_informo_http_error(mock_error_logger, mock_instantiate_logger, mock_settings):
     """Test para verificar que se captura un error HTTP."""
     
-    # Simular una excepción en requests.get
-    mock_requests_get.side_effect = Exception("Error en la conexión")
+    # Simular una excepción en la conexión
+    with aioresponses() as m:
+        m.get(INFORMO_URL, exception=Exception("Error en la conexión"))
 
-    # Ejecutar la función
-    await get_informo(mock_settings)
+        # Ejecutar la función
+        await get_informo(mock_settings)
 
     # Verificar que se llama a instantiate_logger
     mock_instantiate_logger.assert_called_once_with(mock_settings, "INFORMO", "extract")
@@ -88,18 +183,17 @@ async def test_get_informo_http_error(mock_requests_get, mock_error_logger, mock
 # Test para manejar un error de parsing XML
 @patch('inesdata_mov_datasets.sources.extract.informo.instantiate_logger')   
 @patch('inesdata_mov_datasets.sources.extract.informo.logger.error')   
-@patch('inesdata_mov_datasets.sources.extract.informo.requests.get')   
 @patch('inesdata_mov_datasets.sources.extract.informo.save_informo')  
 @pytest.mark.asyncio
-async def test_get_informo_xml_parsing(mock_save_informo, mock_requests_get, mock_error_logger, mock_instantiate_logger, mock_settings):
+async def test_get_informo_xml_parsing(mock_save_informo, mock_error_logger, mock_instantiate_logger, mock_settings):
     """Test para verificar que se captura un error de parsing XML."""
     
     # Simular una respuesta XML no válida
-    mock_response = MagicMock(status_code=200, content="Invalid XML")
-    mock_requests_get.return_value = mock_response
+    with aioresponses() as m:
+        m.get(INFORMO_URL, body="Invalid XML")
 
-    # Ejecutar la función
-    await get_informo(mock_settings)
+        # Ejecutar la función
+        await get_informo(mock_settings)
 
     # Verificar que se llama a instantiate_logger
     mock_instantiate_logger.assert_called_once_with(mock_settings, "INFORMO", "extract")
@@ -141,14 +235,14 @@ def mock_data():
     }
 
 # Test para la funcionalidad de Minio
-@patch('inesdata_mov_datasets.sources.extract.informo.check_s3_file_exists')  # Parchea la función que verifica si el archivo existe en Minio
+@patch('inesdata_mov_datasets.sources.extract.informo.list_stored_objs')  # Parchea la función que lista los objetos del día
 @patch('inesdata_mov_datasets.sources.extract.informo.upload_objs')  # Parchea la función que sube los objetos a Minio
 @pytest.mark.asyncio
-async def test_save_informo_minio(mock_upload_objs, mock_check_s3_file_exists, mock_settings_minio, mock_data):
+async def test_save_informo_minio(mock_upload_objs, mock_list_stored_objs, mock_settings_minio, mock_data):
     """Test para verificar el almacenamiento en Minio."""
     
     # Simular que el archivo no existe en Minio
-    mock_check_s3_file_exists.return_value = False
+    mock_list_stored_objs.return_value = set()
 
     # Llamar a la función
     await save_informo(mock_settings_minio, mock_data)
@@ -163,27 +257,25 @@ async def test_save_informo_minio(mock_upload_objs, mock_check_s3_file_exists, m
         "%Y/%m/%d"
     ) 
     
-    # Verificar que se llamó a check_s3_file_exists con los argumentos correctos
-    mock_check_s3_file_exists.assert_called_once_with(
-        endpoint_url=mock_settings_minio.storage.config.minio.endpoint,
-        aws_secret_access_key=mock_settings_minio.storage.config.minio.secret_key,
-        aws_access_key_id=mock_settings_minio.storage.config.minio.access_key,
-        bucket_name=mock_settings_minio.storage.config.minio.bucket,
-        object_name=f"raw/informo/{formatted_date_slash}/informo_{formated_date}.json"
+    # Verificar que se listaron los objetos del día con los argumentos correctos
+    mock_list_stored_objs.assert_called_once_with(
+        mock_settings_minio, [f"raw/informo/{formatted_date_slash}/"], s3_client=None
     )
 
     # Verificar que se llamó a upload_objs para subir el archivo
     mock_upload_objs.assert_called_once()
+    uploaded = mock_upload_objs.call_args.args[4]
+    assert list(uploaded) == [f"raw/informo/{formatted_date_slash}/informo_{formated_date}.json"]
     
 # Test para la funcionalidad de almacenamiento local
-@patch('inesdata_mov_datasets.sources.extract.informo.check_local_file_exists')  # Parchea la función que verifica si el archivo existe localmente
+@patch('inesdata_mov_datasets.sources.extract.informo.list_stored_objs')  # Parchea la función que lista los objetos del día
 @patch('builtins.open', new_callable=mock_open)  # Parchea 'open' para evitar escribir en el sistema de archivos real
 @pytest.mark.asyncio
-async def test_save_informo_local(mock_open_func, mock_check_local_file_exists, mock_settings_local, mock_data):
+async def test_save_informo_local(mock_open_func, mock_list_stored_objs, mock_settings_local, mock_data):
     """Test para verificar el almacenamiento local."""
     
     # Simular que el archivo no existe en local
-    mock_check_local_file_exists.return_value = False
+    mock_list_stored_objs.return_value = set()
 
     # Llamar a la función
     await save_informo(mock_settings_local, mock_data)
@@ -197,14 +289,100 @@ async def test_save_informo_local(mock_open_func, mock_check_local_file_exists,
         "%Y/%m/%d"
     ) 
 
-    # Verificar que se llamó a check_local_file_exists con los argumentos correctos
-    mock_check_local_file_exists.assert_called_once_with(
-        Path(f"/tmp/raw/informo/{formatted_date_slash}"),
-        f"informo_{formated_date}.json"
+    # Verificar que se listaron los objetos del día con los argumentos correctos
+    mock_list_stored_objs.assert_called_once_with(
+        mock_settings_local, [f"raw/informo/{formatted_date_slash}/"], s3_client=None
     )
 
     # Verificar que se abrió el archivo correctamente para escribir los datos
     mock_open_func.assert_called_once_with(Path(f"/tmp/raw/informo/{formatted_date_slash}") / f"informo_{formated_date}.json", "w")
 
     # Verificar que se escribió el contenido JSON en el archivo
-    mock_open_func().write.assert_called_once_with(json.dumps(mock_data))
\ No newline at end of file
+    written = "".join(call.args[0] for call in mock_open_func().write.call_args_list)
+    assert written == json.dumps(mock_data)
+
+@patch('inesdata_mov_datasets.sources.extract.informo.list_stored_objs', return_value=set())
+@pytest.mark.asyncio
+async def test_save_informo_local_parsed(mock_list_stored_objs, tmp_path):
+    """Test para verificar que los puntos de medida se guardan según se leen del XML."""
+    settings = MagicMock()
+    settings.storage.default = "local"
+    settings.storage.config.local.path = str(tmp_path)
+
+    await save_informo(settings, parse_informo(XML_PM))
+
+    stored = json.loads(next(tmp_path.glob("raw/informo/*/*/*/informo_*.json")).read_text())
+    assert stored["pms"]["fecha_hora"] == "09/10/2024 14:30:00"
+    assert stored["pms"]["pm"][0]["st_x"] == "440123,45"
+
+
+###################### parse_informo
+XML_PM = b"""<?xml version="1.0" encoding="UTF-8"?>
+<pms>
+  <fecha_hora>09/10/2024 14:30:00</fecha_hora>
+  <pm>
+    <idelem>3409</idelem>
+    <descripcion>Calle de Alcal\xc3\xa1</descripcion>
+    <intensidad>120</intensidad>
+    <ocupacion>4</ocupacion>
+    <carga>12</carga>
+    <nivelServicio>0</nivelServicio>
+    <intensidadSat></intensidadSat>
+    <error>N</error>
+    <st_x>440123,45</st_x>
+    <st_y>4474567,89</st_y>
+  </pm>
+  <pm>
+    <idelem>3410</idelem>
+    <intensidad>80</intensidad>
+  </pm>
+</pms>"""
+
+
+def test_parse_informo():
+    """Test para verificar que los puntos de medida se leen uno a uno, como texto como con xmltodict."""
+    data = parse_informo(XML_PM)
+
+    assert data["pms"]["fecha_hora"] == "09/10/2024 14:30:00"
+    records = list(data["pms"]["pm"])
+    assert records == [
+        {
+            "idelem": "3409",
+            "descripcion": "Calle de Alcalá",
+            "intensidad": "120",
+            "ocupacion": "4",
+            "carga": "12",
+            "nivelServicio": "0",
+            "intensidadSat": None,
+            "error": "N",
+            "st_x": "440123,45",
+            "st_y": "4474567,89",
+        },
+        {"idelem": "3410", "intensidad": "80"},
+    ]
+    # El mismo formato que se guardaba con xmltodict
+    assert records == xmltodict.parse(XML_PM)["pms"]["pm"]
+
+
+def test_parse_informo_without_fecha_hora():
+    """Test para verificar que un XML sin fecha_hora no se da por válido."""
+    with pytest.raises(ValueError):
+        parse_informo(b"<pms><pm><idelem>1</idelem></pm></pms>")
+
+
+def test_iter_informo_elements_small_chunks():
+    """Test para verificar que el XML se lee por trozos sin guardar los puntos ya leídos."""
+    with patch('inesdata_mov_datasets.sources.extract.informo.PARSE_CHUNK_BYTES', 16):
+        elements = list(iter_informo_elements(XML_PM))
+
+    assert [tag for tag, _ in elements] == ["fecha_hora", "pm", "pm"]
+
+
+###################### informo_json_chunks
+def test_informo_json_chunks():
+    """Test para verificar que el json por trozos es el mismo que el de json.dumps."""
+    data = {"pms": {"fecha_hora": "09/10/2024 14:30:00", "pm": [{"idelem": 1}, {"idelem": 2}]}}
+    assert "".join(informo_json_chunks(data)) == json.dumps(data)
+
+    data["pms"]["pm"] = {"idelem": 1}
+    assert "".join(informo_json_chunks(data)) == json.dumps(data)
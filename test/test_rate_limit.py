@@ -0,0 +1,77 @@
+import pytest
+import asyncio
+import time
+from inesdata_mov_datasets.handlers.rate_limit import TokenBucket, get_token_bucket
+from inesdata_mov_datasets.settings import RateLimitSettings
+
+
+###################### TokenBucket
+@pytest.mark.asyncio
+async def test_token_bucket_burst_without_waiting():
+    """Test para verificar que las llamadas dentro de la ráfaga no esperan."""
+    bucket = TokenBucket(rate=1, burst=3)
+    for _ in range(3):
+        await bucket.acquire()
+
+    assert bucket.calls == 3
+    assert bucket.waits == 0
+    assert bucket.wait_time == 0
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_waits_over_rate():
+    """Test para verificar que por encima de la ráfaga se respeta la tasa y se cuenta la espera."""
+    bucket = TokenBucket(rate=20, burst=1)
+    start = time.monotonic()
+    await asyncio.gather(*[bucket.acquire() for _ in range(3)])
+    elapsed = time.monotonic() - start
+
+    # 1 llamada de la ráfaga + 2 llamadas a 20 por segundo
+    assert elapsed >= 0.09
+    assert bucket.waits == 2
+    assert bucket.wait_time == pytest.approx(0.05 + 0.1, abs=0.01)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_cancelled_wait_returns_token():
+    """Test para verificar que una espera cancelada devuelve el token reservado."""
+    bucket = TokenBucket(rate=1, burst=1)
+    await bucket.acquire()
+
+    waiting = asyncio.ensure_future(bucket.acquire())
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+
+    assert bucket.tokens > -0.5
+
+
+def test_token_bucket_expected_wait():
+    """Test para verificar la espera estimada de la siguiente llamada."""
+    bucket = TokenBucket(rate=10, burst=1)
+    assert bucket.expected_wait() == 0
+
+    bucket.tokens = -1
+    assert 0.15 < bucket.expected_wait() <= 0.2
+
+
+###################### get_token_bucket
+def test_get_token_bucket():
+    """Test para verificar que el limitador se comparte y que sin tasa no hay limitador."""
+    assert get_token_bucket(RateLimitSettings()) is None
+
+    settings = RateLimitSettings(rate=5, burst=2)
+    bucket = get_token_bucket(settings)
+    assert bucket.rate == 5
+    assert bucket.burst == 2
+    assert get_token_bucket(RateLimitSettings(rate=5, burst=2)) is bucket
+
+
+def test_get_token_bucket_by_key():
+    """Test para verificar que cada credencial tiene su propio limitador."""
+    settings = RateLimitSettings(rate=7, burst=2)
+    bucket_a = get_token_bucket(settings, key="client_a")
+    bucket_b = get_token_bucket(settings, key="client_b")
+    assert bucket_a is not bucket_b
+    assert get_token_bucket(settings, key="client_a") is bucket_a
@@ -0,0 +1,105 @@
+import pytest
+import asyncio
+from unittest.mock import patch
+from inesdata_mov_datasets.handlers import response_cache
+from inesdata_mov_datasets.handlers.response_cache import cached_fetch, clear_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """Fixture para empezar cada test con la caché vacía."""
+    clear_cache()
+    yield
+    clear_cache()
+
+
+def counting_fetch(calls, value="response", delay=0):
+    """Devuelve una función de petición que cuenta sus llamadas."""
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return value
+    return fetch
+
+
+###################### cached_fetch
+@pytest.mark.asyncio
+async def test_cached_fetch_reuses_response():
+    """Test para verificar que la respuesta se reutiliza mientras no caduca."""
+    calls = []
+    assert await cached_fetch(("emt_eta", "1", "27"), 20, counting_fetch(calls)) == "response"
+    assert await cached_fetch(("emt_eta", "1", "27"), 20, counting_fetch(calls)) == "response"
+    assert len(calls) == 1
+
+    # Otra parada es otra clave
+    await cached_fetch(("emt_eta", "2", "27"), 20, counting_fetch(calls))
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_fetch_expires():
+    """Test para verificar que una respuesta caducada se vuelve a pedir."""
+    calls = []
+    with patch("inesdata_mov_datasets.handlers.response_cache.time.monotonic", return_value=100):
+        await cached_fetch("key", 20, counting_fetch(calls))
+    with patch("inesdata_mov_datasets.handlers.response_cache.time.monotonic", return_value=119):
+        await cached_fetch("key", 20, counting_fetch(calls))
+        assert len(calls) == 1
+    with patch("inesdata_mov_datasets.handlers.response_cache.time.monotonic", return_value=121):
+        await cached_fetch("key", 20, counting_fetch(calls))
+        assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_fetch_coalesces_concurrent_requests():
+    """Test para verificar que las peticiones concurrentes comparten una única llamada."""
+    calls = []
+    responses = await asyncio.gather(
+        *[cached_fetch("key", 0, counting_fetch(calls, delay=0.01)) for _ in range(10)]
+    )
+    assert responses == ["response"] * 10
+    assert len(calls) == 1
+    assert response_cache._inflight == {}
+    # Con ttl 0 no se guarda la respuesta
+    assert response_cache._entries == {}
+
+
+@pytest.mark.asyncio
+async def test_cached_fetch_not_cacheable():
+    """Test para verificar que no se guardan las respuestas con error."""
+    calls = []
+    error = {"code": -1}
+    await cached_fetch("key", 20, counting_fetch(calls, error), cacheable=lambda r: r["code"] == "00")
+    await cached_fetch("key", 20, counting_fetch(calls, error), cacheable=lambda r: r["code"] == "00")
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_fetch_exception():
+    """Test para verificar que una excepción llega a todas las peticiones y no se guarda."""
+    async def failing_fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream error")
+
+    results = await asyncio.gather(
+        cached_fetch("key", 20, failing_fetch), cached_fetch("key", 20, failing_fetch),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+
+    calls = []
+    assert await cached_fetch("key", 20, counting_fetch(calls)) == "response"
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_fetch_cancelled_request():
+    """Test para verificar que cancelar una petición no cancela la llamada de las demás."""
+    calls = []
+    first = asyncio.ensure_future(cached_fetch("key", 20, counting_fetch(calls, delay=0.01)))
+    second = asyncio.ensure_future(cached_fetch("key", 20, counting_fetch(calls, delay=0.01)))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == "response"
+    assert len(calls) == 1
@@ -0,0 +1,196 @@
+import pytest
+import asyncio
+import datetime
+import email.utils
+import aiohttp
+from aiohttp import ClientSession
+from aioresponses import aioresponses
+from unittest.mock import AsyncMock, patch
+from inesdata_mov_datasets.handlers.retry import is_retryable_code, parse_retry_after, request_json, response_code, retry_delay
+from inesdata_mov_datasets.settings import SourceEmtRetrySettings
+
+URL = "https://openapi.emtmadrid.es/v2/transport/busemtmad/stops/1/arrives/"
+
+
+###################### parse_retry_after
+def test_parse_retry_after_seconds():
+    """Test para verificar el Retry-After en segundos."""
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("not a date") is None
+
+
+def test_parse_retry_after_date():
+    """Test para verificar el Retry-After como fecha http."""
+    retry_date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    seconds = parse_retry_after(email.utils.format_datetime(retry_date, usegmt=True))
+    assert 25 < seconds <= 30
+
+
+###################### retry_delay
+def test_retry_delay_backoff():
+    """Test para verificar que la espera crece exponencialmente sin pasar del máximo."""
+    retry = SourceEmtRetrySettings(backoff_base=1, backoff_max=5)
+    for _ in range(20):
+        assert 0 <= retry_delay(retry, 1) <= 1
+        assert 0 <= retry_delay(retry, 2) <= 2
+        assert 0 <= retry_delay(retry, 10) <= 5
+
+
+def test_retry_delay_retry_after():
+    """Test para verificar que se respeta el Retry-After del servidor."""
+    retry = SourceEmtRetrySettings(backoff_base=1, backoff_max=5)
+    assert retry_delay(retry, 1, retry_after=10) == 10
+
+
+###################### response_code
+def test_response_code():
+    """Test para verificar la lectura del código sin decodificar la respuesta."""
+    assert response_code(b'{"code":"00","description":"ok","data":[{"code":"99"}]}') == "00"
+    assert response_code(b'{"code": -1}') == "-1"
+    assert response_code(b'{"data": []}') is None
+
+
+###################### is_retryable_code
+def test_is_retryable_code():
+    """Test para verificar qué códigos de respuesta de EMT se reintentan."""
+    retry = SourceEmtRetrySettings()
+    assert not is_retryable_code(retry, {"code": "00"})
+    assert is_retryable_code(retry, {"code": "90"})
+    assert not is_retryable_code(retry, [])
+
+    retry = SourceEmtRetrySettings(retry_codes=["90"])
+    assert is_retryable_code(retry, {"code": "90"})
+    assert not is_retryable_code(retry, {"code": "81"})
+
+
+def test_is_retryable_code_success_codes():
+    """Test para verificar que los códigos de éxito del endpoint no se reintentan."""
+    assert not is_retryable_code(SourceEmtRetrySettings(), {"code": "01"}, ("00", "01"))
+    retry = SourceEmtRetrySettings(retry_codes=["01", "90"])
+    assert not is_retryable_code(retry, {"code": "01"}, ("00", "01"))
+    assert is_retryable_code(retry, {"code": "90"}, ("00", "01"))
+
+
+###################### request_json
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_request_json_retries_status(mock_sleep):
+    """Test para verificar que un estado reintentable se reintenta respetando Retry-After."""
+    retry = SourceEmtRetrySettings(max_attempts=3, backoff_base=0.1, backoff_max=0.1)
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, status=429, headers={"Retry-After": "2"})
+            m.post(URL, payload={"code": "00"})
+
+            result = await request_json(session, "POST", URL, retry=retry)
+
+    assert result == {"code": "00"}
+    mock_sleep.assert_awaited_once_with(2)
+
+
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_request_json_retries_code(mock_sleep):
+    """Test para verificar que un código de EMT reintentable se reintenta."""
+    retry = SourceEmtRetrySettings(max_attempts=3)
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, payload={"code": "90"})
+            m.post(URL, exception=asyncio.TimeoutError())
+            m.post(URL, payload={"code": "00"})
+
+            result = await request_json(session, "POST", URL, retry=retry)
+
+    assert result == {"code": "00"}
+    assert mock_sleep.await_count == 2
+
+
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_request_json_not_retryable_status(mock_sleep):
+    """Test para verificar que un estado no reintentable falla en el primer intento."""
+    retry = SourceEmtRetrySettings(max_attempts=3)
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, status=404)
+
+            with pytest.raises(aiohttp.ClientResponseError):
+                await request_json(session, "POST", URL, retry=retry)
+
+    mock_sleep.assert_not_awaited()
+
+
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_request_json_attempts_exhausted(mock_sleep):
+    """Test para verificar que al agotar los intentos se devuelve la última respuesta."""
+    retry = SourceEmtRetrySettings(max_attempts=2)
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, payload={"code": "90"})
+            m.post(URL, payload={"code": "91"})
+
+            result = await request_json(session, "POST", URL, retry=retry)
+
+    assert result == {"code": "91"}
+    mock_sleep.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_request_json_single_attempt():
+    """Test para verificar que sin política de reintentos se hace un único intento."""
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, status=503)
+
+            with pytest.raises(aiohttp.ClientResponseError):
+                await request_json(session, "POST", URL)
+
+
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_request_json_limiter(mock_sleep):
+    """Test para verificar que cada intento informa al limitador de si hubo sobrecarga."""
+    limiter = AsyncMock()
+    limiter.acquire.return_value = 0.0
+    retry = SourceEmtRetrySettings(max_attempts=2)
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, status=429)
+            m.post(URL, payload={"code": "00"})
+
+            result = await request_json(session, "POST", URL, retry=retry, limiter=limiter)
+
+    assert result == {"code": "00"}
+    assert limiter.acquire.await_count == 2
+    assert [call.args[1] for call in limiter.release.await_args_list] == [True, False]
+
+
+@pytest.mark.asyncio
+async def test_request_json_rate_limiter():
+    """Test para verificar que cada intento pasa por el limitador de tasa."""
+    rate_limiter = AsyncMock()
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, payload={"code": "00"})
+
+            await request_json(session, "POST", URL, rate_limiter=rate_limiter)
+
+    rate_limiter.acquire.assert_awaited_once()
+
+
+@patch("inesdata_mov_datasets.handlers.retry.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_request_json_raw(mock_sleep):
+    """Test para verificar que en modo raw se devuelve el cuerpo tal cual y se reintenta por código."""
+    retry = SourceEmtRetrySettings(max_attempts=2)
+    async with ClientSession() as session:
+        with aioresponses() as m:
+            m.post(URL, body=b'{"code":"90"}')
+            m.post(URL, body=b'{"code":"00","data":[]}')
+
+            result = await request_json(session, "POST", URL, retry=retry, raw=True)
+
+    assert result == b'{"code":"00","data":[]}'
+    mock_sleep.assert_awaited_once()
@@ -1,6 +1,7 @@
 import yaml
 from inesdata_mov_datasets.settings import SourceEmtSettings, StorageSettings
 import pytest
+from unittest.mock import patch
 
 yaml_config = """
 sources:
@@ -51,3 +52,65 @@ def test_wrong_storage():
     with pytest.raises(ValueError):
         StorageSettings(**settings["storage"])
 
+
+def test_emt_credentials_list():
+    yaml_config = """
+        sources:
+            emt:
+                credentials:
+                    - x_client_id: id_1
+                      passkey: key_1
+                    - email: a@b.c
+                      password: pass
+                      rate_limit:
+                          rate: 5
+                stops: [1,2]
+                lines: [1]
+        """
+
+    settings = yaml.safe_load(yaml_config)
+    emt = SourceEmtSettings(**settings["sources"]["emt"])
+    assert len(emt.credentials) == 2
+    assert emt.credentials[1].rate_limit.rate == 5
+    assert emt.credentials_strategy == "round_robin"
+
+
+def test_emt_stop_tiers_not_in_stops():
+    yaml_config = """
+        sources:
+            emt:
+                credentials:
+                    x_client_id: id_1
+                    passkey: key_1
+                stops: [1,2]
+                stop_tiers:
+                    - every: 2
+                      stops: [2,3]
+                lines: [1]
+        """
+
+    settings = yaml.safe_load(yaml_config)
+    # a tier stop that is not polled is an error, not a silently skipped stop
+    with pytest.raises(ValueError, match=r"\[3\]"):
+        SourceEmtSettings(**settings["sources"]["emt"])
+
+
+def test_emt_zstd_without_zstandard():
+    yaml_config = """
+        sources:
+            emt:
+                credentials:
+                    x_client_id: id_1
+                    passkey: key_1
+                stops: [1,2]
+                lines: [1]
+                eta_compression: zstd
+        """
+
+    settings = yaml.safe_load(yaml_config)
+    assert SourceEmtSettings(**settings["sources"]["emt"]).eta_compression == "zstd"
+
+    # without the zstandard package, zstd is rejected when the settings are read
+    with patch("inesdata_mov_datasets.settings.importlib.util.find_spec", return_value=None):
+        with pytest.raises(ValueError, match="zstandard"):
+            SourceEmtSettings(**settings["sources"]["emt"])
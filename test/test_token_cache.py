@@ -0,0 +1,103 @@
+import pytest
+import asyncio
+import concurrent.futures
+import time
+from inesdata_mov_datasets.handlers import token_cache
+from inesdata_mov_datasets.handlers.token_cache import (
+    get_cached_token,
+    login_expiration,
+    read_shared_tokens,
+    refresh_in_background,
+    remember_token,
+    save_shared_token,
+    shared_cache_lock,
+)
+
+
+###################### login_expiration
+def test_login_expiration():
+    """Test para verificar la caducidad del token de la respuesta del login."""
+    login_json = {"data": [{"accessToken": "token", "tokenDteExpiration": {"$date": 1700000000000}}]}
+    assert login_expiration(login_json) == 1700000000
+    assert login_expiration({"data": [{"accessToken": "token"}]}) is None
+    assert login_expiration({"data": []}) is None
+
+
+###################### memory cache
+def test_remember_token():
+    """Test para verificar que el token se guarda en memoria por credencial."""
+    remember_token("client_a", "token_a", 123.0)
+    assert get_cached_token("client_a") == {"token": "token_a", "expiration": 123.0}
+    assert get_cached_token("client_unknown") is None
+
+
+@pytest.mark.asyncio
+async def test_refresh_in_background_once():
+    """Test para verificar que no se lanza una renovación si ya hay otra en curso."""
+    calls = []
+
+    async def refresh():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+
+    refresh_in_background("client_refresh", refresh)
+    refresh_in_background("client_refresh", refresh)
+    await token_cache._refreshing["client_refresh"]
+
+    assert len(calls) == 1
+
+
+###################### shared cache
+def test_save_and_read_shared_tokens(tmp_path):
+    """Test para verificar que la caché compartida guarda el token de cada credencial."""
+    cache_path = tmp_path / "cache" / "emt_tokens.json"
+    save_shared_token(cache_path, "client_a", {"token": "token_a", "expiration": 1.0})
+    save_shared_token(cache_path, "client_b", {"token": "token_b", "expiration": 2.0})
+
+    assert read_shared_tokens(cache_path) == {
+        "client_a": {"token": "token_a", "expiration": 1.0},
+        "client_b": {"token": "token_b", "expiration": 2.0},
+    }
+
+
+def test_read_shared_tokens_missing_or_invalid(tmp_path):
+    """Test para verificar que sin caché válida no hay tokens."""
+    assert read_shared_tokens(tmp_path / "missing.json") == {}
+
+    cache_path = tmp_path / "emt_tokens.json"
+    cache_path.write_text("not json")
+    assert read_shared_tokens(cache_path) == {}
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_lock(tmp_path):
+    """Test para verificar que el bloqueo de la caché compartida es exclusivo."""
+    cache_path = tmp_path / "emt_tokens.json"
+    order = []
+
+    async def hold(name, seconds):
+        async with shared_cache_lock(cache_path):
+            order.append(f"{name}_start")
+            await asyncio.sleep(seconds)
+            order.append(f"{name}_end")
+
+    first = asyncio.ensure_future(hold("first", 0.1))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(first, hold("second", 0))
+
+    assert order == ["first_start", "first_end", "second_start", "second_end"]
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_lock_waiters_free_executor(tmp_path):
+    """Test para verificar que esperar el bloqueo no ocupa los hilos del ejecutor."""
+    cache_path = tmp_path / "emt_tokens.json"
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=2))
+
+    async def hold():
+        async with shared_cache_lock(cache_path):
+            # El login del que tiene el bloqueo necesita el ejecutor (p. ej. para el DNS)
+            await loop.run_in_executor(None, time.sleep, 0.01)
+
+    await asyncio.wait_for(asyncio.gather(*[hold() for _ in range(3)]), timeout=5)
@@ -1,12 +1,15 @@
 import pytest
 import asyncio
+import datetime
 import aiofiles
 import os
 import yaml
+import botocore.exceptions
 from pathlib import Path
 from unittest.mock import MagicMock, patch, AsyncMock, Mock, mock_open
 
-from inesdata_mov_datasets.utils import list_objs, async_download, get_obj, download_obj, download_objs, read_obj, upload_obj, upload_metadata, upload_objs, read_settings, check_local_file_exists, check_s3_file_exists
+from inesdata_mov_datasets.settings import SourceEmtHttpSettings
+from inesdata_mov_datasets.utils import list_objs, async_download, get_obj, download_obj, download_objs, read_obj, upload_obj, manifest_shard_name, upload_manifest, read_manifest, upload_objs, read_settings, check_local_file_exists, check_s3_file_exists, s3_client_context, storage_client, http_session, HTTP_TIMEOUT, list_stored_objs, is_packed_file, pack_ndjson, read_ndjson, read_json_state, write_json_state
 
 ###################### list_objs
 @patch('inesdata_mov_datasets.utils.botocore.session.get_session')  # Cambia 'inesdata_mov_datasets.utils' por el nombre real del módulo
@@ -203,6 +206,21 @@ async def test_download_objs_without_eta(mock_logger, mock_list_objs, mock_downl
     mock_logger.debug.assert_any_call("Downloading files from s3")
     # mock_logger.debug.assert_any_call("Downloading 3 files from emt endpoint")
 
+@pytest.mark.asyncio
+@patch('inesdata_mov_datasets.utils.get_session')  
+@patch('inesdata_mov_datasets.utils.download_obj')  
+@patch('inesdata_mov_datasets.utils.read_manifest')  
+async def test_download_objs_with_eta(mock_read_manifest, mock_download_obj, mock_get_session):
+    """Test para verificar que con '/eta' en el prefix se descargan las claves del manifiesto."""
+    mock_client = AsyncMock()
+    mock_get_session.return_value.create_client.return_value.__aenter__.return_value = mock_client
+    mock_read_manifest.return_value = ['eta_1', 'eta_2']
+
+    await download_objs("my-bucket", "raw/emt/2024/03/11/eta/", "tmp/", "http://minio.example.com", "minio_user", "minio_password")
+
+    mock_read_manifest.assert_called_once_with(mock_client, "my-bucket", "raw/emt/2024/03/11/eta/")
+    assert mock_download_obj.call_count == 2
+
 ###################### read_obj
 @pytest.mark.asyncio
 @patch('inesdata_mov_datasets.utils.get_session')  
@@ -257,14 +275,13 @@ async def test_upload_obj(mock_client_creator_context):
     # Verifica que se llama a put_object con los parámetros correctos
     mock_client.put_object.assert_called_once_with(Bucket=bucket, Key=key, Body=object_value.encode("utf-8"))
 
-###################### upload_metadata
-@patch('botocore.session.get_session')  # Mock para la sesión de botocore
-def test_upload_metadata(mock_get_session):
-    """Test para verificar la subida de metadatos a S3."""
+###################### upload_manifest
+@pytest.mark.asyncio
+async def test_upload_manifest():
+    """Test para verificar que cada ejecución escribe su propio fragmento del manifiesto en S3."""
     
-    # Simular el cliente S3
-    mock_client = Mock()
-    mock_get_session.return_value.create_client.return_value = mock_client
+    # Simular el cliente S3 compartido
+    mock_client = AsyncMock()
 
     bucket = "my-bucket"
     endpoint_url = "http://localhost:9000"
@@ -272,29 +289,89 @@ def test_upload_metadata(mock_get_session):
     aws_secret_access_key = "test-secret-key"
     keys = ["some/object/key1", "some/object/key2"]
 
-    # Caso 1: El archivo de metadatos ya existe
-    mock_client.get_object.return_value = {
-        'Body': Mock(read=Mock(return_value=b'old_file1\nold_file2\n'))
+    await upload_manifest(bucket, endpoint_url, aws_access_key_id, aws_secret_access_key, keys, "1230", client=mock_client)
+
+    # No se lee el manifiesto previo
+    mock_client.get_object.assert_not_called()
+
+    # Verifica que se escribe un fragmento nuevo con las claves de la ejecución
+    expected_content = 'some/object/key1\nsome/object/key2'
+    mock_client.put_object.assert_called_once_with(Bucket=bucket, Key='some/object/_manifest/1230.txt', Body=expected_content.encode('utf-8'))
+
+def test_manifest_shard_name():
+    """Test para verificar que dos ejecuciones del mismo minuto no comparten fragmento del manifiesto."""
+    run_datetime = datetime.datetime(2024, 3, 11, 12, 30, 5)
+    first = manifest_shard_name(run_datetime)
+    second = manifest_shard_name(run_datetime)
+
+    assert first.startswith(f"123005_{os.getpid()}_")
+    assert first != second
+
+###################### read_manifest
+@pytest.mark.asyncio
+async def test_read_manifest():
+    """Test para verificar la lectura de todos los fragmentos del manifiesto y del metadata.txt antiguo."""
+    prefix = "raw/emt/2024/03/11/eta/"
+    contents = {
+        prefix + "_manifest/1230.txt": b"eta_1\neta_2\n",
+        prefix + "_manifest/1231.txt": b"eta_2\neta_3",
+        prefix + "metadata.txt": b"eta_0\n",
     }
-    
-    upload_metadata(bucket, endpoint_url, aws_access_key_id, aws_secret_access_key, keys)
 
-    # Verifica que se llama a get_object para obtener el contenido previo
-    mock_client.get_object.assert_called_once_with(Bucket=bucket, Key='some/object/metadata.txt')
+    async def paginate(Bucket, Prefix):
+        yield {"Contents": [{"Key": prefix + "_manifest/1230.txt"}, {"Key": prefix + "_manifest/1231.txt"}]}
+
+    async def get_object(Bucket, Key):
+        return {"Body": AsyncMock(read=AsyncMock(return_value=contents[Key]))}
+
+    mock_client = MagicMock()
+    mock_client.get_paginator.return_value.paginate.side_effect = paginate
+    mock_client.get_object.side_effect = get_object
+
+    keys = await read_manifest(mock_client, "my-bucket", prefix)
 
-    # Verifica que se llama a put_object con el nuevo contenido
-    expected_content = 'old_file1\nold_file2\n\nsome/object/key1\nsome/object/key2'
-    mock_client.put_object.assert_called_once_with(Bucket=bucket, Key='some/object/metadata.txt', Body=expected_content.encode('utf-8'))
+    assert keys == ["eta_1", "eta_2", "eta_3", "eta_0"]
 
-    # Caso 2: El archivo de metadatos no existe (primer ejecución del día)
-    mock_client.reset_mock()  # Reinicia los mocks
-    mock_client.get_object.side_effect = Exception("File not found")  # Simula que no se encuentra el archivo
+@pytest.mark.asyncio
+async def test_read_manifest_without_legacy_metadata():
+    """Test para verificar que no falla si no existe el metadata.txt antiguo."""
+    prefix = "raw/emt/2024/03/11/eta/"
 
-    upload_metadata(bucket, endpoint_url, aws_access_key_id, aws_secret_access_key, keys)
+    async def paginate(Bucket, Prefix):
+        yield {"Contents": [{"Key": prefix + "_manifest/1230.txt"}]}
 
-    # Verifica que se llama a put_object con el nuevo contenido
-    new_expected_content = 'some/object/key1\nsome/object/key2'
-    mock_client.put_object.assert_called_once_with(Bucket=bucket, Key='some/object/metadata.txt', Body=new_expected_content.encode('utf-8'))
+    async def get_object(Bucket, Key):
+        if Key.endswith("metadata.txt"):
+            raise botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": AsyncMock(read=AsyncMock(return_value=b"eta_1"))}
+
+    mock_client = MagicMock()
+    mock_client.get_paginator.return_value.paginate.side_effect = paginate
+    mock_client.get_object.side_effect = get_object
+
+    keys = await read_manifest(mock_client, "my-bucket", prefix)
+
+    assert keys == ["eta_1"]
+
+@pytest.mark.asyncio
+async def test_read_manifest_shard_error():
+    """Test para verificar que un fragmento que no se puede leer no se descarta en silencio."""
+    prefix = "raw/emt/2024/03/11/eta/"
+
+    async def paginate(Bucket, Prefix):
+        yield {"Contents": [{"Key": prefix + "_manifest/1230.txt"}]}
+
+    async def get_object(Bucket, Key):
+        if Key.endswith("metadata.txt"):
+            raise botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        raise botocore.exceptions.ClientError({"Error": {"Code": "SlowDown"}}, "GetObject")
+
+    mock_client = MagicMock()
+    mock_client.get_paginator.return_value.paginate.side_effect = paginate
+    mock_client.get_object.side_effect = get_object
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        await read_manifest(mock_client, "my-bucket", prefix)
 
 ###################### upload_objs
 @patch('botocore.session.get_session')  # Mock para la sesión de botocore
@@ -444,4 +521,195 @@ async def test_check_s3_file_exists_does_not_exist():
         
         result = await check_s3_file_exists(endpoint_url, aws_secret_access_key, aws_access_key_id, bucket_name, object_name)
 
-    assert result is False
\ No newline at end of file
+    assert result is False
+
+###################### s3_client_context
+@pytest.mark.asyncio
+async def test_s3_client_context_reuses_client():
+    """Test para verificar que se reutiliza el cliente compartido sin crear uno nuevo."""
+    shared_client = AsyncMock()
+
+    with patch("inesdata_mov_datasets.utils.get_session") as mock_get_session:
+        async with s3_client_context("http://localhost:9000", "secret", "access_key", shared_client) as client:
+            assert client is shared_client
+
+        mock_get_session.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_s3_client_context_opens_client():
+    """Test para verificar que se abre un cliente nuevo si no se proporciona ninguno."""
+    new_client = AsyncMock()
+
+    with patch("inesdata_mov_datasets.utils.get_session") as mock_get_session:
+        mock_get_session.return_value.create_client.return_value.__aenter__.return_value = new_client
+        async with s3_client_context("http://localhost:9000", "secret", "access_key") as client:
+            assert client is new_client
+
+        mock_get_session.return_value.create_client.assert_called_once()
+
+###################### storage_client
+@pytest.mark.asyncio
+async def test_storage_client_local():
+    """Test para verificar que no se abre cliente S3 con almacenamiento local."""
+    settings = MagicMock()
+    settings.storage.default = "local"
+
+    with patch("inesdata_mov_datasets.utils.get_session") as mock_get_session:
+        async with storage_client(settings) as client:
+            assert client is None
+
+        mock_get_session.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_storage_client_minio():
+    """Test para verificar que se abre un único cliente S3 con almacenamiento MinIO."""
+    settings = MagicMock()
+    settings.storage.default = "minio"
+    settings.storage.config.minio.max_pool_connections = 50
+    new_client = AsyncMock()
+
+    with patch("inesdata_mov_datasets.utils.get_session") as mock_get_session:
+        mock_get_session.return_value.create_client.return_value.__aenter__.return_value = new_client
+        async with storage_client(settings) as client:
+            assert client is new_client
+
+        mock_get_session.return_value.create_client.assert_called_once()
+
+###################### http_session
+@pytest.mark.asyncio
+async def test_http_session_reuses_session():
+    """Test para verificar que se reutiliza la sesión dada sin cerrarla."""
+    session = MagicMock()
+    async with http_session(session) as yielded:
+        assert yielded is session
+    session.close.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_http_session_default():
+    """Test para verificar que una sesión nueva aplica el timeout por defecto."""
+    async with http_session() as session:
+        assert session.timeout == HTTP_TIMEOUT
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_http_session_emt_settings():
+    """Test para verificar que se aplican el pool de conexiones y los timeouts configurados."""
+    http_settings = SourceEmtHttpSettings(
+        limit=20, limit_per_host=10, keepalive_timeout=5, ttl_dns_cache=60,
+        total_timeout=15, connect_timeout=2, read_timeout=8,
+    )
+    async with http_session(http_settings=http_settings) as session:
+        assert session.connector.limit == 20
+        assert session.connector.limit_per_host == 10
+        assert session.timeout.total == 15
+        assert session.timeout.connect == 2
+        assert session.timeout.sock_read == 8
+
+
+###################### list_stored_objs
+@pytest.mark.asyncio
+async def test_list_stored_objs_local(tmp_path):
+    """Test para verificar el índice de objetos ya guardados en local."""
+    settings = MagicMock()
+    settings.storage.default = "local"
+    settings.storage.config.local.path = str(tmp_path)
+    calendar_dir = tmp_path / "raw" / "emt" / "2024" / "03" / "11" / "calendar"
+    calendar_dir.mkdir(parents=True)
+    (calendar_dir / "calendar_20240311.json").write_text("{}")
+
+    stored_objs = await list_stored_objs(
+        settings, ["raw/emt/2024/03/11/calendar/", "raw/emt/2024/03/11/line_detail/"]
+    )
+
+    assert stored_objs == {"raw/emt/2024/03/11/calendar/calendar_20240311.json"}
+
+@pytest.mark.asyncio
+async def test_list_stored_objs_minio():
+    """Test para verificar el índice de objetos ya guardados en MinIO con una única paginación por prefijo."""
+    settings = MagicMock()
+    settings.storage.default = "minio"
+    settings.storage.config.minio.bucket = "my-bucket"
+
+    async def paginate(Bucket, Prefix):
+        yield {"Contents": [{"Key": Prefix + "obj_1.json"}]}
+        yield {"Contents": [{"Key": Prefix + "obj_2.json"}]}
+
+    mock_client = MagicMock()
+    mock_client.get_paginator.return_value.paginate.side_effect = paginate
+
+    stored_objs = await list_stored_objs(settings, ["raw/informo/2024/03/11/"], s3_client=mock_client)
+
+    mock_client.get_paginator.assert_called_once_with("list_objects_v2")
+    assert stored_objs == {"raw/informo/2024/03/11/obj_1.json", "raw/informo/2024/03/11/obj_2.json"}
+
+###################### pack_ndjson / read_ndjson
+def test_pack_and_read_ndjson_gzip(tmp_path):
+    """Test para verificar que los registros empaquetados en NDJSON comprimido se leen de vuelta."""
+    records = [{"stop_id": 1, "response": {"code": "00"}}, {"stop_id": 2, "response": {"code": "00"}}]
+    packed_file = tmp_path / "eta_2024-03-11T1230.ndjson.gz"
+    packed_file.write_bytes(pack_ndjson(records, "gzip"))
+
+    assert is_packed_file(packed_file.name)
+    assert not is_packed_file("eta_1_2024-03-11T1230.json")
+    assert list(read_ndjson(packed_file)) == records
+
+def test_pack_and_read_ndjson_zstd(tmp_path):
+    """Test para verificar que los registros empaquetados con zstd se leen de vuelta."""
+    records = [{"stop_id": 1, "response": {"code": "00"}}, b'{"stop_id": 2, "response": {"code":"00"}}']
+    packed_file = tmp_path / "eta_2024-03-11T1230.ndjson.zst"
+    packed_file.write_bytes(pack_ndjson(records, "zstd"))
+
+    assert is_packed_file(packed_file.name)
+    assert list(read_ndjson(packed_file)) == [{"stop_id": 1, "response": {"code": "00"}}, {"stop_id": 2, "response": {"code": "00"}}]
+
+def test_pack_ndjson_encoded_records(tmp_path):
+    """Test para verificar que los registros ya codificados se empaquetan tal cual."""
+    records = [b'{"stop_id": 1, "response": {"code":"00"}}', {"stop_id": 2}]
+    packed_file = tmp_path / "eta_2024-03-11T1230.ndjson.gz"
+    packed_file.write_bytes(pack_ndjson(records, "gzip"))
+
+    assert list(read_ndjson(packed_file)) == [{"stop_id": 1, "response": {"code": "00"}}, {"stop_id": 2}]
+
+def test_pack_ndjson_unknown_compression():
+    """Test para verificar que se rechaza una compresión desconocida."""
+    with pytest.raises(ValueError):
+        pack_ndjson([{"stop_id": 1}], "lz4")
+
+
+###################### read_json_state / write_json_state
+def test_write_and_read_json_state(tmp_path):
+    """Test para verificar que el estado se guarda y se lee del fichero local."""
+    state_path = tmp_path / "state" / "state.json"
+    write_json_state(state_path, {"limit": 4.0})
+
+    assert read_json_state(state_path) == {"limit": 4.0}
+    assert os.listdir(tmp_path / "state") == ["state.json"]
+
+
+def test_read_json_state_missing_or_invalid(tmp_path):
+    """Test para verificar que sin fichero válido el estado está vacío, con sus valores por defecto."""
+    assert read_json_state(tmp_path / "missing.json") == {}
+
+    state_path = tmp_path / "state.json"
+    state_path.write_text("not json")
+    assert read_json_state(state_path, defaults={"windows": {}}) == {"windows": {}}
+
+    state_path.write_text("[1, 2]")
+    assert read_json_state(state_path) == {}
+
+
+def test_read_json_state_defaults_and_memoize(tmp_path):
+    """Test para verificar los valores por defecto y que el estado se guarda en memoria."""
+    state_path = tmp_path / "state.json"
+    write_json_state(state_path, {"windows": {"1": [0, 60]}})
+    defaults = {"windows": {}, "stop_lines": {}}
+
+    state = read_json_state(state_path, defaults=defaults, memoize=True)
+    assert state == {"windows": {"1": [0, 60]}, "stop_lines": {}}
+    state["stop_lines"]["1"] = ["27"]
+    assert defaults["stop_lines"] == {}
+
+    assert read_json_state(state_path, defaults=defaults, memoize=True) is state
+    assert read_json_state(state_path) is not state